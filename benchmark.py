@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Benchmarks for rendering, compression and decoding on synthetic labels.
+#
+# $ python3 benchmark.py --save baseline.json      # record a baseline
+# $ python3 benchmark.py --compare baseline.json   # fail if something got slower
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import platform
+import random
+import sys
+import time
+
+import PIL.Image
+import PIL.ImageDraw
+
+import plotimg
+import rasterprynt
+
+# (printer model, tape size) combinations
+CONFIGS = sorted(rasterprynt.STRIPE_SIZE)
+# Fail --compare if a benchmark takes this much longer than the baseline
+TOLERANCE_DEFAULT = 0.25
+
+
+def text_label(width, height, rnd):
+    img = PIL.Image.new('L', (width, height), 255)
+    draw = PIL.ImageDraw.Draw(img)
+    for y in range(2, height - 10, 12):
+        line = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 -') for _ in range(width // 6))
+        draw.text((2, y), line, fill=0)
+    return img
+
+
+def barcode_label(width, height, rnd):
+    img = PIL.Image.new('RGB', (width, height), 'white')
+    draw = PIL.ImageDraw.Draw(img)
+    x = 10
+    while x < width - 10:
+        bar = rnd.randint(1, 4)
+        if rnd.random() < 0.5:
+            draw.rectangle((x, 5, x + bar - 1, height - 5), fill='black')
+        x += bar
+    return img
+
+
+def photo_label(width, height, rnd):
+    # Noisy gradient, dithered to black and white
+    img = PIL.Image.linear_gradient('L').resize((width, height))
+    noise = PIL.Image.frombytes('L', (width, height), bytes(rnd.getrandbits(8) for _ in range(width * height)))
+    return PIL.Image.blend(img, noise, 0.3).convert('1').convert('L')
+
+
+def blank_label(width, height, rnd):
+    img = PIL.Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    PIL.ImageDraw.Draw(img).rectangle((width // 2, height // 2, width // 2 + 3, height // 2 + 3), fill='black')
+    return img
+
+
+def banner_label(width, height, rnd):
+    return text_label(width * 10, height, rnd)
+
+
+CORPORA = {
+    'text': text_label,
+    'barcode': barcode_label,
+    'photo': photo_label,
+    'blank': blank_label,
+    'banner': banner_label,
+}
+
+
+def make_corpus(name, stripe_size, count=5, width=400, seed=0):
+    rnd = random.Random(seed)
+    return [CORPORA[name](width, stripe_size, rnd) for _ in range(count)]
+
+
+def measure(func, repeat):
+    # Returns the best time of repeat runs
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _compress_all(rows):
+    return [b''.join(rasterprynt._compress_tiff(row)) for row in rows]
+
+
+def _compress_all_rows(rows):
+    return [rasterprynt._compress_tiff_row(row) for row in rows]
+
+
+def benchmarks(corpora, quick=False):
+    # Yields tuples (name, func, pixels, bytes)
+    for printer_model, tape_size in CONFIGS:
+        stripe_size = rasterprynt.STRIPE_SIZE[(printer_model, tape_size)]
+        for corpus in corpora:
+            images = make_corpus(corpus, stripe_size, count=2 if quick else 5)
+            pixels = sum(img.width * img.height for img in images)
+            prefix = '%s/%s/%s' % (printer_model, tape_size, corpus)
+
+            for compression in rasterprynt.COMPRESSION_MODES:
+                data = rasterprynt.cat(
+                    images, printer_model=printer_model, tape_size=tape_size, compression=compression)
+                yield (
+                    '%s/cat-%s' % (prefix, compression),
+                    functools.partial(
+                        rasterprynt.cat, images, printer_model=printer_model, tape_size=tape_size,
+                        compression=compression),
+                    pixels, len(data))
+
+            bitmap = b''.join(rasterprynt._raster_bitmap(img, stripe_size) for img in images)
+            rows = [bitmap[i:i + stripe_size // 8] for i in range(0, len(bitmap), stripe_size // 8)]
+            yield (
+                '%s/compress_tiff' % prefix,
+                functools.partial(_compress_all, rows),
+                pixels, len(bitmap))
+            yield (
+                '%s/compress_tiff_row' % prefix,
+                functools.partial(_compress_all_rows, rows),
+                pixels, len(bitmap))
+
+            if printer_model != 'P950NW' or tape_size != '18mm':
+                continue
+            # The decoder does not depend on the model, so measure it only once per corpus
+            for compression in ('raw', 'tiff'):
+                data = rasterprynt.cat(images, printer_model=printer_model, compression=compression)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    decoded = plotimg.read_rows(data)
+                yield (
+                    '%s/read_rows-%s' % (prefix, compression),
+                    functools.partial(plotimg.read_rows, data),
+                    pixels, len(data))
+            yield (
+                '%s/plotimg' % prefix,
+                functools.partial(plotimg.plotimg, decoded),
+                pixels, len(data))
+
+    # Parallel rendering
+    images = make_corpus('text', rasterprynt.STRIPE_SIZE[('P950NW', '36mm')], count=8 if quick else 40)
+    pixels = sum(img.width * img.height for img in images)
+    data = rasterprynt.cat(images, printer_model='P950NW', tape_size='36mm', compression='auto')
+    for workers in (1, 2, 4):
+        yield (
+            'P950NW/36mm/text/cat-auto-workers%d' % workers,
+            functools.partial(
+                rasterprynt.cat, images, printer_model='P950NW', tape_size='36mm', compression='auto',
+                workers=workers),
+            pixels, len(data))
+
+
+def run(corpora, repeat, quick=False, name_filter=None):
+    results = {}
+    for name, func, pixels, byte_count in benchmarks(corpora, quick=quick):
+        if name_filter and name_filter not in name:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = measure(func, repeat)
+        results[name] = {
+            'seconds': seconds,
+            'pixels_per_second': pixels / seconds,
+            'bytes_per_second': byte_count / seconds,
+        }
+        print('%-50s %10.2f ms %12.0f px/s %12.0f B/s' % (
+            name, seconds * 1000, pixels / seconds, byte_count / seconds))
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Returns a list of regression descriptions
+    regressions = []
+    for name, base in sorted(baseline['results'].items()):
+        current = results.get(name)
+        if current is None:
+            continue
+        ratio = current['seconds'] / base['seconds']
+        if ratio > 1 + tolerance:
+            regressions.append('%s: %.2f ms -> %.2f ms (%+.0f%%)' % (
+                name, base['seconds'] * 1000, current['seconds'] * 1000, (ratio - 1) * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark rasterprynt and plotimg')
+    parser.add_argument(
+        '--corpus', metavar='NAME', action='append', choices=sorted(CORPORA),
+        help='Only run benchmarks on this corpus (can be given multiple times)')
+    parser.add_argument(
+        '-k', '--filter', metavar='TEXT',
+        help='Only run benchmarks whose name contains TEXT')
+    parser.add_argument(
+        '--repeat', default=3, metavar='INT', type=int,
+        help='Number of runs per benchmark; the fastest counts (default: %(default)s)')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Use smaller corpora')
+    parser.add_argument(
+        '--save', metavar='FILE.json',
+        help='Write the results to a JSON file, to be used as a baseline')
+    parser.add_argument(
+        '--compare', metavar='FILE.json',
+        help='Compare with a baseline and fail on regressions')
+    parser.add_argument(
+        '--tolerance', default=TOLERANCE_DEFAULT, metavar='FRACTION', type=float,
+        help='Allowed slowdown relative to the baseline (default: %(default)s)')
+    args = parser.parse_args()
+
+    corpora = args.corpus or sorted(CORPORA)
+    results = run(corpora, args.repeat, quick=args.quick, name_filter=args.filter)
+
+    if args.save:
+        with open(args.save, 'w') as save_f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, save_f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_f:
+            baseline = json.load(baseline_f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions compared to %s:' % args.compare)
+            for r in regressions:
+                print('  ' + r)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# Emulates a Brother P-Touch printer on the local machine, for load and soak tests without hardware.
+# Jobs sent to the raster port are decoded like plotimg does, and every printed page is recorded.
+
+import argparse
+import collections
+import http.server
+import os
+import socket
+import struct
+import threading
+import time
+
+import plotimg
+from rasterprynt import parser as commands
+from rasterprynt import status
+
+# Minimal versions of the pages detect_printer_model looks at
+MODEL_HTML = {
+    'P950NW': b'<html><head><title>Brother PT-P950NW</title></head><body></body></html>',
+    '9800PCN': b'<HTML><HEAD><TITLE>Brother PT-9800PCN</TITLE></HEAD><BODY></BODY></HTML>',
+}
+
+PrintedPage = collections.namedtuple('PrintedPage', ['connection', 'job', 'raster', 'time'])
+
+
+class FakePrinter(object):
+    """ A fake printer listening on host:port (port 0 picks a free port).
+
+    If http_port is not None, /admin/default.html is served there for detect_printer_model
+    (with a 401 status if password is set, like a printer with a password).
+    rows_per_second limits the print speed: after every page, the printer stops reading for as long as printing
+    takes. bytes_per_second limits the speed of reading, and recv_buffer the size of the receive buffer,
+    so that senders experience backpressure.
+    Faults: read_delay seconds are waited before every read. The first reset_count connections
+    (all if None) are reset once reset_after bytes have been received on them.
+    For long soak tests, keep_rasters=False only records that pages were printed, not their content.
+    Once a connection has sent a status request, the printer sends status frames on it like a real printer:
+    phase changes and "printing completed" for every page. media_width is the tape width reported there (in mm).
+    After tape_out_after pages, the printer reports that it has no media and does not print anymore.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, model='P950NW', http_port=None, password=False,
+                 rows_per_second=None, bytes_per_second=None, read_size=65536, recv_buffer=None,
+                 read_delay=0, reset_after=None, reset_count=None, keep_rasters=True, media_width=18,
+                 tape_out_after=None):
+        self.model = model
+        self.media_width = media_width
+        self.tape_out_after = tape_out_after
+        self.keep_rasters = keep_rasters
+        self.password = password
+        self.rows_per_second = rows_per_second
+        self.bytes_per_second = bytes_per_second
+        self.read_size = read_size
+        self.read_delay = read_delay
+        self.reset_after = reset_after
+        self.reset_count = reset_count
+
+        self.pages = []
+        self.errors = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._connection_count = 0
+        self._job_count = 0
+        self._reset_connections = 0
+        self._resets = 0
+        self._bytes = 0
+        self._first_byte = self._last_byte = None
+        self._connections = set()
+        self._closed = False
+
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if recv_buffer is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.host, self.port = self.sock.getsockname()[:2]
+        self._thread = threading.Thread(target=self._serve, name='fakeprinter')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.http_server = None
+        if http_port is not None:
+            self.http_server = http.server.ThreadingHTTPServer((host, http_port), self._http_handler())
+            self.http_server.daemon_threads = True
+            http_thread = threading.Thread(target=self.http_server.serve_forever, name='fakeprinter-http')
+            http_thread.daemon = True
+            http_thread.start()
+
+    @property
+    def http_host(self):
+        """ Host and port of the web interface, to be passed to detect_printer_model instead of the IP """
+        return '%s:%d' % self.http_server.server_address[:2]
+
+    def _http_handler(self):
+        printer = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/admin/default.html':
+                    self.send_error(404)
+                    return
+                body = MODEL_HTML[printer.model]
+                self.send_response(401 if printer.password else 200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                    return
+                connection_id = self._connection_count
+                self._connection_count += 1
+                self._connections.add(conn)
+            thread = threading.Thread(
+                target=self._handle, args=(conn, connection_id), name='fakeprinter-%d' % connection_id)
+            thread.daemon = True
+            thread.start()
+
+    def _take_reset(self):
+        with self._lock:
+            if self.reset_count is not None and self._reset_connections >= self.reset_count:
+                return False
+            self._reset_connections += 1
+            return True
+
+    def _handle(self, conn, connection_id):
+        parser = commands.Parser()
+        collector = plotimg.RowCollector()
+        received = 0
+        reset = self.reset_after is not None and self._take_reset()
+        send_status = False
+        was_reset = False
+        try:
+            while True:
+                if self.read_delay:
+                    time.sleep(self.read_delay)
+                try:
+                    data = conn.recv(self.read_size)
+                except OSError:
+                    return
+                if not data:
+                    parser.close()
+                    return
+                if reset and received + len(data) >= self.reset_after:
+                    data = data[:self.reset_after - received]
+                self._count_bytes(len(data))
+                received += len(data)
+
+                for event in parser.feed(data):
+                    collector.add_events((event,))
+                    if isinstance(event, commands.StatusRequest):
+                        send_status = True
+                        self._send_status(conn, status.STATUS_REPLY)
+                    if isinstance(event, (commands.FormFeed, commands.Print)):
+                        self._print_page(connection_id, collector, conn if send_status else None)
+                    if isinstance(event, commands.Print):
+                        with self._cond:
+                            self._job_count += 1
+                            self._cond.notify_all()
+
+                if reset and received >= self.reset_after:
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                    was_reset = True
+                    return
+                if self.bytes_per_second:
+                    time.sleep(len(data) / float(self.bytes_per_second))
+        except (ValueError, NotImplementedError, AssertionError) as e:
+            with self._cond:
+                self.errors.append((connection_id, e))
+                self._cond.notify_all()
+        finally:
+            conn.close()
+            with self._cond:
+                self._connections.discard(conn)
+                if was_reset:
+                    self._resets += 1  # Only counted once the reset has been sent
+                self._cond.notify_all()
+
+    def _count_bytes(self, count):
+        now = time.time()
+        with self._lock:
+            if self._first_byte is None:
+                self._first_byte = now
+            self._last_byte = now
+            self._bytes += count
+
+    def _tape_out(self):
+        return self.tape_out_after is not None and len(self.pages) >= self.tape_out_after
+
+    def _send_status(self, conn, status_type, phase=status.PHASE_RECEIVING):
+        errors = ['no_media'] if self._tape_out() else []
+        try:
+            conn.sendall(status.make_status(status_type, phase, errors, media_width=self.media_width))
+        except OSError:
+            pass  # The sender does not have to listen
+
+    def _print_page(self, connection_id, collector, status_conn=None):
+        # status_conn is the connection to send status frames on, if any
+        rows = collector.rows
+        raster = None
+        if rows and self.keep_rasters:
+            raster = plotimg._make_raster(rows, collector.margin, collector.mirroring, collector.row_len())
+        # Only keep the rows of the current page
+        collector.rows = []
+        collector.page_starts = [0]
+        if self._tape_out():
+            if status_conn is not None:
+                self._send_status(status_conn, status.STATUS_ERROR)
+            return
+        if status_conn is not None:
+            self._send_status(status_conn, status.STATUS_PHASE_CHANGE, status.PHASE_PRINTING)
+        if self.rows_per_second:
+            time.sleep(len(rows) / float(self.rows_per_second))
+        with self._cond:
+            self.pages.append(PrintedPage(connection_id, self._job_count, raster, time.time()))
+            self._cond.notify_all()
+        if status_conn is not None:
+            self._send_status(status_conn, status.STATUS_PRINTING_COMPLETED)
+            self._send_status(status_conn, status.STATUS_PHASE_CHANGE)
+
+    def wait_for_pages(self, count, timeout=10):
+        """ Waits until count pages have been printed. Returns whether they have. """
+        deadline = time.time() + timeout
+        with self._cond:
+            while len(self.pages) < count and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            return len(self.pages) >= count
+
+    def stats(self):
+        with self._lock:
+            seconds = (self._last_byte - self._first_byte) if self._first_byte is not None else 0
+            pages = len(self.pages)
+            return {
+                'connections': self._connection_count,
+                'jobs': self._job_count,
+                'pages': pages,
+                'bytes': self._bytes,
+                'resets': self._resets,
+                'errors': len(self.errors),
+                'seconds': seconds,
+                'bytes_per_second': self._bytes / seconds if seconds else 0,
+                'pages_per_second': pages / seconds if seconds else 0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            connections = list(self._connections)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes up accept
+        except OSError:
+            pass
+        self.sock.close()
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser('Emulate a Brother P-Touch printer for load tests')
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='Address to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--port', type=int, default=9100,
+        help='Raster port (default: %(default)s)')
+    parser.add_argument(
+        '--http-port', type=int, metavar='PORT',
+        help='Serve a fake web interface for printer detection on this port')
+    parser.add_argument(
+        '--model', choices=sorted(MODEL_HTML), default='P950NW',
+        help='Printer model reported by the web interface (default: %(default)s)')
+    parser.add_argument(
+        '--rows-per-second', type=float, metavar='ROWS',
+        help='Print speed in raster rows (pixels along the tape) per second (default: unlimited)')
+    parser.add_argument(
+        '--bytes-per-second', type=float, metavar='BYTES',
+        help='Limit the speed of reading from the network (default: unlimited)')
+    parser.add_argument(
+        '--recv-buffer', type=int, metavar='BYTES',
+        help='Size of the receive buffer, for earlier backpressure')
+    parser.add_argument(
+        '--read-delay', type=float, default=0, metavar='SECONDS',
+        help='Wait this long before every read')
+    parser.add_argument(
+        '--reset-after', type=int, metavar='BYTES',
+        help='Reset connections after receiving this many bytes on them')
+    parser.add_argument(
+        '--reset-count', type=int, metavar='INT',
+        help='Only reset this many connections (default: all)')
+    parser.add_argument(
+        '--media-width', type=int, default=18, metavar='MM',
+        help='Tape width reported in status information (default: %(default)s)')
+    parser.add_argument(
+        '--tape-out-after', type=int, metavar='PAGES',
+        help='Run out of tape after printing this many pages')
+    parser.add_argument(
+        '-o', '--output-dir', metavar='DIR',
+        help='Write printed pages as page-N.pbm to this directory')
+    parser.add_argument(
+        '--report-interval', type=float, default=10, metavar='SECONDS',
+        help='Print statistics this often (default: %(default)s)')
+    args = parser.parse_args()
+
+    printer = FakePrinter(
+        host=args.host, port=args.port, model=args.model, http_port=args.http_port,
+        rows_per_second=args.rows_per_second, bytes_per_second=args.bytes_per_second,
+        recv_buffer=args.recv_buffer, read_delay=args.read_delay,
+        reset_after=args.reset_after, reset_count=args.reset_count, keep_rasters=bool(args.output_dir),
+        media_width=args.media_width, tape_out_after=args.tape_out_after)
+    print('Listening on %s:%d' % (printer.host, printer.port))
+    written = 0
+    try:
+        while True:
+            time.sleep(args.report_interval)
+            print(', '.join('%s: %s' % (k, round(v, 1)) for k, v in sorted(printer.stats().items())))
+            if args.output_dir:
+                for page in printer.pages[written:]:
+                    written += 1
+                    if page.raster is not None:
+                        plotimg.write_image(page.raster, os.path.join(args.output_dir, 'page-%d.pbm' % written))
+                        printer.pages[written - 1] = page._replace(raster=None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        printer.close()
+
+
+if __name__ == '__main__':
+    main()
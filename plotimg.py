@@ -1,244 +1,552 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import io
+import os.path
+import socket
 import struct
+import sys
 
+from rasterprynt import STRIPE_SIZE
+from rasterprynt import parser as commands
+from rasterprynt.parser import (  # NOQA
+    COMPRESSION_RAW,
+    COMPRESSION_TIFF,
+    MODE_ESCP,
+    MODE_PTOUCH,
+    MODE_RASTER,
+    tiff_uncompress,
+)
 
-MODE_ESCP = 0x00
-MODE_RASTER = 0x01
-MODE_PTOUCH = 0x02
-COMPRESSION_RAW = 0
-COMPRESSION_TIFF = 2
+# Size of the chunks in which binary input files are read
+CHUNK_SIZE = 1024 * 1024
 
+# Maps every byte to the byte with the reversed bit order
+_REVERSE_BITS = bytes(int('{:08b}'.format(b)[::-1], 2) for b in range(256))
+# Maps every byte to its bits in netpbm P1 notation
+_P1_BITS = [' '.join('{:08b}'.format(b)).encode('ascii') for b in range(256)]
+# Bytes per row of pages without any raster rows (only Z), by print information command (ESC i z / ESC i c)
+_DEFAULT_ROW_LEN = {
+    'z': STRIPE_SIZE[('P950NW', '18mm')] // 8,
+    'c': STRIPE_SIZE[('9800PCN', '18mm')] // 8,
+}
 
-def hexstr(b):
-    return ' '.join('%02x' % byte for byte in b)
-
-
-def tiff_uncompress(data):
-    """ Yields the bytes in compressed TIFF format """
-    p = 0
-    while p < len(data):
-        num = struct.unpack('!b', data[p:p+1])[0]
-        if num < 0:
-            count = (- num) + 1
-            repeat = data[p + 1:p + 2]
-            yield repeat * count
-            p += 2
-        else:
-            dlen = num + 1
-            yield data[p + 1:p + 1 + dlen]
-            p += 1 + dlen
 
+class Raster(object):
+    """ A 1-bit image. Every row is a bytes object of width / 8 bytes; set bits (MSB first) are black. """
 
-def read_rows(bc):
-    """ Read rows from the brother commands (as one bytes object) bc """
-    p = 0
-
-    # Skip zeroes at the start (if present)
-    while bc[p] == 0:
-        p += 1
-
-    mode = 0x02  # P-Touch
-    margin = 0
-    compression_mode = None
-    mirroring = False
-
-    rows = []
-    while p < len(bc):
-        if mode == MODE_RASTER and bc[p] == ord('M'):  # Select compression mode
-            compression_mode = bc[p + 1]
-            assert compression_mode in (COMPRESSION_RAW, COMPRESSION_TIFF)
-            p += 2
-            continue
-        elif mode == MODE_RASTER and bc[p] == ord('Z'):  # Zero raster graphics
-            rows.append('empty')
-            p += 1
-            continue
-        elif mode == MODE_RASTER and bc[p] == ord('G'):  # Seems to be the same as g?
-            dlen = struct.unpack('<H', bc[p + 1:p + 3])[0]
-            p += 3
-            img_data = bc[p:p + dlen]
-            p += dlen
-            if compression_mode == COMPRESSION_TIFF:
-                binrow = b''.join(tiff_uncompress(img_data))
-            elif compression_mode == COMPRESSION_RAW:
-                binrow = img_data
-            else:
-                raise ValueError('Invalid compression mode %r' % compression_mode)
-            row = []
-            for c in binrow:
-                for bit in range(8):
-                    v = (c >> (7 - bit)) & 0x01
-                    col = (0, 0, 0) if v else (255, 255, 255)
-                    row.append(col)
-            rows.append(row)
-            continue
-        elif bc[p] == 0xff:  # Print command
-            p += 1
-            continue
-        elif mode == MODE_RASTER and bc[p] == 0x1a:  # Print Command with feeding
-            p += 1
-            continue
-        elif bc[p] == 0x0c or bc[p] == 0x0f:
-            print('Form feed at position %x, ignoring' % p)
-            p += 1
-            continue
+    def __init__(self, width, rows):
+        assert width % 8 == 0
+        assert all(len(r) * 8 == width for r in rows)
+        self.width = width
+        self.rows = rows
 
-        # ESC code
-        if bc[p] != 0x1b:
-            raise ValueError(
-                'Invalid control character: Expected ESC; got 0x%02x at position 0x%x' % (bc[p], p))
-
-        p += 1
-        cmd = bc[p]
-
-        if cmd == ord('@'):
-            pass  # Initialize
-        elif cmd == ord('i'):
-            p += 1
-            subcmd = bc[p]
-
-            if subcmd == ord('a'):  # Switch command mode
-                p += 1
-                mode = bc[p]
-                assert mode in (MODE_ESCP, MODE_RASTER, MODE_PTOUCH)
-            elif subcmd == ord('c'):  # Some kind of initialization
-                print('Unknown 9800PCN initialization')
-                p += 5
-            elif subcmd == ord('U'):  # Serial bus configuration
-                p += 1
-                subsubcmd = bc[p]
-
-                if subsubcmd == ord('B'):
-                    p += 1  # Baud rate - we don't care
-                elif mode == MODE_RASTER and subsubcmd == ord('J'):  # TODO ??
-                    p += 14
-                else:
-                    raise NotImplementedError(
-                        'Unsupported bus subsubcommand of iU in mode %s: %s / 0x%02x' %
-                        (mode, chr(subsubcmd), subsubcmd))
-            elif mode == MODE_RASTER and subcmd == ord('z'):
-                print('Print information command: %s' % hexstr(bc[p+1:p+11]))
-                p += 10
-            elif mode == MODE_RASTER and subcmd == ord('A'):  # TODO ??
-                print('Unknown command iA, args %s' % hexstr(bc[p+1:p+2]))
-                p += 1
-            elif mode == MODE_RASTER and subcmd == ord('k'):  # TODO ??
-                print('Unknown command ik, args %s' % hexstr(bc[p+1:p+4]))
-                p += 3
-            elif mode == MODE_RASTER and subcmd == ord('K'):  # Advanced Mode settings
-                p += 1  # we don't care
-            elif mode == MODE_RASTER and subcmd == ord('d'):  # Margin
-                margin = struct.unpack('<H', bc[p + 1:p + 3])[0]
-                p += 2
-            elif subcmd == ord('M'):  # Various Mode Settings
-                p += 1
-                rest_bits = bc[p] & 0x9f
-                if rest_bits != 0:
-                    raise NotImplementedError('Strange bits in Various Mode settings: 0x%02x' % bc[p])
-                mirroring = (bc[p] & 0x4) != 0
-            else:
-                raise NotImplementedError(
-                    'Unsupported subcommand i %s / 0x%02x in mode %s' %
-                    (chr(subcmd), subcmd, mode))
-        else:
-            raise NotImplementedError('Unsupported command %s / 0x%02x' % (chr(cmd), cmd))
+    @property
+    def height(self):
+        return len(self.rows)
+
+    def pixel(self, x, y):
+        """ Returns True if the pixel is black """
+        return bool(self.rows[y][x // 8] & (0x80 >> (x % 8)))
+
+    def __eq__(self, other):
+        return isinstance(other, Raster) and self.width == other.width and self.rows == other.rows
 
-        p += 1
+    def __ne__(self, other):
+        return not self == other
 
-    print('margin: %r' % margin)
+    def __repr__(self):
+        return 'Raster(%d x %d)' % (self.width, self.height)
 
+
+def hexstr(b):
+    return ' '.join('%02x' % byte for byte in bytearray(b))
+
+
+class RowCollector(object):
+    """ Collects the rows of a command stream, which can be fed in chunks """
+
+    def __init__(self):
+        self.parser = commands.Parser()
+        self.margin = 0
+        self.mirroring = False
+        self.rows = []  # bytes, or None for empty rows
+        self.page_starts = [0]
+        self.stripe_bytes = None  # Length of the raster rows seen so far
+        self.default_stripe_bytes = None  # From the print information
+
+    def feed(self, data):
+        self.add_events(self.parser.feed(data))
+
+    def add_events(self, events):
+        for event in events:
+            if isinstance(event, commands.RasterRow):
+                row = event.decode()
+                if self.stripe_bytes is None:
+                    self.stripe_bytes = len(row)
+                self.rows.append(row)
+            elif isinstance(event, commands.ZeroRow):
+                self.rows.append(None)
+            elif isinstance(event, commands.FormFeed):  # next page
+                self.page_starts.append(len(self.rows))
+            elif isinstance(event, commands.PrintInfo):
+                self.default_stripe_bytes = _DEFAULT_ROW_LEN.get(event.command)
+            elif isinstance(event, commands.Margin):
+                self.margin = event.margin
+            elif isinstance(event, commands.VariousMode):
+                self.mirroring = event.mirroring
+
+    def raster(self):
+        """ Returns the whole job as a Raster """
+        return _make_raster(self.rows, self.margin, self.mirroring, self.row_len())
+
+    def row_len(self):
+        """ Bytes per row for pages which only consist of empty rows """
+        return self.stripe_bytes if self.stripe_bytes is not None else self.default_stripe_bytes
+
+    def pages(self):
+        """ Returns a Raster per page """
+        page_ends = self.page_starts[1:] + [len(self.rows)]
+        return [
+            _make_raster(self.rows[start:end], self.margin, self.mirroring, self.row_len())
+            for start, end in zip(self.page_starts, page_ends)]
+
+
+def _make_raster(rows, margin, mirroring, row_len=None):
+    # row_len (in bytes) is only used if all rows are empty
     assert len(rows) > 0
-    rows = ['empty'] * margin + rows + ['empty'] * margin
-    max_len = max(len(r) for r in rows if r != 'empty')
-    rows = [[(0xff, 0xff, 0xff)] * max_len if r == 'empty' else r for r in rows]
-    assert all(len(r) == max_len for r in rows)
+    rows = [None] * margin + rows + [None] * margin
+    lengths = [len(r) for r in rows if r is not None]
+    if lengths:
+        row_len = max(lengths)
+    elif row_len is None:
+        raise ValueError('Cannot determine the width of a page without raster rows')
+    empty = bytes(row_len)
+    if mirroring:
+        rows = [empty if r is None else r for r in rows]
+    else:
+        rows = [empty if r is None else r[::-1].translate(_REVERSE_BITS) for r in rows]
+
+    return Raster(row_len * 8, rows)
+
 
-    if not mirroring:
-        for r in rows:
-            r.reverse()
+def _collect(bc):
+    collector = RowCollector()
+    collector.add_events(commands.parse(bc))
+    return collector
+
+
+def read_rows(bc):
+    """ Read rows from the brother commands (as one bytes object) bc. Returns a Raster of the whole job. """
+    return _collect(bc).raster()
 
-    return rows
 
+def read_pages(bc):
+    """ Like read_rows, but returns one Raster per page (pages are separated by form feeds) """
+    return _collect(bc).pages()
 
-def plotimg(rows):
-    """ Returns the netbpm image as bytes """
 
-    height = len(rows)
-    width = len(rows[0])
-    assert all(all(c in ((0, 0, 0), (255, 255, 255)) for c in row) for row in rows)
+def plotimg(raster):
+    """ Returns the netbpm image of a Raster as bytes """
 
     return (
         b'P1\n' +
-        ('%d %d\n' % (width, height)).encode('ascii') +
-        b'\n'.join(b' '.join(b'1' if cell == (0, 0, 0) else b'0' for cell in row) for row in rows)
+        ('%d %d\n' % (raster.width, raster.height)).encode('ascii') +
+        b'\n'.join(b' '.join(_P1_BITS[b] for b in bytearray(row)) for row in raster.rows)
     )
 
 
+def plotimg_p4(raster):
+    """ Returns the binary netbpm (P4) image of a Raster as bytes """
+    return ('P4\n%d %d\n' % (raster.width, raster.height)).encode('ascii') + b''.join(raster.rows)
+
+
+def raster_image(raster):
+    """ Returns a Raster as PIL image (mode 1) """
+    import PIL.Image  # If this fails run pip3 install Pillow
+
+    # In mode 1, set bits are white
+    return PIL.Image.frombytes('1', (raster.width, raster.height), b''.join(raster.rows), 'raw', '1;I')
+
+
+OUTPUT_FORMATS = ('auto', 'p1', 'p4', 'png')
+
+
+def write_image(raster, filename, output_format='auto'):
+    if output_format == 'auto':
+        output_format = 'png' if filename.lower().endswith('.png') else 'p4'
+
+    if output_format == 'png':
+        raster_image(raster).save(filename, 'PNG')
+        return
+
+    img_bytes = plotimg(raster) if output_format == 'p1' else plotimg_p4(raster)
+    with open(filename, 'wb') as output_f:
+        output_f.write(img_bytes)
+
+
+def page_filename(filename, page_num):
+    """ Filename of a page when splitting pages: label.pbm -> label-1.pbm """
+    base, ext = os.path.splitext(filename)
+    return '%s-%d%s' % (base, page_num, ext)
+
+
+PCAP_MAGICS = (b'\xa1\xb2\xc3\xd4', b'\xd4\xc3\xb2\xa1', b'\xa1\xb2\x3c\x4d', b'\x4d\x3c\xb2\xa1')
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+
+
 def detect_format(b):
-    if b[:4] in (b'\xa1\xb2\xc3\xd4', b'\xd4\xc3\xb2\xa1'):
+    if b[:4] in PCAP_MAGICS:
         return 'pcap'
+    if b[:4] == PCAPNG_MAGIC:
+        return 'pcapng'
     return 'bin'
 
 
-def parse_pcap(b):
-    import scapy  # If this fails run pip3 install scapy
-    import scapy.all
-    TCP = scapy.all.TCP
-
-    pseudo_file = io.BytesIO(b)
-    pcap_file = scapy.all.rdpcap(pseudo_file)
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return data
+
+
+def read_pcap_packets(f):
+    """ Yields tuples (linktype, packet data) from a pcap or pcapng file object """
+    magic = f.read(4)
+    if magic == PCAPNG_MAGIC:
+        for packet in _read_pcapng_packets(f):
+            yield packet
+        return
+    if magic not in PCAP_MAGICS:
+        raise ValueError('Not a pcap file')
+
+    endian = '>' if magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d') else '<'
+    header = _read_exactly(f, 20)
+    linktype = struct.unpack(endian + 'HHiIII', header)[5] & 0x0fffffff
+    while True:
+        record = f.read(16)
+        if len(record) < 16:
+            return
+        _, _, incl_len, _ = struct.unpack(endian + 'IIII', record)
+        yield linktype, _read_exactly(f, incl_len)
+
+
+def _read_pcapng_packets(f):
+    # The section header block type has already been read
+    endian = None
+    linktypes = []
+    block_type = 0x0a0d0d0a
+    while True:
+        if block_type == 0x0a0d0d0a:  # Section header block
+            length_bytes = _read_exactly(f, 4)
+            bom = _read_exactly(f, 4)
+            endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            block_len = struct.unpack(endian + 'I', length_bytes)[0]
+            _read_exactly(f, block_len - 12)
+            linktypes = []
+        else:
+            block_len = struct.unpack(endian + 'I', _read_exactly(f, 4))[0]
+            body = _read_exactly(f, block_len - 12)
+            _read_exactly(f, 4)  # Trailing block length
+
+            if block_type == 1:  # Interface description block
+                linktypes.append(struct.unpack(endian + 'H', body[:2])[0])
+            elif block_type == 6:  # Enhanced packet block
+                interface_id, _, _, cap_len, _ = struct.unpack(endian + 'IIIII', body[:20])
+                yield linktypes[interface_id], body[20:20 + cap_len]
+            elif block_type == 3:  # Simple packet block
+                orig_len = struct.unpack(endian + 'I', body[:4])[0]
+                yield linktypes[0], body[4:4 + orig_len]
+            elif block_type == 2:  # Packet block (obsolete)
+                interface_id, _, _, _, cap_len, _ = struct.unpack(endian + 'HHIIII', body[:20])
+                yield linktypes[interface_id], body[20:20 + cap_len]
+
+        type_bytes = f.read(4)
+        if len(type_bytes) < 4:
+            return
+        block_type = struct.unpack(endian + 'I', type_bytes)[0]
+
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+
+TcpSegment = collections.namedtuple('TcpSegment', ['src', 'sport', 'dst', 'dport', 'seq', 'flags', 'payload'])
+
+
+def _ip_packet(linktype, data):
+    """ Returns the IP packet in a link layer frame, or None """
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype = struct.unpack('!H', data[12:14])[0]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = struct.unpack('!H', data[offset + 2:offset + 4])[0]
+            offset += 4
+        return data[offset:] if ethertype in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return data[16:] if struct.unpack('!H', data[14:16])[0] in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return data[20:] if struct.unpack('!H', data[0:2])[0] in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if linktype == LINKTYPE_NULL:
+        return data[4:]
+    if linktype in LINKTYPE_RAW or linktype in (LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return data
+    return None
+
+
+def _tcp_segment(ip):
+    """ Returns a TcpSegment for an IP packet, or None if it is not TCP """
+    if len(ip) < 20:
+        return None
+    version = bytearray(ip[:1])[0] >> 4
+    if version == 4:
+        ihl = (bytearray(ip[:1])[0] & 0x0f) * 4
+        total_len, frag, proto = struct.unpack('!H2xHxB', ip[2:10])
+        if proto != 6 or frag & 0x1fff:  # Not TCP, or a later fragment
+            return None
+        src = socket.inet_ntop(socket.AF_INET, ip[12:16])
+        dst = socket.inet_ntop(socket.AF_INET, ip[16:20])
+        tcp = ip[ihl:total_len]
+    elif version == 6:
+        payload_len, next_header = struct.unpack('!HB', ip[4:7])
+        src = socket.inet_ntop(socket.AF_INET6, ip[8:24])
+        dst = socket.inet_ntop(socket.AF_INET6, ip[24:40])
+        tcp = ip[40:40 + payload_len]
+        while next_header in (0, 43, 60):  # Hop-by-hop, routing and destination options
+            next_header = bytearray(tcp[:1])[0]
+            tcp = tcp[(bytearray(tcp[1:2])[0] + 1) * 8:]
+        if next_header != 6:
+            return None
+    else:
+        return None
+
+    if len(tcp) < 20:
+        return None
+    sport, dport, seq, offset_byte, flags = struct.unpack('!HHIxxxxBB', tcp[:14])
+    return TcpSegment(src, sport, dst, dport, seq, flags, tcp[(offset_byte >> 4) * 4:])
+
+
+def _seq_diff(a, b):
+    """ a - b in TCP sequence number space """
+    return ((a - b + 2 ** 31) % 2 ** 32) - 2 ** 31
+
+
+# When a segment is missing, give up waiting for it once this many bytes are buffered after it
+MAX_REORDER_BYTES = 16 * 1024 * 1024
+
+
+class _TcpFlow(object):
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}  # seq -> payload of segments which arrived too early
+        self.pending_bytes = 0
+
+    def add(self, seg):
+        """ Returns the list of payloads which can be delivered in order after this segment """
+        if seg.flags & TCP_SYN:
+            if self.next_seq is None:
+                self.next_seq = (seg.seq + 1) % 2 ** 32
+            return []
+        if not seg.payload:
+            return []
+        if self.next_seq is None:  # Capture started in the middle of the connection
+            self.next_seq = seg.seq
+
+        self._add_pending(seg.seq, seg.payload)
+        res = self._deliver()
+        if self.pending_bytes > MAX_REORDER_BYTES:
+            sys.stderr.write('Warning: missing TCP data, skipping a gap\n')
+            self.next_seq = min(self.pending, key=lambda seq: _seq_diff(seq, self.next_seq))
+            res.extend(self._deliver())
+        return res
+
+    def _add_pending(self, seq, payload):
+        existing = self.pending.get(seq, b'')
+        if len(payload) > len(existing):
+            self.pending[seq] = payload
+            self.pending_bytes += len(payload) - len(existing)
+
+    def _deliver(self):
+        res = []
+        while self.pending:
+            # Drop segments (or parts of them) which have been delivered already (retransmissions)
+            for seq in list(self.pending):
+                diff = _seq_diff(self.next_seq, seq)
+                if diff > 0:
+                    payload = self.pending.pop(seq)
+                    self.pending_bytes -= len(payload)
+                    if diff < len(payload):
+                        self._add_pending(self.next_seq, payload[diff:])
+            payload = self.pending.pop(self.next_seq, None)
+            if payload is None:
+                break
+            self.pending_bytes -= len(payload)
+            self.next_seq = (self.next_seq + len(payload)) % 2 ** 32
+            res.append(payload)
+        return res
+
+    def flush(self):
+        """ Returns the remaining payloads after missing segments """
+        res = []
+        while self.pending:
+            sys.stderr.write('Warning: missing TCP data at the end of a connection\n')
+            self.next_seq = min(self.pending, key=lambda seq: _seq_diff(seq, self.next_seq))
+            res.extend(self._deliver())
+        return res
+
+
+def pcap_streams(f, port=9100):
+    """ Reads a pcap/pcapng file object and reassembles the TCP connections to port.
+    Yields tuples (connection, data) in capture order, where connection is a tuple
+    (src, sport, dst, dport, number) and data is the next part of that connection's stream. """
+    flows = {}
+    numbers = collections.Counter()
+    for linktype, frame in read_pcap_packets(f):
+        ip = _ip_packet(linktype, frame)
+        seg = _tcp_segment(ip) if ip is not None else None
+        if seg is None or seg.dport != port:
+            continue
 
-    return b''.join(
-        bytes(p[TCP].payload)
-        for p in pcap_file
-        if TCP in p and p[TCP].dport == 9100
-    )
+        addr = (seg.src, seg.sport, seg.dst, seg.dport)
+        key = (addr, numbers[addr])
+        flow = flows.get(key)
+        if (flow is not None and seg.flags & TCP_SYN and flow.next_seq is not None and
+                flow.next_seq != (seg.seq + 1) % 2 ** 32):
+            # New connection with the same addresses and ports
+            for payload in flow.flush():
+                yield addr + (numbers[addr],), payload
+            del flows[key]
+            numbers[addr] += 1
+            key = (addr, numbers[addr])
+            flow = None
+        if flow is None:
+            flow = flows[key] = _TcpFlow()
+
+        for payload in flow.add(seg):
+            yield addr + (numbers[addr],), payload
+
+    for (addr, number), flow in flows.items():
+        for payload in flow.flush():
+            yield addr + (number,), payload
+
+
+def parse_pcap(b, port=9100):
+    """ Returns the data sent to port in a pcap/pcapng file (as bytes), one TCP connection after another """
+    streams = collections.OrderedDict()
+    for connection, data in pcap_streams(io.BytesIO(b), port):
+        streams.setdefault(connection, []).append(data)
+    return b''.join(b''.join(chunks) for chunks in streams.values())
+
+
+class _BinWriter(object):
+    """ Writes the data of every job to a file: FILE.bin for a single job, FILE-1.bin, FILE-2.bin, ... otherwise """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = collections.OrderedDict()
+
+    def write(self, job, data):
+        f = self.files.get(job)
+        if f is None:
+            if len(self.files) == 1:
+                # Second job: rename the file of the first one
+                first_job, first_f = next(iter(self.files.items()))
+                first_f.close()
+                os.rename(self.filename, page_filename(self.filename, 1))
+                self.files[first_job] = open(page_filename(self.filename, 1), 'ab')
+            filename = self.filename if not self.files else page_filename(self.filename, len(self.files) + 1)
+            f = self.files[job] = open(filename, 'wb')
+        f.write(data)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
 
 
 def main():
     parser = argparse.ArgumentParser('Plot the image which is going to be printed')
     parser.add_argument(
         '-f', '--format', metavar='FORMAT',
-        choices=['auto', 'pcap', 'bin'], default='auto',
-        help='File format: binary data to the printer or pcap file. Auto-detects by default.')
+        choices=['auto', 'pcap', 'pcapng', 'bin'], default='auto',
+        help='File format: binary data to the printer or pcap/pcapng file. Auto-detects by default.')
     parser.add_argument(
         '-w', '--write-bin', metavar='FILE.bin',
         help='Write read binary file to disk.')
+    parser.add_argument(
+        '--port', metavar='PORT', type=int, default=9100,
+        help='TCP port of the printer in pcap files (default: %(default)s)')
+    parser.add_argument(
+        '-o', '--output-format', metavar='FORMAT',
+        choices=OUTPUT_FORMATS, default='auto',
+        help='Output format: ASCII (p1) or binary (p4) netpbm, or PNG. '
+             'By default PNG for .png files and p4 otherwise.')
+    parser.add_argument(
+        '--split-pages', action='store_true',
+        help='Write one image per page, to OUTPUT-1.pbm, OUTPUT-2.pbm and so on')
     parser.add_argument(
         'input', metavar='INPUT_FILE',
         help='The .bin file of instructions to the Brother printer')
     parser.add_argument(
         'output', metavar='OUTPUT_FILE',
-        help='An netbpm output file')
+        help='An netbpm or PNG output file. '
+             'If a pcap file contains multiple jobs, they are written to OUTPUT-1.pbm, OUTPUT-2.pbm and so on.')
     args = parser.parse_args()
 
-    with open(args.input, 'rb') as input_f:
-        bc = input_f.read()
-
-    file_format = args.format
-    if file_format == 'auto':
-        file_format = detect_format(bc)
-
-    if file_format == 'pcap':
-        bc = parse_pcap(bc)
-
-    if args.write_bin:
-        with open(args.write_bin, 'wb') as bin_f:
-            bin_f.write(bc)
-
-    rows = read_rows(bc)
-
-    height = len(rows)
-    width = len(rows[0])
-    print('width: %s, height: %s' % (width, height))
-
-    img_bytes = plotimg(rows)
+    # Decode all jobs while reading the input, so that large captures do not have to fit into memory
+    collectors = collections.OrderedDict()
+    bin_writer = _BinWriter(args.write_bin) if args.write_bin else None
+    try:
+        with open(args.input, 'rb') as input_f:
+            file_format = args.format
+            if file_format == 'auto':
+                file_format = detect_format(input_f.read(4))
+                input_f.seek(0)
+
+            if file_format in ('pcap', 'pcapng'):
+                streams = pcap_streams(input_f, args.port)
+            else:
+                streams = ((None, chunk) for chunk in iter(lambda: input_f.read(CHUNK_SIZE), b''))
+
+            for connection, data in streams:
+                collector = collectors.get(connection)
+                if collector is None:
+                    collector = collectors[connection] = RowCollector()
+                collector.feed(data)
+                if bin_writer:
+                    bin_writer.write(connection, data)
+    finally:
+        if bin_writer:
+            bin_writer.close()
+
+    if not collectors:
+        parser.error('No print data found in %s' % args.input)
+
+    for job_num, collector in enumerate(collectors.values(), start=1):
+        collector.parser.close()
+        output = page_filename(args.output, job_num) if len(collectors) > 1 else args.output
+
+        if args.split_pages:
+            for page_num, raster in enumerate(collector.pages(), start=1):
+                filename = page_filename(output, page_num)
+                print('%s: width: %s, height: %s' % (filename, raster.width, raster.height))
+                write_image(raster, filename, args.output_format)
+            continue
 
-    with open(args.output, 'wb') as output_f:
-        output_f.write(img_bytes)
+        raster = collector.raster()
+        print('%s: width: %s, height: %s' % (output, raster.width, raster.height))
+        write_image(raster, output, args.output_format)
 
 
 if __name__ == '__main__':
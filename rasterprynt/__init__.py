@@ -5,9 +5,16 @@ from __future__ import unicode_literals
 import argparse
 import collections
 import contextlib
+import json
 import logging
+import mmap
+import os
+import re
 import socket
 import struct
+import sys
+import tempfile
+import threading
 import time
 
 try:
@@ -18,6 +25,13 @@ try:
     from urllib.error import URLError
 except ImportError:  # Python 2
     from urllib2 import URLError
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from .cache import RenderCache  # NOQA
+from .instrument import Profile, clock as _clock, notify as _notify  # NOQA
 
 
 __version__ = '1.0.5'
@@ -37,32 +51,122 @@ TAPE_SIZE_DEFAULT = '18mm'
 TOP_MARGIN_DEFAULT = 8
 BOTTOM_MARGIN_DEFAULT = 8
 
+# raw: no compression, tiff: TIFF (PackBits) compression, auto: whichever is smaller for each image.
+# We support TIFF, but it seems to introduce artifacts on some printers, so it is not enabled by default.
+COMPRESSION_MODES = ('auto', 'raw', 'tiff')
+COMPRESSION_DEFAULT = 'raw'
+
+PORT = 9100
+# When streaming, small chunks from render are collected into buffers of this size before sending them
+SEND_BUFFER_SIZE_DEFAULT = 64 * 1024
+# Number of buffers that can be rendered ahead of the socket when streaming
+SEND_QUEUE_SIZE = 16
+
 # Cache of IP address -> model name
 CACHE_TIMEOUT = 3600  # 1 hour
+# Failed detections ('error') are cached for a shorter time, so that an offline printer does not cost
+# a full timeout on every job, but is picked up again soon once it is back.
+ERROR_CACHE_TIMEOUT = 60
+# Timeout of a single HTTP request to detect the printer model
+DETECT_TIMEOUT_DEFAULT = 10
 PrinterCacheEntry = collections.namedtuple('PrinterCacheEntry', ['ip', 'timestamp', 'model'])
-_PRINTER_BY_IP = {}
 
 
-def detect_printer_model(ip):
-    cached = _PRINTER_BY_IP.get(ip)
-    if cached and cached.timestamp + CACHE_TIMEOUT < time.time():
+class PrinterModelCache(object):
+    # Thread-safe cache of detected printer models.
+    # If path is given, entries are loaded from and saved to that JSON file.
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def get(self, ip, now=None):
+        # Returns the cached model (possibly 'error') or None if there is no valid entry
+        if now is None:
+            now = time.time()
+        with self._lock:
+            cached = self._entries.get(ip)
+        if cached is None:
+            return None
+        timeout = ERROR_CACHE_TIMEOUT if cached.model == 'error' else CACHE_TIMEOUT
+        if cached.timestamp + timeout < now:
+            return None
         return cached.model
 
+    def set(self, ip, model, now=None):
+        entry = PrinterCacheEntry(ip, time.time() if now is None else now, model)
+        with self._lock:
+            self._entries[ip] = entry
+            if self.path is not None:
+                self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.path is not None:
+                self._save()
+
+    def load(self):
+        with open(self.path) as cache_f:
+            data = json.load(cache_f)
+        with self._lock:
+            for ip, (timestamp, model) in data.items():
+                self._entries[ip] = PrinterCacheEntry(ip, timestamp, model)
+
+    def _save(self):
+        # Must be called with the lock held
+        data = dict((e.ip, [e.timestamp, e.model]) for e in self._entries.values())
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp_f:
+            json.dump(data, tmp_f)
+        os.rename(tmp_path, self.path)
+
+
+printer_cache = PrinterModelCache()
+
+
+def _cached_printer_model(ip):
+    return printer_cache.get(ip)
+
+
+def detect_printer_model(ip, timeout=DETECT_TIMEOUT_DEFAULT):
+    cached_model = _cached_printer_model(ip)
+    if cached_model:
+        return cached_model
+
     try:
-        res_model = _detect_printer_model_uncached(ip)
-    except URLError as urle:
+        res_model = _detect_printer_model_uncached(ip, timeout=timeout)
+    except (URLError, socket.error) as urle:
         logging.warning('Failed to detect printer at %s: %s' % (ip, urle))
+        printer_cache.set(ip, 'error')
         return 'error'
     if res_model:
-        _PRINTER_BY_IP[ip] = PrinterCacheEntry(ip, time.time(), res_model)
+        printer_cache.set(ip, res_model)
     return res_model
 
 
-def _detect_printer_model_uncached(ip):
+def detect_many(ips, timeout=DETECT_TIMEOUT_DEFAULT, max_workers=32):
+    # Detects the models of many printers at once. Returns a dictionary IP -> model.
+    # Printers which do not respond within timeout are reported as 'error'. The timeout applies to every printer,
+    # not to all of them: with more ips than max_workers, some printers are only asked once others have answered.
+    import concurrent.futures
+
+    ips = set(ips)
+    if not ips:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(ips))) as executor:
+        futures = dict((executor.submit(detect_printer_model, ip, timeout), ip) for ip in ips)
+        return dict((futures[future], future.result()) for future in concurrent.futures.as_completed(futures))
+
+
+def _detect_printer_model_uncached(ip, timeout=DETECT_TIMEOUT_DEFAULT):
     # We use /admin/default.html because this seems to be the only common URL for both supported printers so far
     test_url = 'http://%s/admin/default.html' % ip
     try:
-        with contextlib.closing(urlopen(test_url)) as url_handle:
+        with contextlib.closing(urlopen(test_url, timeout=timeout)) as url_handle:
             html = url_handle.read()
     except URLError as urle:
         if hasattr(urle, 'code') and urle.code == 401:
@@ -70,6 +174,10 @@ def _detect_printer_model_uncached(ip):
         else:
             raise
 
+    return _model_from_html(html)
+
+
+def _model_from_html(html):
     if b'<TITLE>Brother PT-9800PCN</TITLE>' in html:
         return '9800PCN'
     if b'<title>Brother PT-P950NW</title>' in html:
@@ -107,6 +215,55 @@ def _compress_tiff(row):
         yield struct.pack('!b', pos - uncompressed_start - 1) + row[uncompressed_start:pos]
 
 
+# Runs of at least 2 identical bytes
+_TIFF_RUN_RE = re.compile(b'(.)\\1+', re.DOTALL)
+# Both literal blocks and runs are limited to 128 bytes
+_TIFF_MAX_BLOCK = 128
+
+
+def _tiff_literal(out, row, start, end):
+    for block_start in range(start, end, _TIFF_MAX_BLOCK):
+        block_end = min(block_start + _TIFF_MAX_BLOCK, end)
+        out.append(block_end - block_start - 1)
+        out += row[block_start:block_end]
+
+
+# Same output as _compress_tiff, but returns one bytes object and finds runs with a regular expression.
+# Unlike _compress_tiff, this also handles runs and literals longer than 128 bytes.
+def _compress_tiff_row(row):
+    out = bytearray()
+    pos = 0
+    for m in _TIFF_RUN_RE.finditer(row):
+        start, end = m.span()
+        _tiff_literal(out, row, pos, start)
+        value = row[start:start + 1]
+        while start < end:
+            count = min(end - start, _TIFF_MAX_BLOCK)
+            out.append((1 - count) & 0xff)  # A single byte is a literal, which has the same encoding
+            out += value
+            start += count
+        pos = end
+    _tiff_literal(out, row, pos, len(row))
+    return bytes(out)
+
+
+def _encode_rows(bitmap, stripe_count, compression):
+    # Split the bitmap of an image into rows and compress them.
+    # Returns a tuple (use_tiff, rows). Blank rows are None, to be sent as Z.
+    blank = b'\x00' * stripe_count
+    rows = [bitmap[pos:pos + stripe_count] for pos in range(0, len(bitmap), stripe_count)]
+    rows = [None if row == blank else row for row in rows]
+    if compression == 'raw':
+        return False, rows
+
+    compressed = [None if row is None else _compress_tiff_row(row) for row in rows]
+    if compression == 'auto' and (
+            sum(len(row) for row in compressed if row is not None) >=
+            sum(len(row) for row in rows if row is not None)):
+        return False, rows
+    return True, compressed
+
+
 # Scan a line from the image and yield the bytes that make them
 def _raw_row(img, img_bytes, stripe_count, x, y_offset):
     for stripe_idx in range(stripe_count):
@@ -123,7 +280,7 @@ def _raw_row(img, img_bytes, stripe_count, x, y_offset):
         yield struct.pack('!B', bits)
 
 
-def _get_bytes(img):
+def _flatten_image(img):
     if img.mode == 'P':
         img = img.convert('RGBA')
 
@@ -134,12 +291,316 @@ def _get_bytes(img):
         new_img.paste(img, mask=img.split()[3])
         img = new_img
 
-    return img.load()
+    return img
+
+
+def _get_bytes(img):
+    return _flatten_image(img).load()
+
+
+# Threshold lookup tables mapping a single-band value to 255 (ink) or 0 (blank).
+# In _raw_row, a pixel is black if px <= 230, where px is the grayscale value or the mean of R, G and B.
+_INK_LUT_GRAY = [255 if v <= 230 else 0 for v in range(256)]
+# RGB images are first converted with the matrix (1, 1, 1, -690), i.e. to R+G+B-690 clipped to 0..255.
+# All of these values are integers, so this is exact; (R+G+B) / 3 <= 230 iff the result is 0.
+_RGB_SUM_MATRIX = (1.0, 1.0, 1.0, -690.0)
+_INK_LUT_RGB = [255] + [0] * 255
+
+
+def _ink_mask(img):
+    # Returns a mode 1 image which is set wherever _raw_row would print a dot, or None if the mode is not supported
+    img = _flatten_image(img)
+    if img.mode == 'L':
+        return img.point(_INK_LUT_GRAY, '1')
+    if img.mode == 'RGB':
+        return img.convert('L', _RGB_SUM_MATRIX).point(_INK_LUT_RGB, '1')
+    return None
+
+
+def _trim_image(img):
+    # Removes blank columns at the start and the end of img, i.e. white space before and after the label content.
+    # Images in modes that _ink_mask does not support are returned unchanged.
+    if hasattr(img, 'trimmed'):  # template.TemplateLabel
+        return img.trimmed()
+    mask = _ink_mask(img)
+    if mask is None:
+        return img
+    bbox = mask.getbbox()
+    left, right = (bbox[0], bbox[2]) if bbox else (0, 0)
+    if (left, right) == (0, img.width):
+        return img
+    return img.crop((left, 0, right, img.height))
+
+
+def _raster_bitmap_reference(img, stripe_size):
+    # Slow reference implementation of _raster_bitmap, based on _raw_row
+    img_bytes = _get_bytes(img)
+    stripe_count = stripe_size // 8
+    offset = stripe_size - img.height
+    return b''.join(
+        b''.join(_raw_row(img, img_bytes, stripe_count, x, offset))
+        for x in range(img.width))
+
+
+def _raster_bitmap(img, stripe_size, stats=None):
+    # Returns the raster data of all columns of img as one bytes object.
+    # Every column takes stripe_size // 8 bytes, with the first pixel in the most significant bit.
+    # The image is aligned to the end of the stripe, just like in _raw_row.
+    # If stats is a dict, the time spent is stored there under the keys convert and rasterize.
+    # Instead of an image, img can be a template.TemplateLabel, which rasterizes itself.
+    if hasattr(img, 'raster_bitmap'):
+        return img.raster_bitmap(stripe_size, stats)
+
+    start = _clock()
+    mask = _ink_mask(img)
+    converted = _clock()
+    if mask is None:
+        bitmap = _raster_bitmap_reference(img, stripe_size)
+    else:
+        from PIL import Image
+        # Columns become rows, so that tobytes() packs them in the order the printer expects
+        columns = mask.transpose(Image.TRANSPOSE)
+        canvas = Image.new('1', (stripe_size, img.width), 0)
+        canvas.paste(columns, (stripe_size - img.height, 0))
+        bitmap = canvas.tobytes()
+
+    if stats is not None:
+        stats['convert'] = converted - start
+        stats['rasterize'] = _clock() - converted
+    return bitmap
+
+
+def _image_tiles(img, tile_width):
+    # Yields img in vertical slices of at most tile_width columns (or img itself if tile_width is None).
+    # Template labels are not sliced, since the raster data of their base image is kept as a whole anyway.
+    if not tile_width or img.width <= tile_width or hasattr(img, 'raster_bitmap'):
+        yield img
+        return
+    for x in range(0, img.width, tile_width):
+        yield img.crop((x, 0, min(x + tile_width, img.width), img.height))
+
+
+_G_HEADER = struct.Struct('<BH')
+
+
+class _EncodedPage(object):
+    # The commands for an image, from the compression mode to its last row (but not the bottom margin).
+    # rows are the compressed rows, None for blank rows. Iterating yields the commands as bytes.
+    __slots__ = ('use_tiff', 'top_lines', 'rows')
+
+    def __init__(self, use_tiff, top_lines, rows):
+        self.use_tiff = use_tiff
+        self.top_lines = top_lines
+        self.rows = rows
+
+    def __iter__(self):
+        if self.use_tiff:
+            yield b'M\x02'  # Select compression mode: TIFF
+        else:
+            yield b'M\x00'  # Select compression mode: Simple
+
+        # Draw margin.
+        # For compatibility with different printers, we send empty lines instead of specifying a margin.
+        yield b'Z' * self.top_lines
+
+        for row in self.rows:
+            if row is None:
+                yield b'Z'  # Blank row
+            else:
+                yield b'G' + struct.pack('<H', len(row))
+                yield row
+
+    def size(self):
+        return 2 + self.top_lines + sum(1 if row is None else 3 + len(row) for row in self.rows)
+
+    def write_into(self, view, pos):
+        # Writes the commands to the memoryview view at pos. Returns the position after them.
+        view[pos:pos + 2] = b'M\x02' if self.use_tiff else b'M\x00'
+        pos += 2
+        view[pos:pos + self.top_lines] = b'Z' * self.top_lines
+        pos += self.top_lines
+        pack_header = _G_HEADER.pack_into
+        for row in self.rows:
+            if row is None:
+                view[pos] = 0x5a  # Z
+                pos += 1
+            else:
+                row_len = len(row)
+                pack_header(view, pos, 0x47, row_len)  # G
+                view[pos + 3:pos + 3 + row_len] = row
+                pos += 3 + row_len
+        return pos
+
+
+def _render_page(img, stripe_size, compression, top_lines, stats=None, tile_width=None):
+    # Returns the commands for an image, from the compression mode to its last row (but not the bottom margin),
+    # as an iterable of bytes: an _EncodedPage, or a generator for images which are rendered in slices
+    # (see _render_page_tiles).
+    # If stats is a dict, it is filled with the information for the image event (see instrument.notify).
+    if tile_width and img.width > tile_width and not hasattr(img, 'raster_bitmap'):
+        return _render_page_tiles(img, stripe_size, compression, top_lines, stats, tile_width)
+
+    stripe_count = stripe_size // 8
+    bitmap = _raster_bitmap(img, stripe_size, stats)
+    assert len(bitmap) == img.width * stripe_count
+    start = _clock()
+    use_tiff, rows = _encode_rows(bitmap, stripe_count, compression)
+    if stats is not None:
+        stats['compress'] = _clock() - start
+        stats['raw_bytes'] = len(bitmap)
+        stats['bytes'] = sum(len(row) for row in rows if row is not None)
+        stats['compression'] = 'tiff' if use_tiff else 'raw'
+    return _EncodedPage(use_tiff, top_lines, rows)
+
+
+def _render_page_tiles(img, stripe_size, compression, top_lines, stats, tile_width):
+    # Yields the commands for an image like _render_page.
+    # The image is converted and rasterized in slices of tile_width columns, and the rows of every slice
+    # are yielded before the next one is processed. This keeps the memory needed for very long images bounded.
+    # Compression auto is decided on the first slice.
+    stripe_count = stripe_size // 8
+    totals = {'convert': 0, 'rasterize': 0, 'compress': 0, 'raw_bytes': 0, 'bytes': 0}
+    first = True
+    for tile in _image_tiles(img, tile_width):
+        tile_stats = {}
+        bitmap = _raster_bitmap(tile, stripe_size, tile_stats)
+        assert len(bitmap) == tile.width * stripe_count
+        start = _clock()
+        if first:
+            use_tiff, rows = _encode_rows(bitmap, stripe_count, compression)
+        else:
+            _, rows = _encode_rows(bitmap, stripe_count, 'tiff' if use_tiff else 'raw')
+        totals['convert'] += tile_stats['convert']
+        totals['rasterize'] += tile_stats['rasterize']
+        totals['compress'] += _clock() - start
+        totals['raw_bytes'] += len(bitmap)
+        totals['bytes'] += sum(len(row) for row in rows if row is not None)
+        del bitmap
+
+        if first:
+            first = False
+            if use_tiff:
+                yield b'M\x02'  # Select compression mode: TIFF
+            else:
+                yield b'M\x00'  # Select compression mode: Simple
+
+            # Draw margin.
+            # For compatibility with different printers, we send empty lines instead of specifying a margin.
+            yield b'Z' * top_lines
+
+        for row in rows:
+            if row is None:
+                yield b'Z'  # Blank row
+            else:
+                yield b'G' + struct.pack('<H', len(row))
+                yield row
+
+    if stats is not None:
+        stats.update(totals)
+        stats['compression'] = 'tiff' if use_tiff else 'raw'
+
+
+def _image_buffer(img):
+    # Everything needed to recreate img in another process, without pickling the PIL image
+    palette = (img.palette.mode, img.palette.tobytes()) if img.mode == 'P' else None
+    return (img.mode, img.size, img.tobytes(), palette, img.info.get('transparency'))
+
+
+def _image_from_buffer(buf):
+    from PIL import Image
+
+    mode, size, data, palette, transparency = buf
+    img = Image.frombytes(mode, size, data)
+    if palette is not None:
+        palette_mode, palette_data = palette
+        img.putpalette(palette_data, palette_mode)
+    if transparency is not None:
+        img.info['transparency'] = transparency
+    return img
+
+
+_load_lock = threading.Lock()
+
+
+def _load_images(images):
+    # Yields images, decoding the PIL images among them first. PIL decodes images lazily, which is not thread-safe,
+    # so this must happen before the same images are rendered in several threads.
+    from PIL import Image
+
+    for img in images:
+        if isinstance(img, Image.Image):
+            with _load_lock:
+                img.load()
+        yield img
+
+
+def _render_page_buffer(buf, stripe_size, compression, top_lines, tile_width=None):
+    # Runs in a worker process
+    stats = {}
+    page = b''.join(_render_page(_image_from_buffer(buf), stripe_size, compression, top_lines, stats, tile_width))
+    return page, stats
+
+
+def _render_pages(images, stripe_size, compression, top_lines, cache=None, cache_settings=None, workers=1,
+                  tile_width=None, trim=False):
+    # Yields tuples (img, chunks, stats) with the commands of every page (see _render_page), in order.
+    # stats is only complete once chunks has been consumed.
+    # With workers > 1, up to 2 * workers pages are rendered ahead in a process pool.
+    executor = None
+    if workers > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+    lookahead = 2 * workers if executor else 0
+
+    pending = collections.deque()
+    try:
+        for img in images:
+            if trim:
+                img = _trim_image(img)
+            key = page = None
+            stats = {}
+            if cache is not None:
+                key = cache.key(img, *cache_settings)
+                page = cache.get(key)
+            if page is not None:
+                key = None  # Already cached
+                stats['cached'] = True
+                stats['bytes'] = len(page)
+            elif executor is not None and not hasattr(img, 'raster_bitmap'):
+                # Template labels only rasterize their variable parts, which is not worth sending to a process
+                page = executor.submit(
+                    _render_page_buffer, _image_buffer(img), stripe_size, compression, top_lines, tile_width)
+            else:
+                page = _render_page(img, stripe_size, compression, top_lines, stats, tile_width)
+            pending.append((img, key, page, stats))
+
+            while len(pending) > lookahead:
+                yield _finish_page(pending.popleft(), cache)
+        while pending:
+            yield _finish_page(pending.popleft(), cache)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _finish_page(entry, cache):
+    img, key, page, stats = entry
+    if hasattr(page, 'result'):  # Future from the process pool
+        page, worker_stats = page.result()
+        stats.update(worker_stats)
+    if key is not None:
+        if not isinstance(page, bytes):
+            page = b''.join(page)
+        cache.put(key, page)
+    if isinstance(page, bytes):
+        page = [page]
+    return img, page, stats
 
 
 def render(images, ip=None,
            top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT,
-           printer_model=None, tape_size=TAPE_SIZE_DEFAULT):
+           printer_model=None, tape_size=TAPE_SIZE_DEFAULT,
+           compression=COMPRESSION_DEFAULT, cache=None, workers=1, observer=None, tile_width=None, trim=False):
     # Yields bytes that can be printed on a Brother P950NW(new printer) or Brother 9800PCN(old printer).
     # The protocol here is reverse-engineered from what the Windows driver for brother printers sends.
     # Many commands are documented at
@@ -147,131 +608,373 @@ def render(images, ip=None,
     # The ESC/P command reference at
     #  http://support.brother.com/g/b/manuallist.aspx?c=us&lang=en&prod=p950nweus&flang=English&type3=384&type2=81
     # can also help.
+    # If cache (a RenderCache) is given, the rendered pages are looked up there before rasterizing them.
+    # With workers > 1, images are rasterized in that many processes in parallel.
+    # With tile_width, long images are rasterized and yielded in slices of that many columns (see _render_page);
+    # without cache and workers, memory use then does not grow with the length of the images.
+    # Template labels (see template) are always rasterized as a whole.
+    # With trim, blank columns at the start and end of every image are left out. Blank columns are always sent
+    # as Z, which is a single byte.
+    # observer gets called with timing and size information, see instrument.notify.
     # Our old code and brother sends 200 0-bytes here (maybe to synchronize the serial bus? No need for that via TCP)
 
-    # We support TIFF, but it seems to introduce artifacts on some printers, so disable it.
-    USE_TIFF = False
-
-    yield b'\x00' * 200
-
-    if printer_model is None:
-        printer_model = detect_printer_model(ip) if ip else None
-    assert printer_model in ('P950NW', '9800PCN')
-
-    # These are the only supported sizes so far
-    assert tape_size in ('18mm', '36mm')
+    yield _ZEROS
 
-    # number of dots in a stripe (depends on printer + tape size)
-    stripe_size = STRIPE_SIZE.get((printer_model, tape_size), STRIPE_SIZE_DEFAULT)
-    assert stripe_size % 8 == 0
-    stripe_count = stripe_size // 8
+    printer_model, stripe_size, cut_correction = _job_settings(
+        ip, printer_model, tape_size, compression, top_margin, observer)
+    yield _JOB_START
 
-    yield b'\x1b@'  # Init
-    yield b'\x1bia\x01'  # Raster mode
-    yield b'\x1biM\x00'  # Various Mode settings: no auto cut
-    yield b'\x1bid\x00\x00'  # Margin = 0
+    pages = _render_pages(
+        images, stripe_size, compression, top_margin - cut_correction,
+        cache=cache, cache_settings=(printer_model, tape_size, top_margin, bottom_margin, compression, tile_width),
+        workers=workers, tile_width=tile_width, trim=trim)
 
     first = True
-    for img in images:
+    for index, (img, page, stats) in enumerate(pages):
         if first:
             first = False
         else:
             yield b'\x0c'
 
-        img_bytes = _get_bytes(img)
-
-        cut_correction = 0  # Correction factor for cuts: Cuts come this much after we send the signal to cut
-        if printer_model == 'P950NW':
-            # The "raster number" seems to be the width, or length of the stripe
-            raster_number = img.width + top_margin + bottom_margin
-
-            yield (
-                b'\x1biz'  # Print information command
-                b'\xc0' +  # PI_RECOVER | PI_QUALITY
-                b'\x00' +  # Media type: not set
-                b'\x00' +  # Media width, e.g. 18 = 18mm. We're setting it to 0 (unspecified)
-                b'\x00' +  # Media length: not set
-                struct.pack('<I', raster_number) +  # "Raster number"
-                (b'\x00' if first else b'\x01') +  # Starting page?
-                b'\x00')   # This byte is always 0 (reserved)
-        elif printer_model == '9800PCN':
-            # ?? Some kind of initialization.
-            # In our old code, \x01 was labelled "type"
-            # \x12 is the media width in mm (i.e. 18mm)
-            yield b'\x1bic\x8e\x01\x12\x00\x00'
+        yield _page_header(printer_model, img.width, top_margin, bottom_margin, first)
 
-            # Specify feed amount (correction for overly early cutting)
-            yield b'\x1bid' + struct.pack('!B', 0) + b'\x00'
-            cut_correction = 8
-        else:
-            assert False, 'Unsupported printer %s' % printer_model
-
-        if top_margin < cut_correction:
-            raise ValueError(
-                'top margin %d is smaller than cut correction %d of %s' %
-                (top_margin, cut_correction, printer_model))
+        for chunk in page:
+            yield chunk
 
-        if USE_TIFF:
-            yield b'M\x02'  # Select compression mode: TIFF
-        else:
-            yield b'M\x00'  # Select compression mode: Simple
+        stats.update(index=index, width=img.width, height=img.height, pixels=img.width * img.height)
+        _notify(observer, 'image', stats)
 
-        # Draw margin.
+        # Draw bottom margin.
         # For compatibility with different printers, we send empty lines instead of specifying a margin.
-        yield b'Z' * (top_margin - cut_correction)
+        yield b'Z' * (bottom_margin + cut_correction)
 
-        for x in range(img.width):
-            offset = (stripe_size - img.height)
+    yield b'\x1a'  # Print
 
-            row = b''.join(_raw_row(img, img_bytes, stripe_count, x, offset))
-            assert len(row) == stripe_count
-            if USE_TIFF:
-                row = b''.join(_compress_tiff(row))
 
-            yield b'G' + struct.pack('<H', len(row))
-            yield row
+_ZEROS = b'\x00' * 200
+_JOB_START = (
+    b'\x1b@'  # Init
+    b'\x1bia\x01'  # Raster mode
+    b'\x1biM\x00'  # Various Mode settings: no auto cut
+    b'\x1bid\x00\x00')  # Margin = 0
 
-        # Draw bottom margin.
-        # For compatibility with different printers, we send empty lines instead of specifying a margin.
-        yield b'Z' * (bottom_margin + cut_correction)
 
-    yield b'\x1a'  # Print
+def _job_settings(ip, printer_model, tape_size, compression, top_margin, observer):
+    # Detects the printer model if necessary and checks the settings.
+    # Returns a tuple (printer_model, stripe_size, cut_correction).
+    if printer_model is None and ip:
+        start = _clock()
+        printer_model = detect_printer_model(ip)
+        _notify(observer, 'detect', {'ip': ip, 'model': printer_model, 'seconds': _clock() - start})
+    assert printer_model in ('P950NW', '9800PCN')
+
+    # These are the only supported sizes so far
+    assert tape_size in ('18mm', '36mm')
+    assert compression in COMPRESSION_MODES
+
+    # number of dots in a stripe (depends on printer + tape size)
+    stripe_size = STRIPE_SIZE.get((printer_model, tape_size), STRIPE_SIZE_DEFAULT)
+    assert stripe_size % 8 == 0
+
+    # Correction factor for cuts: Cuts come this much after we send the signal to cut
+    cut_correction = 8 if printer_model == '9800PCN' else 0
+    if top_margin < cut_correction:
+        raise ValueError(
+            'top margin %d is smaller than cut correction %d of %s' %
+            (top_margin, cut_correction, printer_model))
+    return printer_model, stripe_size, cut_correction
+
+
+def _page_header(printer_model, width, top_margin, bottom_margin, first):
+    if printer_model == 'P950NW':
+        # The "raster number" seems to be the width, or length of the stripe
+        raster_number = width + top_margin + bottom_margin
+
+        return (
+            b'\x1biz'  # Print information command
+            b'\xc0' +  # PI_RECOVER | PI_QUALITY
+            b'\x00' +  # Media type: not set
+            b'\x00' +  # Media width, e.g. 18 = 18mm. We're setting it to 0 (unspecified)
+            b'\x00' +  # Media length: not set
+            struct.pack('<I', raster_number) +  # "Raster number"
+            (b'\x00' if first else b'\x01') +  # Starting page?
+            b'\x00')   # This byte is always 0 (reserved)
+    elif printer_model == '9800PCN':
+        return (
+            # ?? Some kind of initialization.
+            # In our old code, \x01 was labelled "type"
+            # \x12 is the media width in mm (i.e. 18mm)
+            b'\x1bic\x8e\x01\x12\x00\x00' +
+            # Specify feed amount (correction for overly early cutting)
+            b'\x1bid' + struct.pack('!B', 0) + b'\x00')
+    else:
+        assert False, 'Unsupported printer %s' % printer_model
+
+
+class Job(object):
+    # The same commands as render yields, but kept as compressed rows until they are written with render_into.
+    # Since job_size is known in advance, the whole job can be written into a single preallocated buffer
+    # (bytearray, mmap, ...) instead of being assembled from many small bytes objects.
+    # The arguments are the same as for render. All images are rasterized in the constructor.
+
+    def __init__(self, images, ip=None,
+                 top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT,
+                 printer_model=None, tape_size=TAPE_SIZE_DEFAULT,
+                 compression=COMPRESSION_DEFAULT, cache=None, workers=1, observer=None, tile_width=None, trim=False):
+        printer_model, stripe_size, cut_correction = _job_settings(
+            ip, printer_model, tape_size, compression, top_margin, observer)
+        self.printer_model = printer_model
+        self._bottom = b'Z' * (bottom_margin + cut_correction)
+
+        pages = _render_pages(
+            images, stripe_size, compression, top_margin - cut_correction,
+            cache=cache, cache_settings=(printer_model, tape_size, top_margin, bottom_margin, compression, tile_width),
+            workers=workers, tile_width=tile_width, trim=trim)
+        self._pages = []  # Tuples (header, page); page is an _EncodedPage or bytes
+        first = True
+        for index, (img, page, stats) in enumerate(pages):
+            if first:
+                first = False
+            if not isinstance(page, _EncodedPage):
+                page = b''.join(page)
+            self._pages.append((_page_header(printer_model, img.width, top_margin, bottom_margin, first), page))
+            stats.update(index=index, width=img.width, height=img.height, pixels=img.width * img.height)
+            _notify(observer, 'image', stats)
+
+        self._size = (
+            len(_ZEROS) + len(_JOB_START) +
+            sum(len(header) + (page.size() if isinstance(page, _EncodedPage) else len(page))
+                for header, page in self._pages) +
+            len(self._pages) * len(self._bottom) +
+            max(len(self._pages) - 1, 0) +  # Form feeds
+            1)  # Print
+
+    def job_size(self):
+        # Number of bytes render_into writes
+        return self._size
+
+    def render_into(self, buffer, offset=0):
+        # Writes the job into buffer (any writable bytes-like object) at offset.
+        # Returns the offset after the job.
+        view = memoryview(buffer)
+        try:
+            if offset < 0 or offset + self._size > len(view):
+                raise ValueError(
+                    'Job of %d bytes does not fit into buffer of %d bytes at offset %d' %
+                    (self._size, len(view), offset))
+            pos = offset
+            view[pos:pos + len(_ZEROS)] = _ZEROS
+            pos += len(_ZEROS)
+            view[pos:pos + len(_JOB_START)] = _JOB_START
+            pos += len(_JOB_START)
+            bottom = self._bottom
+            for index, (header, page) in enumerate(self._pages):
+                if index > 0:
+                    view[pos] = 0x0c  # Form feed
+                    pos += 1
+                view[pos:pos + len(header)] = header
+                pos += len(header)
+                if isinstance(page, _EncodedPage):
+                    pos = page.write_into(view, pos)
+                else:
+                    view[pos:pos + len(page)] = page
+                    pos += len(page)
+                view[pos:pos + len(bottom)] = bottom
+                pos += len(bottom)
+            view[pos] = 0x1a  # Print
+            pos += 1
+        finally:
+            view.release()
+        assert pos == offset + self._size
+        return pos
 
 
 def cat(images, ip=None,
         top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT,
-        tape_size=TAPE_SIZE_DEFAULT):
-    return b''.join(
-        render(images, ip=ip, top_margin=top_margin, bottom_margin=bottom_margin, tape_size=tape_size))
+        tape_size=TAPE_SIZE_DEFAULT, compression=COMPRESSION_DEFAULT, cache=None, printer_model=None,
+        workers=1, observer=None, tile_width=None, trim=False):
+    return bytes(_render_buffer(
+        images, ip=ip, top_margin=top_margin, bottom_margin=bottom_margin, tape_size=tape_size,
+        compression=compression, cache=cache, printer_model=printer_model, workers=workers,
+        observer=observer, tile_width=tile_width, trim=trim))
+
+
+def _render_buffer(images, **kwargs):
+    # Renders a Job into a new bytearray
+    job = Job(images, **kwargs)
+    buf = bytearray(job.job_size())
+    job.render_into(buf)
+    return buf
+
+
+def _notify_send(observer, ip, byte_count, start):
+    seconds = _clock() - start
+    _notify(observer, 'send', {
+        'ip': ip,
+        'bytes': byte_count,
+        'seconds': seconds,
+        'bytes_per_second': byte_count / seconds if seconds else float('inf'),
+    })
+
+
+def send(data, ip, port=PORT, observer=None):
+    start = _clock()
+    with socket.create_connection((ip, port)) as sock:
+        sock.sendall(data)
+    _notify_send(observer, ip, len(data), start)
+
+
+def _coalesce(chunks, buffer_size):
+    # Collect the (often tiny) chunks yielded by render into buffers of at least buffer_size bytes
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= buffer_size:
+            yield bytes(buf)
+            buf = bytearray()
+    if buf:
+        yield bytes(buf)
+
+
+def _send_buffers(sock, buffers, queue_size=SEND_QUEUE_SIZE):
+    # Send the buffers from a background thread, so that the next buffers can be produced in the meantime.
+    # At most queue_size buffers are kept in memory.
+    buffer_queue = queue.Queue(queue_size)
+    errors = []
+
+    def sender():
+        try:
+            while True:
+                buf = buffer_queue.get()
+                if buf is None:
+                    return
+                sock.sendall(buf)
+        except Exception as e:
+            errors.append(e)
+            # Unblock the producer
+            while buffer_queue.get() is not None:
+                pass
+
+    sender_thread = threading.Thread(target=sender, name='rasterprynt-send')
+    sender_thread.daemon = True
+    sender_thread.start()
+    try:
+        for buf in buffers:
+            if errors:
+                break
+            buffer_queue.put(buf)
+    finally:
+        buffer_queue.put(None)
+        sender_thread.join()
 
+    if errors:
+        raise errors[0]
 
-def send(data, ip):
-    with socket.create_connection((ip, 9100)) as sock:
-        sock.sendall(data)
+
+def send_stream(chunks, ip, port=PORT, buffer_size=SEND_BUFFER_SIZE_DEFAULT, observer=None):
+    # Like send, but sends an iterable of bytes (e.g. from render) while it is being produced.
+    # The time reported to observer includes producing the chunks.
+    start = _clock()
+    sizes = []
+    with socket.create_connection((ip, port)) as sock:
+        _send_buffers(sock, (sizes.append(len(buf)) or buf for buf in _coalesce(chunks, buffer_size)))
+    _notify_send(observer, ip, sum(sizes), start)
 
 
 def prynt(images, ip,
           top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT,
-          tape_size=TAPE_SIZE_DEFAULT):
-    data = cat(images, ip, top_margin, bottom_margin, tape_size=tape_size)
-    send(data, ip)
+          tape_size=TAPE_SIZE_DEFAULT, compression=COMPRESSION_DEFAULT,
+          stream=False, buffer_size=SEND_BUFFER_SIZE_DEFAULT, cache=None, printer_model=None, workers=1,
+          observer=None, tile_width=None, trim=False, pool=None, status=False):
+    # If pool (a pool.ConnectionPool) is given, the job is sent on a pooled connection to the printer.
+    # With status, the printer's status information is read while sending (see status.send_with_status):
+    # printer errors and a different tape size raise status.PrinterError, and prynt only returns once all pages
+    # have been printed.
+    # ip can also be a group.PrinterGroup; then the job is printed on one of its printers,
+    # with the printer model and tape size of the group.
+    from .group import PrinterGroup
+    if status and (stream or pool is not None or isinstance(ip, PrinterGroup)):
+        raise ValueError('status cannot be combined with stream, pool or printer groups')
+    images = _load_images(images)
+    if isinstance(ip, PrinterGroup):
+        if pool is not None:
+            raise ValueError('Printer groups cannot be used with a connection pool')
+        group = ip
+        render_args = dict(
+            top_margin=top_margin, bottom_margin=bottom_margin, tape_size=group.tape_size,
+            compression=compression, cache=cache, printer_model=printer_model or group.model(), workers=workers,
+            observer=observer, tile_width=tile_width, trim=trim)
+        if stream:
+            group.send_stream(render(images, **render_args), buffer_size=buffer_size, observer=observer)
+        else:
+            group.send(_render_buffer(images, **render_args), observer=observer)
+        return
+
+    if stream:
+        # Start printing while the following images are still being rendered
+        (send_stream if pool is None else pool.send_stream)(
+            render(images, ip=ip, top_margin=top_margin, bottom_margin=bottom_margin, tape_size=tape_size,
+                   compression=compression, cache=cache, printer_model=printer_model, workers=workers,
+                   observer=observer, tile_width=tile_width, trim=trim),
+            ip, buffer_size=buffer_size, observer=observer)
+        return
+
+    data = _render_buffer(
+        images, ip=ip, top_margin=top_margin, bottom_margin=bottom_margin, tape_size=tape_size,
+        compression=compression, cache=cache, printer_model=printer_model, workers=workers, observer=observer,
+        tile_width=tile_width, trim=trim)
+    if status:
+        from .status import send_with_status
+        send_with_status(data, ip, media_width=int(tape_size.rstrip('m')), observer=observer)
+        return
+    (send if pool is None else pool.send)(data, ip, observer=observer)
 
 
 def main():
-    import PIL.Image
+    if sys.argv[1:2] == ['serve']:
+        from .server import main as serve_main
+        serve_main(sys.argv[2:])
+        return
 
-    parser = argparse.ArgumentParser('Print images to a Brother P-Touch printer')
+    parser = argparse.ArgumentParser(
+        'Print images to a Brother P-Touch printer',
+        epilog='Run "python -m rasterprynt serve --help" for the print daemon.')
     parser.add_argument(
-        'ip', metavar='IP', help='IP address (or domain name) of the printer')
+        'ip', metavar='IP', help='IP address (or domain name) of the printer, or the name of a group from --groups')
     parser.add_argument(
         'image_files', metavar='IMAGE', nargs='*'
     )
     parser.add_argument(
         '--to-file', metavar='FILENAME',
         help='Write the sent binary data to a file instead of printing it')
+    parser.add_argument(
+        '--compile', metavar='FILENAME',
+        help='Write a job file with an index of the pages instead of printing, for use with --replay')
+    parser.add_argument(
+        '--replay', metavar='FILENAME',
+        help='Print a job file written with --compile instead of images')
+    parser.add_argument(
+        '--pages', metavar='LIST',
+        help='With --replay, only print these pages, e.g. 1,3-5 (default: all)')
+    parser.add_argument(
+        '--manifest', metavar='FILENAME',
+        help='Print the labels listed in a CSV or JSON Lines (.jsonl) file, with optional per-label ip, '
+             'top_margin, bottom_margin and tape_size')
+    parser.add_argument(
+        '--directory', metavar='DIR',
+        help='Print all images in this directory, sorted by name')
+    parser.add_argument(
+        '--stdin', action='store_true',
+        help='Print the images whose file names are read from stdin, one per line')
     parser.add_argument(
         '--detect-device', action='store_true',
         help='Detect which printer is running at the specified IP address')
+    parser.add_argument(
+        '--model-cache', metavar='FILE.json',
+        help='Remember detected printer models in this file')
+    parser.add_argument(
+        '--groups', metavar='FILE.json',
+        help='Printer groups; if IP is the name of a group, print on the least busy printer of the group')
     parser.add_argument(
         '--top-margin', default=TOP_MARGIN_DEFAULT, metavar='INT', type=int,
         help='Margin before every image, in pixels (default: %(default)s)')
@@ -281,8 +984,49 @@ def main():
     parser.add_argument(
         '--tape-size', default=TAPE_SIZE_DEFAULT, metavar='SIZE',
         help='Description of tape size (limited support, default: %(default)s)')
+    parser.add_argument(
+        '--compression', default=COMPRESSION_DEFAULT, choices=COMPRESSION_MODES,
+        help='Compression of the raster data; auto picks the smaller encoding for every image (default: %(default)s)')
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='Send data to the printer while the images are still being rendered')
+    parser.add_argument(
+        '--status', action='store_true',
+        help='Read status information from the printer: stop on printer errors, and wait until all pages are printed')
+    parser.add_argument(
+        '--cache-dir', metavar='DIR',
+        help='Cache rendered images in this directory')
+    parser.add_argument(
+        '--jobs', default=1, metavar='INT', type=int,
+        help='Number of processes to render images in (default: %(default)s)')
+    parser.add_argument(
+        '--trim', action='store_true',
+        help='Leave out white space at the start and end of every image')
+    parser.add_argument(
+        '--tile-width', metavar='INT', type=int,
+        help='Rasterize long images in slices of this many pixels, to limit memory use')
+    parser.add_argument(
+        '--server', metavar='ADDRESS',
+        help='Send the images to the print daemon at ADDRESS (HOST:PORT or unix:PATH) instead of printing directly')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print how much time was spent in every stage')
     args = parser.parse_args()
 
+    if args.model_cache:
+        printer_cache.path = args.model_cache
+        if os.path.exists(args.model_cache):
+            printer_cache.load()
+
+    target = args.ip
+    if args.groups:
+        from .group import load_groups
+        target = load_groups(args.groups).get(args.ip, args.ip)
+        if target is not args.ip and (
+                args.detect_device or args.server or args.replay or args.compile or args.to_file):
+            parser.error('Printer groups can only be used for printing images')
+            return
+
     if args.detect_device:
         if args.image_files:
             parser.error('Images given with --detect-device')
@@ -291,6 +1035,75 @@ def main():
         print(detect_printer_model(args.ip))
         return
 
+    if args.server:
+        # Thin client: the daemon decodes and renders the images
+        from .server import submit
+        # The daemon renders with its own settings, and only gets the ones sent by submit
+        unsupported = [
+            option for option, given in (
+                ('--to-file', args.to_file), ('--compile', args.compile), ('--replay', args.replay),
+                ('--manifest', args.manifest), ('--directory', args.directory), ('--stdin', args.stdin),
+                ('--stream', args.stream), ('--status', args.status), ('--cache-dir', args.cache_dir),
+                ('--jobs', args.jobs != 1), ('--trim', args.trim), ('--tile-width', args.tile_width is not None),
+                ('--profile', args.profile))
+            if given]
+        if unsupported:
+            parser.error('--server cannot be combined with %s' % ', '.join(unsupported))
+            return
+        if not args.image_files:
+            parser.error('No images given')
+            return
+        image_data = []
+        for img_file in args.image_files:
+            with open(img_file, 'rb') as img_f:
+                image_data.append(img_f.read())
+        submit(
+            args.server, image_data, args.ip, top_margin=args.top_margin, bottom_margin=args.bottom_margin,
+            tape_size=args.tape_size, compression=args.compression)
+        return
+
+    import PIL.Image
+
+    if args.replay:
+        from . import jobfile
+        if args.image_files:
+            parser.error('Images given with --replay')
+            return
+        try:
+            pages = jobfile.parse_page_ranges(args.pages) if args.pages else None
+        except ValueError as e:
+            parser.error('Invalid --pages: %s' % e)
+            return
+        jobfile.replay(args.replay, args.ip, pages=pages)
+        return
+
+    cache = RenderCache(directory=args.cache_dir) if args.cache_dir else None
+    profile = Profile() if args.profile else None
+
+    if args.manifest or args.directory or args.stdin:
+        from . import batch
+        if args.image_files or args.compile:
+            parser.error('Images and --compile cannot be combined with --manifest, --directory or --stdin')
+            return
+        if args.manifest:
+            labels = batch.read_manifest(args.manifest)
+        elif args.directory:
+            labels = batch.read_directory(args.directory)
+        else:
+            labels = batch.read_paths(sys.stdin)
+        batch_args = dict(
+            top_margin=args.top_margin, bottom_margin=args.bottom_margin, tape_size=args.tape_size,
+            compression=args.compression, cache=cache, workers=args.jobs, observer=profile,
+            tile_width=args.tile_width, trim=args.trim)
+        if args.to_file:
+            with open(args.to_file, 'wb') as outf:
+                batch.print_batch(labels, args.ip, output=outf, **batch_args)
+        else:
+            batch.print_batch(labels, target, **batch_args)
+        if profile:
+            print(profile.report())
+        return
+
     images = [
         PIL.Image.open(img_file) for img_file in args.image_files
     ]
@@ -298,20 +1111,41 @@ def main():
         parser.error('No images given')
         return
 
+    if args.compile:
+        from . import jobfile
+        jobfile.compile_job(
+            images, args.compile, ip=args.ip,
+            top_margin=args.top_margin, bottom_margin=args.bottom_margin,
+            tape_size=args.tape_size, compression=args.compression, cache=cache,
+            workers=args.jobs, observer=profile, tile_width=args.tile_width, trim=args.trim)
+        if profile:
+            print(profile.report())
+        return
+
     if args.to_file:
-        data = cat(
+        job = Job(
             images, args.ip,
             top_margin=args.top_margin, bottom_margin=args.bottom_margin,
-            tape_size=args.tape_size)
-
-        with open(args.to_file, 'wb') as outf:
-            outf.write(data)
+            tape_size=args.tape_size, compression=args.compression, cache=cache,
+            workers=args.jobs, observer=profile, tile_width=args.tile_width, trim=args.trim)
+
+        # Write the job directly into the file
+        with open(args.to_file, 'w+b') as outf:
+            outf.truncate(job.job_size())
+            with contextlib.closing(mmap.mmap(outf.fileno(), job.job_size())) as mm:
+                job.render_into(mm)
+        if profile:
+            print(profile.report())
         return
 
     prynt(
-        images, args.ip,
+        images, target,
         top_margin=args.top_margin, bottom_margin=args.bottom_margin,
-        tape_size=args.tape_size)
+        tape_size=args.tape_size, compression=args.compression, stream=args.stream,
+        cache=cache, workers=args.jobs, observer=profile, tile_width=args.tile_width, trim=args.trim,
+        status=args.status)
+    if profile:
+        print(profile.report())
 
 
 if __name__ == '__main__':
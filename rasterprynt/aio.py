@@ -0,0 +1,88 @@
+# asyncio interface to rasterprynt (Python 3 only).
+# Network I/O happens on the event loop, rasterization in an executor,
+# so that many printers can be served from one event loop.
+
+import asyncio
+import functools
+import logging
+
+from . import (
+    BOTTOM_MARGIN_DEFAULT,
+    COMPRESSION_DEFAULT,
+    DETECT_TIMEOUT_DEFAULT,
+    PORT,
+    TAPE_SIZE_DEFAULT,
+    TOP_MARGIN_DEFAULT,
+    _cached_printer_model,
+    _load_images,
+    _model_from_html,
+    cat,
+    printer_cache,
+)
+
+CONNECT_TIMEOUT_DEFAULT = 10
+WRITE_TIMEOUT_DEFAULT = 60
+HTTP_PORT = 80
+
+
+async def _http_get(ip, path, port):
+    reader, writer = await asyncio.open_connection(ip, port)
+    try:
+        writer.write(
+            ('GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n' % (path, ip)).encode('ascii'))
+        await writer.drain()
+        return await reader.read()
+    finally:
+        writer.close()
+
+
+async def detect_printer_model(ip, timeout=DETECT_TIMEOUT_DEFAULT, http_port=HTTP_PORT):
+    cached_model = _cached_printer_model(ip)
+    if cached_model:
+        return cached_model
+
+    # Like _detect_printer_model_uncached, we do not care about the HTTP status:
+    # the page is sent along with a 401 error if a password is set.
+    try:
+        response = await asyncio.wait_for(_http_get(ip, '/admin/default.html', http_port), timeout)
+    except (OSError, asyncio.TimeoutError) as err:
+        logging.warning('Failed to detect printer at %s: %r' % (ip, err))
+        printer_cache.set(ip, 'error')
+        return 'error'
+
+    res_model = _model_from_html(response)
+    if res_model:
+        printer_cache.set(ip, res_model)
+    return res_model
+
+
+async def send(data, ip, port=PORT,
+               connect_timeout=CONNECT_TIMEOUT_DEFAULT, write_timeout=WRITE_TIMEOUT_DEFAULT):
+    _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+    try:
+        writer.write(data)
+        await asyncio.wait_for(writer.drain(), write_timeout)
+    except BaseException:
+        # Closing would wait for the unsent data to be flushed, which may never happen
+        writer.transport.abort()
+        raise
+    writer.close()
+    await writer.wait_closed()
+
+
+async def prynt(images, ip,
+                top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT,
+                tape_size=TAPE_SIZE_DEFAULT, compression=COMPRESSION_DEFAULT, cache=None, printer_model=None,
+                port=PORT, connect_timeout=CONNECT_TIMEOUT_DEFAULT, write_timeout=WRITE_TIMEOUT_DEFAULT,
+                executor=None):
+    # Like rasterprynt.prynt. Rendering runs in executor (default: the loop's default executor).
+    if printer_model is None:
+        printer_model = await detect_printer_model(ip)
+
+    # Decoding the images in the executor threads would not be thread-safe if other jobs print them, too
+    images = list(_load_images(images))
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(executor, functools.partial(
+        cat, images, ip, top_margin=top_margin, bottom_margin=bottom_margin, tape_size=tape_size,
+        compression=compression, cache=cache, printer_model=printer_model))
+    await send(data, ip, port=port, connect_timeout=connect_timeout, write_timeout=write_timeout)
@@ -0,0 +1,178 @@
+from __future__ import unicode_literals
+
+# Printing large batches of labels.
+#
+# The labels come from a manifest, a directory or a stream of file names (e.g. stdin), and are only opened
+# shortly before they are rendered, so that memory use and open files do not grow with the size of the batch.
+#
+# A manifest is a CSV file with a header row, or a JSON Lines file (.jsonl) with one object per label.
+# The columns (keys) are image (file name, relative to the manifest), and optionally ip, top_margin,
+# bottom_margin and tape_size. Missing or empty values fall back to the defaults of print_batch.
+
+import collections
+import csv
+import io
+import itertools
+import json
+import os
+import threading
+
+from . import (
+    BOTTOM_MARGIN_DEFAULT,
+    PORT,
+    SEND_BUFFER_SIZE_DEFAULT,
+    TAPE_SIZE_DEFAULT,
+    TOP_MARGIN_DEFAULT,
+    _coalesce,
+    render,
+    send_stream,
+)
+from .group import PrinterGroup
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+# Number of images that are decoded ahead of rendering
+PREFETCH_DEFAULT = 4
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.pbm', '.png', '.tif', '.tiff', '.webp')
+
+Label = collections.namedtuple('Label', ['path', 'ip', 'top_margin', 'bottom_margin', 'tape_size'])
+
+
+def _label(path, ip=None, top_margin=None, bottom_margin=None, tape_size=None):
+    return Label(
+        path, ip or None,
+        None if top_margin in (None, '') else int(top_margin),
+        None if bottom_margin in (None, '') else int(bottom_margin),
+        tape_size or None)
+
+
+def read_manifest(filename):
+    # Yields a Label for every line of the manifest filename
+    base = os.path.dirname(filename)
+    with io.open(filename, encoding='utf-8', newline='') as manifest_f:
+        if filename.endswith('.jsonl'):
+            rows = (json.loads(line) for line in manifest_f if line.strip())
+        else:
+            rows = csv.DictReader(manifest_f)
+        for line_number, row in enumerate(rows, start=1):
+            if not row.get('image'):
+                raise ValueError('%s: entry %d has no image' % (filename, line_number))
+            yield _label(
+                os.path.join(base, row['image']), row.get('ip'), row.get('top_margin'),
+                row.get('bottom_margin'), row.get('tape_size'))
+
+
+def read_directory(directory):
+    # Yields a Label for every image file in directory, sorted by name
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+            yield _label(os.path.join(directory, name))
+
+
+def read_paths(lines):
+    # Yields a Label for every non-empty line of lines (e.g. sys.stdin), which are file names
+    for line in lines:
+        path = line.strip()
+        if path:
+            yield _label(path)
+
+
+def _open_image(path):
+    import PIL.Image
+
+    img = PIL.Image.open(path)
+    img.load()  # Decode now, and close the file
+    return img
+
+
+def prefetch(labels, count=PREFETCH_DEFAULT):
+    # Yields tuples (label, img) for labels, while up to count images are opened and decoded ahead
+    # in a background thread.
+    # Errors (e.g. from opening an image) are raised once the consumer gets to them.
+    item_queue = queue.Queue(count)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def loader():
+        try:
+            for label in labels:
+                if not put((label, _open_image(label.path), None)):
+                    return
+        except Exception as e:
+            put((None, None, e))
+            return
+        put(done)
+
+    loader_thread = threading.Thread(target=loader, name='rasterprynt-prefetch')
+    loader_thread.daemon = True
+    loader_thread.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if item is done:
+                return
+            label, img, error = item
+            if error is not None:
+                raise error
+            yield label, img
+    finally:
+        stop.set()
+        loader_thread.join()
+
+
+def print_batch(labels, ip=None, output=None, port=PORT,
+                top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT, tape_size=TAPE_SIZE_DEFAULT,
+                prefetch_count=PREFETCH_DEFAULT, buffer_size=SEND_BUFFER_SIZE_DEFAULT, **render_args):
+    # Prints labels (an iterable of Label). ip, top_margin, bottom_margin and tape_size are the defaults for
+    # labels which do not specify them. ip can also be a group.PrinterGroup, whose tape size is then used.
+    # Consecutive labels with the same settings are printed as one job, which is streamed to the printer
+    # (or written to the file object output) while it is being rendered.
+    # render_args are passed on to render. Returns the number of labels printed.
+    def settings(item):
+        label = item[0]
+        return (
+            label.ip or ip,
+            top_margin if label.top_margin is None else label.top_margin,
+            bottom_margin if label.bottom_margin is None else label.bottom_margin,
+            label.tape_size or tape_size)
+
+    label_count = [0]
+
+    def images(entries):
+        for _, img in entries:
+            label_count[0] += 1
+            yield img
+
+    for (job_ip, job_top, job_bottom, job_tape), entries in itertools.groupby(
+            prefetch(labels, prefetch_count), settings):
+        if not job_ip and output is None:
+            raise ValueError('No IP address for %s' % next(entries)[0].path)
+        observer = render_args.get('observer')
+        if isinstance(job_ip, PrinterGroup):
+            chunks = render(
+                images(entries), top_margin=job_top, bottom_margin=job_bottom, tape_size=job_ip.tape_size,
+                **dict(render_args, printer_model=render_args.get('printer_model') or job_ip.model()))
+            job_ip.send_stream(chunks, buffer_size=buffer_size, observer=observer)
+            continue
+        chunks = render(
+            images(entries), ip=job_ip, top_margin=job_top, bottom_margin=job_bottom, tape_size=job_tape,
+            **render_args)
+        if output is None:
+            send_stream(chunks, job_ip, port=port, buffer_size=buffer_size, observer=observer)
+        else:
+            for buf in _coalesce(chunks, buffer_size):
+                output.write(buf)
+    return label_count[0]
@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+
+
+# Default size of the in-memory part of a RenderCache, in bytes
+RENDER_CACHE_SIZE_DEFAULT = 64 * 1024 * 1024
+
+
+def image_hash(img):
+    # Hash of everything in img that influences rendering
+    if hasattr(img, 'content_hash'):  # template.TemplateLabel
+        return img.content_hash()
+    h = hashlib.sha256()
+    h.update(img.mode.encode('ascii'))
+    h.update(struct.pack('<II', img.width, img.height))
+    if img.mode == 'P':
+        h.update(bytes(bytearray(img.getpalette() or [])))
+        h.update(repr(img.info.get('transparency')).encode('ascii'))
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class RenderCache(object):
+    # Cache of rendered pages, keyed by a hash of the image and the render settings.
+    # Entries are kept in memory (least recently used ones are evicted once max_bytes is exceeded)
+    # and, if directory is given, also on disk.
+
+    def __init__(self, max_bytes=RENDER_CACHE_SIZE_DEFAULT, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, img, printer_model, tape_size, top_margin, bottom_margin, compression, tile_width=None):
+        settings = '%s/%s/%d/%d/%s' % (printer_model, tape_size, top_margin, bottom_margin, compression)
+        if tile_width and compression == 'auto':  # The compression is decided on the first tile
+            settings += '/%d' % tile_width
+        return hashlib.sha256((settings + '/' + image_hash(img)).encode('ascii')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+    def get(self, key):
+        # Returns the cached bytes, or None if key is not in the cache
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+                self.hits += 1
+                return data
+
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as cache_f:
+                    data = cache_f.read()
+            except (IOError, OSError):
+                pass
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                self._store(key, data)
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self._store(key, data)
+
+        if self.directory is not None:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp_f:
+                tmp_f.write(data)
+            os.rename(tmp_path, self._path(key))
+
+    def _store(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        # Clears the in-memory part of the cache
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'size': self.size,
+            }
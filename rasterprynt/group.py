@@ -0,0 +1,235 @@
+from __future__ import unicode_literals
+
+# Groups of identical printers.
+#
+# A PrinterGroup is a named set of printers with the same model and tape. A job sent to the group is printed
+# by the member that is expected to finish it first. Every member has a backlog of bytes it has received (or is
+# still receiving) but probably not printed yet. Since a send completes as soon as the job fits into the socket
+# buffers, the backlog is not cleared when the send completes, but shrinks at the rate the printer prints: print_rate
+# bytes per second, or the rate at which recent jobs were received if that is lower (i.e. if the printer made the
+# sender wait). Members that are expected to finish at the same time are used in turn.
+# If a printer cannot be connected to, the job is sent to another member, and the printer is skipped for a while.
+#
+# Groups can be configured in a JSON file:
+#
+#   {"station-1": {"ips": ["192.168.1.21", "192.168.1.22"], "printer_model": "P950NW", "tape_size": "18mm"}}
+
+import io
+import json
+import socket
+import threading
+import time
+
+from . import (
+    PORT,
+    SEND_BUFFER_SIZE_DEFAULT,
+    TAPE_SIZE_DEFAULT,
+    _clock,
+    _coalesce,
+    _notify_send,
+    _send_buffers,
+    detect_printer_model,
+)
+
+CONNECT_TIMEOUT_DEFAULT = 10
+# How long a printer that could not be connected to is skipped
+RETRY_AFTER_DEFAULT = 30
+# Weight of the latest job in the throughput estimate
+THROUGHPUT_WEIGHT = 0.3
+# Assumed print speed in bytes per second, roughly a P950NW printing uncompressed rows
+PRINT_RATE_DEFAULT = 40 * 1024
+# Assumed size of a streamed job while no job has been sent yet
+JOB_SIZE_DEFAULT = 64 * 1024
+
+
+class _Member(object):
+    def __init__(self, ip):
+        self.ip = ip
+        self.in_flight = 0  # Bytes of the jobs currently being sent
+        self.jobs_in_flight = 0
+        self.backlog = 0  # Bytes probably not printed yet, at the time updated
+        self.updated = 0
+        self.last_used = 0
+        self.throughput = None  # Bytes per second, averaged over recent jobs
+        self.down_until = 0
+        self.jobs = 0
+        self.failures = 0
+
+
+class PrinterGroup(object):
+    # Printers at ips, which all have the same printer_model (detected from the first reachable one if None)
+    # and tape_size.
+
+    def __init__(self, name, ips, printer_model=None, tape_size=TAPE_SIZE_DEFAULT, port=PORT,
+                 connect_timeout=CONNECT_TIMEOUT_DEFAULT, retry_after=RETRY_AFTER_DEFAULT,
+                 print_rate=PRINT_RATE_DEFAULT):
+        if not ips:
+            raise ValueError('Printer group %s has no printers' % name)
+        self.name = name
+        self.printer_model = printer_model
+        self.tape_size = tape_size
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.retry_after = retry_after
+        self.print_rate = print_rate
+        self._members = [_Member(ip) for ip in ips]
+        self._job_size = None  # Bytes per job, averaged over recent jobs
+        self._uses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ips(self):
+        return [member.ip for member in self._members]
+
+    def __repr__(self):
+        return 'PrinterGroup(%r, %r)' % (self.name, self.ips)
+
+    def model(self):
+        # The printer model of the group
+        if self.printer_model is None:
+            for member in self._members:
+                model = detect_printer_model(member.ip)
+                if model != 'error':
+                    self.printer_model = model
+                    break
+            else:
+                raise ValueError('Cannot detect the printer model of group %s' % self.name)
+        return self.printer_model
+
+    def _rate(self, member):
+        # Bytes per second member is assumed to print
+        return min(member.throughput or self.print_rate, self.print_rate)
+
+    def _backlog(self, member, now):
+        # Bytes member probably has not printed yet at time now
+        return max(0, member.backlog - self._rate(member) * (now - member.updated))
+
+    def _add_backlog(self, member, size, now):
+        member.backlog = max(0, self._backlog(member, now) + size)
+        member.updated = now
+
+    def _candidates(self, size, now):
+        # Members in the order they should be tried for a job of size bytes
+        def expected_finish(member):
+            return (self._backlog(member, now) + size) / self._rate(member)
+
+        up = [m for m in self._members if m.down_until <= now]
+        down = sorted((m for m in self._members if m.down_until > now), key=lambda m: m.down_until)
+        return sorted(up, key=lambda m: (expected_finish(m), m.jobs_in_flight, m.last_used)) + down
+
+    def _connect(self, size):
+        # Connects to the best member. Returns (member, socket); size bytes are counted as in flight there.
+        tried = []
+        error = None
+        while len(tried) < len(self._members):
+            with self._lock:
+                # Choose and count the job in one go, so that concurrent jobs see it
+                now = time.time()
+                member = [m for m in self._candidates(size, now) if m not in tried][0]
+                member.in_flight += size
+                member.jobs_in_flight += 1
+                self._add_backlog(member, size, now)
+                self._uses += 1
+                member.last_used = self._uses
+            tried.append(member)
+            try:
+                sock = socket.create_connection((member.ip, self.port), timeout=self.connect_timeout)
+            except (socket.error, socket.timeout) as e:
+                error = e
+                with self._lock:
+                    member.in_flight -= size
+                    member.jobs_in_flight -= 1
+                    self._add_backlog(member, -size, time.time())
+                    member.failures += 1
+                    member.down_until = time.time() + self.retry_after
+                continue
+            sock.settimeout(None)
+            return member, sock
+        raise error
+
+    def _finish(self, member, size, sent, start, observer):
+        seconds = _clock() - start
+        with self._lock:
+            member.in_flight -= size
+            member.jobs_in_flight -= 1
+            # Only the bytes sent will be printed
+            self._add_backlog(member, sent - size, time.time())
+            if sent:
+                member.jobs += 1
+                self._job_size = sent if self._job_size is None else (
+                    THROUGHPUT_WEIGHT * sent + (1 - THROUGHPUT_WEIGHT) * self._job_size)
+                if seconds > 0:
+                    rate = sent / seconds
+                    member.throughput = rate if member.throughput is None else (
+                        THROUGHPUT_WEIGHT * rate + (1 - THROUGHPUT_WEIGHT) * member.throughput)
+        if sent:
+            _notify_send(observer, member.ip, sent, start)
+
+    def send(self, data, observer=None):
+        # Sends data (e.g. from cat) to one of the printers. Returns the IP address of that printer.
+        start = _clock()
+        member, sock = self._connect(len(data))
+        sent = 0
+        try:
+            with sock:
+                sock.sendall(data)
+            sent = len(data)
+        finally:
+            self._finish(member, len(data), sent, start, observer)
+        return member.ip
+
+    def send_stream(self, chunks, size_estimate=None, buffer_size=SEND_BUFFER_SIZE_DEFAULT, observer=None):
+        # Like send, but sends an iterable of bytes (e.g. from render) while it is being produced.
+        # Since the size of the job is not known yet, size_estimate bytes (default: the average size of recent jobs)
+        # are counted as in flight, and more once more has been sent.
+        if size_estimate is None:
+            with self._lock:
+                size_estimate = int(self._job_size or JOB_SIZE_DEFAULT)
+        start = _clock()
+        member, sock = self._connect(size_estimate)
+        counted = [size_estimate, 0]  # Bytes counted as in flight, bytes sent
+
+        def count(buf):
+            with self._lock:
+                counted[1] += len(buf)
+                if counted[1] > counted[0]:
+                    member.in_flight += counted[1] - counted[0]
+                    self._add_backlog(member, counted[1] - counted[0], time.time())
+                    counted[0] = counted[1]
+            return buf
+
+        try:
+            with sock:
+                _send_buffers(sock, (count(buf) for buf in _coalesce(chunks, buffer_size)))
+        finally:
+            self._finish(member, counted[0], counted[1], start, observer)
+        return member.ip
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                member.ip: {
+                    'in_flight': member.in_flight,
+                    'jobs_in_flight': member.jobs_in_flight,
+                    'backlog': int(self._backlog(member, now)),
+                    'bytes_per_second': member.throughput,
+                    'jobs': member.jobs,
+                    'failures': member.failures,
+                    'down': member.down_until > now,
+                }
+                for member in self._members
+            }
+
+
+def load_groups(filename, **kwargs):
+    # Reads printer groups from a JSON file (see above). Returns a dictionary name -> PrinterGroup.
+    # kwargs are passed on to every PrinterGroup.
+    with io.open(filename, encoding='utf-8') as groups_f:
+        config = json.load(groups_f)
+    return {
+        name: PrinterGroup(
+            name, group['ips'], printer_model=group.get('printer_model'),
+            tape_size=group.get('tape_size', TAPE_SIZE_DEFAULT), **kwargs)
+        for name, group in config.items()
+    }
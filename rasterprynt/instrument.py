@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import logging
+import time
+
+logger = logging.getLogger('rasterprynt')
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# Stages in the order they happen
+STAGES = ('detect', 'convert', 'rasterize', 'compress', 'send')
+
+
+# Observers are callables which get called with an event name and a dictionary of information:
+#
+# detect: ip, model, seconds
+# image:  index, width, height, pixels, bytes (raster data as sent), and
+#         - for rendered images: raw_bytes (before compression), compression ('raw' or 'tiff'),
+#           convert, rasterize, compress (seconds)
+#         - for images from the render cache: cached (True)
+# send:   ip, bytes, seconds, bytes_per_second
+# status: ip and the fields of a status.Status received from the printer (with status.send_with_status)
+# printed: ip, page (index in the job), seconds (since the page was sent), once the printer reports it printed
+def notify(observer, event, info):
+    logger.debug('%s: %r', event, info)
+    if observer is not None:
+        observer(event, info)
+
+
+class Profile(object):
+    # Observer that adds up the time spent in every stage
+
+    def __init__(self):
+        self.seconds = dict((stage, 0.0) for stage in STAGES)
+        self.images = 0
+        self.cached_images = 0
+        self.pixels = 0
+        self.raw_bytes = 0
+        self.raster_bytes = 0
+        self.sent_bytes = 0
+
+    def __call__(self, event, info):
+        if event == 'detect':
+            self.seconds['detect'] += info['seconds']
+        elif event == 'image':
+            self.images += 1
+            self.pixels += info['pixels']
+            if info.get('cached'):
+                self.cached_images += 1
+                return
+            for stage in ('convert', 'rasterize', 'compress'):
+                self.seconds[stage] += info[stage]
+            self.raw_bytes += info['raw_bytes']
+            self.raster_bytes += info['bytes']
+        elif event == 'send':
+            self.seconds['send'] += info['seconds']
+            self.sent_bytes += info['bytes']
+
+    def report(self):
+        lines = ['%-10s %9.3f s' % (stage, self.seconds[stage]) for stage in STAGES]
+        lines.append('%d images (%d from cache), %d pixels' % (self.images, self.cached_images, self.pixels))
+        if self.raster_bytes:
+            lines.append('raster data: %d bytes, %d after compression (ratio %.2f)' % (
+                self.raw_bytes, self.raster_bytes, float(self.raw_bytes) / self.raster_bytes))
+        if self.seconds['send']:
+            lines.append('sent %d bytes (%.0f bytes/s)' % (self.sent_bytes, self.sent_bytes / self.seconds['send']))
+        return '\n'.join(lines)
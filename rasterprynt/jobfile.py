@@ -0,0 +1,202 @@
+from __future__ import unicode_literals
+
+# Pre-rendered print jobs.
+#
+# A job file contains the output of render, followed by an index of the pages, so that
+# all or some of the pages can be sent to a printer later without rendering them again.
+#
+# Layout: MAGIC, the render output, the index (JSON), index length (8 bytes little-endian), MAGIC
+
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import socket
+import struct
+
+from . import PORT, _trim_image, detect_printer_model, render
+from .cache import image_hash
+from .parser import FormFeed, Parser, Print, PrintInfo
+
+MAGIC = b'RPRYNTJ1'
+FORMAT_VERSION = 1
+_TRAILER = struct.Struct('<Q8s')
+
+
+class _HashingImages(object):
+    # Iterates over images, remembering their hashes and sizes.
+    # With trim, the images are trimmed here (instead of in render), so that the index describes what is printed.
+    def __init__(self, images, trim=False):
+        self.images = images
+        self.trim = trim
+        self.info = []
+
+    def __iter__(self):
+        for img in self.images:
+            if self.trim:
+                img = _trim_image(img)
+            width, height = img.size
+            self.info.append({'image_sha256': image_hash(img), 'width': width, 'height': height})
+            yield img
+
+
+def compile_job(images, filename, ip=None, printer_model=None, **render_args):
+    # Renders images into the job file filename. render_args are passed on to render.
+    # Returns the index.
+    if printer_model is None and ip:
+        printer_model = detect_printer_model(ip)
+    hashing_images = _HashingImages(images, trim=render_args.get('trim', False))
+    parser = Parser()
+    pages = []
+    page_start = None
+    last_end = 0
+
+    with open(filename, 'wb') as job_f:
+        job_f.write(MAGIC)
+        for chunk in render(hashing_images, printer_model=printer_model, **dict(render_args, trim=False)):
+            job_f.write(chunk)
+            # Find the page boundaries
+            for event in parser.feed(chunk):
+                if isinstance(event, PrintInfo) and page_start is None:
+                    page_start = last_end
+                elif isinstance(event, (FormFeed, Print)) and page_start is not None:
+                    pages.append([page_start, last_end])
+                    page_start = None
+                last_end = parser.position
+        parser.close()
+        stream_length = parser.position
+
+    with open(filename, 'r+b') as job_f:
+        with contextlib.closing(mmap.mmap(job_f.fileno(), 0)) as mm:
+            stream = memoryview(mm)[len(MAGIC):]
+            try:
+                index = {
+                    'version': FORMAT_VERSION,
+                    'printer_model': printer_model,
+                    'settings': dict((k, v) for k, v in render_args.items() if k in (
+                        'tape_size', 'top_margin', 'bottom_margin', 'compression', 'trim')),
+                    'length': stream_length,
+                    'preamble': [0, pages[0][0] if pages else stream_length - 1],
+                    'end': [stream_length - 1, stream_length],
+                    'pages': [
+                        dict(info, offset=start, length=end - start,
+                             sha256=hashlib.sha256(stream[start:end]).hexdigest())
+                        for (start, end), info in zip(pages, hashing_images.info)],
+                }
+            finally:
+                stream.release()
+
+        index_bytes = json.dumps(index, sort_keys=True).encode('utf-8')
+        job_f.seek(0, os.SEEK_END)
+        job_f.write(index_bytes)
+        job_f.write(_TRAILER.pack(len(index_bytes), MAGIC))
+    return index
+
+
+class JobFile(object):
+    # A job file opened for replaying. Use as context manager, or call close().
+    # The memoryviews returned by page and chunks must be gone before closing.
+
+    def __init__(self, filename):
+        self._f = open(filename, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._f.close()
+            raise
+        self._view = memoryview(self._mmap)
+
+        if bytes(self._view[:len(MAGIC)]) != MAGIC:
+            self.close()
+            raise ValueError('%s is not a job file' % filename)
+        index_length, magic = _TRAILER.unpack(self._view[-_TRAILER.size:])
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is incomplete' % filename)
+        index_start = len(self._view) - _TRAILER.size - index_length
+        self.index = json.loads(bytes(self._view[index_start:-_TRAILER.size]).decode('utf-8'))
+        self.stream = self._view[len(MAGIC):len(MAGIC) + self.index['length']]
+
+    @property
+    def page_count(self):
+        return len(self.index['pages'])
+
+    def page(self, page_num):
+        # Returns the commands of a page (0-based) as memoryview
+        page = self.index['pages'][page_num]
+        return self.stream[page['offset']:page['offset'] + page['length']]
+
+    def check_pages(self, pages):
+        # Returns pages (0-based) as a list; raises ValueError if one of them does not exist
+        pages = list(pages)
+        for page_num in pages:
+            if not 0 <= page_num < self.page_count:
+                raise ValueError('Page %d does not exist, the job has %d pages' % (page_num + 1, self.page_count))
+        return pages
+
+    def chunks(self, pages=None):
+        # Yields memoryviews which form a printable job of the given pages (0-based, default: all)
+        pages = range(self.page_count) if pages is None else self.check_pages(pages)
+        start, end = self.index['preamble']
+        yield self.stream[start:end]
+        for i, page_num in enumerate(pages):
+            if i > 0:
+                yield b'\x0c'
+            yield self.page(page_num)
+        start, end = self.index['end']
+        yield self.stream[start:end]
+
+    def verify(self):
+        # Returns the (0-based) numbers of pages whose content does not match the index
+        return [
+            page_num for page_num, page in enumerate(self.index['pages'])
+            if hashlib.sha256(self.page(page_num)).hexdigest() != page['sha256']]
+
+    def close(self):
+        if self._view is not None:
+            if getattr(self, 'stream', None) is not None:
+                self.stream.release()
+            self._view.release()
+            self._view = None
+            self._mmap.close()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def replay(filename, ip, pages=None, port=PORT):
+    # Sends the given pages (0-based, default: all) of a job file to the printer
+    with JobFile(filename) as job:
+        if pages is not None:
+            pages = job.check_pages(pages)
+        with contextlib.closing(socket.create_connection((ip, port))) as sock:
+            for chunk in job.chunks(pages):
+                try:
+                    sock.sendall(chunk)
+                finally:
+                    # The file cannot be closed while views of it exist, not even if sending fails
+                    if isinstance(chunk, memoryview):
+                        chunk.release()
+
+
+def parse_page_ranges(spec):
+    # Parses a 1-based page specification like "1,3-5" into a list of 0-based page numbers.
+    # Whether the pages exist is checked by JobFile.chunks.
+    res = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-', 1)
+            first, last = int(first), int(last)
+            if last < first:
+                raise ValueError('Invalid page range %s' % part)
+        else:
+            first = last = int(part)
+        if first < 1:
+            raise ValueError('Invalid page %d: pages start at 1' % first)
+        res.extend(range(first - 1, last))
+    return res
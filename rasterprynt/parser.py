@@ -0,0 +1,233 @@
+from __future__ import unicode_literals
+
+# Parser for the command stream sent to the printer (the reverse of rasterprynt.render).
+#
+# Parser.feed can be called with arbitrary chunks of the stream (e.g. from a socket) and yields events.
+# Raster rows refer to the fed data with memoryviews instead of copying it.
+
+import collections
+import struct
+
+MODE_ESCP = 0x00
+MODE_RASTER = 0x01
+MODE_PTOUCH = 0x02
+COMPRESSION_RAW = 0
+COMPRESSION_TIFF = 2
+
+Init = collections.namedtuple('Init', [])  # ESC @
+ModeSwitch = collections.namedtuple('ModeSwitch', ['mode'])  # ESC i a
+PrintInfo = collections.namedtuple('PrintInfo', ['command', 'args'])  # ESC i z (P950NW) or ESC i c (9800PCN)
+Margin = collections.namedtuple('Margin', ['margin'])  # ESC i d
+VariousMode = collections.namedtuple('VariousMode', ['value', 'mirroring'])  # ESC i M
+StatusRequest = collections.namedtuple('StatusRequest', [])  # ESC i S
+Setting = collections.namedtuple('Setting', ['command', 'args'])  # Other ESC i commands we do not interpret
+Compression = collections.namedtuple('Compression', ['mode'])  # M
+ZeroRow = collections.namedtuple('ZeroRow', [])  # Z
+FormFeed = collections.namedtuple('FormFeed', ['code'])  # 0x0c (or 0x0f)
+Print = collections.namedtuple('Print', ['feed'])  # 0x1a (with feeding) or 0xff
+
+
+class RasterRow(collections.namedtuple('RasterRow', ['data', 'compression'])):  # G
+    __slots__ = ()
+
+    def decode(self):
+        """ Returns the uncompressed row as bytes """
+        if self.compression == COMPRESSION_TIFF:
+            return b''.join(tiff_uncompress(bytes(self.data)))
+        elif self.compression == COMPRESSION_RAW:
+            return bytes(self.data)
+        raise ValueError('Invalid compression mode %r' % self.compression)
+
+
+def tiff_uncompress(data):
+    """ Yields the bytes in compressed TIFF format """
+    p = 0
+    while p < len(data):
+        num = struct.unpack('!b', data[p:p+1])[0]
+        if num < 0:
+            count = (- num) + 1
+            repeat = data[p + 1:p + 2]
+            yield repeat * count
+            p += 2
+        else:
+            dlen = num + 1
+            yield data[p + 1:p + 1 + dlen]
+            p += 1 + dlen
+
+
+# Length of the arguments of ESC i commands, and whether they are only valid in raster mode
+_ESC_I_ARGS = {
+    ord('a'): (1, False),
+    ord('c'): (5, False),
+    ord('z'): (10, True),
+    ord('A'): (1, True),
+    ord('k'): (3, True),
+    ord('K'): (1, True),
+    ord('d'): (2, True),
+    ord('M'): (1, False),
+    ord('S'): (0, False),
+    ord('!'): (1, False),
+}
+
+
+class Parser(object):
+    """ Incremental parser of a command stream """
+
+    def __init__(self):
+        self.mode = MODE_PTOUCH
+        self.compression = None
+        self.position = 0  # Number of bytes parsed so far
+        self._started = False
+        self._pending = b''  # Start of an incomplete command
+
+    def feed(self, data):
+        """ Yields the events of all commands completed by data """
+        data = memoryview(data)
+
+        # Complete a command left over from the last call, copying as little as possible
+        while self._pending and len(data) > 0:
+            event, end = self._parse_one(self._pending, 0)
+            if event is None:
+                take = end - len(self._pending)
+                self._pending += data[:take].tobytes()
+                data = data[take:]
+                continue
+            self._pending = b''
+            self.position += end
+            if event is not False:
+                yield event
+
+        if self._pending:
+            return
+
+        p = 0
+        while p < len(data):
+            event, end = self._parse_one(data, p)
+            if event is None:
+                self._pending = data[p:].tobytes()
+                break
+            self.position += end - p
+            p = end
+            if event is not False:
+                yield event
+
+    def close(self):
+        """ Checks that the stream did not end in the middle of a command """
+        if self._pending:
+            raise ValueError(
+                'Incomplete command at end of stream: %s' % ' '.join('%02x' % b for b in bytearray(self._pending)))
+
+    def _parse_one(self, bc, p):
+        # Returns a tuple (event, end). event is False for bytes without meaning (leading zeros).
+        # If bc ends before the command at p is complete, returns (None, minimal length of bc needed).
+        mode = self.mode
+        c = bc[p]
+        if not self._started:
+            if c == 0:  # Zeroes at the start
+                return False, p + 1
+            self._started = True
+
+        if mode == MODE_RASTER and c == ord('M'):  # Select compression mode
+            if p + 2 > len(bc):
+                return None, p + 2
+            self.compression = bc[p + 1]
+            assert self.compression in (COMPRESSION_RAW, COMPRESSION_TIFF)
+            return Compression(self.compression), p + 2
+        elif mode == MODE_RASTER and c == ord('Z'):  # Zero raster graphics
+            return ZeroRow(), p + 1
+        elif mode == MODE_RASTER and c == ord('G'):  # Seems to be the same as g?
+            if p + 3 > len(bc):
+                return None, p + 3
+            dlen = bc[p + 1] | (bc[p + 2] << 8)
+            if p + 3 + dlen > len(bc):
+                return None, p + 3 + dlen
+            return RasterRow(bc[p + 3:p + 3 + dlen], self.compression), p + 3 + dlen
+        elif c == 0xff:  # Print command
+            return Print(False), p + 1
+        elif mode == MODE_RASTER and c == 0x1a:  # Print Command with feeding
+            return Print(True), p + 1
+        elif c == 0x0c or c == 0x0f:
+            return FormFeed(c), p + 1
+
+        # ESC code
+        if c != 0x1b:
+            raise ValueError(
+                'Invalid control character: Expected ESC; got 0x%02x at position 0x%x' % (c, self.position))
+
+        if p + 2 > len(bc):
+            return None, p + 2
+        cmd = bc[p + 1]
+        if cmd == ord('@'):  # Initialize
+            return Init(), p + 2
+        if cmd != ord('i'):
+            raise NotImplementedError('Unsupported command %s / 0x%02x' % (chr(cmd), cmd))
+
+        if p + 3 > len(bc):
+            return None, p + 3
+        subcmd = bc[p + 2]
+
+        if subcmd == ord('U'):  # Serial bus configuration
+            if p + 4 > len(bc):
+                return None, p + 4
+            subsubcmd = bc[p + 3]
+            if subsubcmd == ord('B'):
+                arg_count = 1  # Baud rate - we don't care
+            elif mode == MODE_RASTER and subsubcmd == ord('J'):  # TODO ??
+                arg_count = 14
+            else:
+                raise NotImplementedError(
+                    'Unsupported bus subsubcommand of iU in mode %s: %s / 0x%02x' %
+                    (mode, chr(subsubcmd), subsubcmd))
+            end = p + 4 + arg_count
+            if end > len(bc):
+                return None, end
+            return Setting('iU' + chr(subsubcmd), bc[p + 4:end]), end
+
+        arg_count, raster_only = _ESC_I_ARGS.get(subcmd, (None, False))
+        if arg_count is None or (raster_only and mode != MODE_RASTER):
+            raise NotImplementedError(
+                'Unsupported subcommand i %s / 0x%02x in mode %s' %
+                (chr(subcmd), subcmd, mode))
+        end = p + 3 + arg_count
+        if end > len(bc):
+            return None, end
+        args = bc[p + 3:end]
+
+        if subcmd == ord('a'):  # Switch command mode
+            self.mode = args[0]
+            assert self.mode in (MODE_ESCP, MODE_RASTER, MODE_PTOUCH)
+            return ModeSwitch(self.mode), end
+        elif subcmd in (ord('c'), ord('z')):
+            return PrintInfo(chr(subcmd), args), end
+        elif subcmd == ord('d'):  # Margin
+            return Margin(args[0] | (args[1] << 8)), end
+        elif subcmd == ord('M'):  # Various Mode Settings
+            rest_bits = args[0] & 0x9f
+            if rest_bits != 0:
+                raise NotImplementedError('Strange bits in Various Mode settings: 0x%02x' % args[0])
+            return VariousMode(args[0], (args[0] & 0x4) != 0), end
+        elif subcmd == ord('S'):  # Status information request
+            return StatusRequest(), end
+        return Setting('i' + chr(subcmd), args), end
+
+
+def parse(bc):
+    """ Yields the events of a whole command stream (as one bytes object) """
+    parser = Parser()
+    for event in parser.feed(bc):
+        yield event
+    parser.close()
+
+
+def parse_stream(chunks):
+    """ Yields the events of a command stream given as an iterable of bytes objects """
+    parser = Parser()
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    parser.close()
+
+
+def parse_file(f, chunk_size=1024 * 1024):
+    """ Yields the events of a command stream read from the file object f """
+    return parse_stream(iter(lambda: f.read(chunk_size), b''))
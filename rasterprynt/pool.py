@@ -0,0 +1,230 @@
+from __future__ import unicode_literals
+
+# Persistent connections to printers.
+#
+# A ConnectionPool keeps the connection to a printer open after a job, so that the next job for the same printer
+# neither has to connect again nor to initialize the printer again: the 200 zero bytes and the ESC @ sent by
+# render at the start of every job are only sent once per connection.
+
+import collections
+import contextlib
+import errno
+import select
+import socket
+import threading
+import time
+
+from . import PORT, SEND_BUFFER_SIZE_DEFAULT, _clock, _coalesce, _notify_send, _send_buffers
+
+# What render sends before the first page setting; only needed once per connection
+PREAMBLE = b'\x00' * 200 + b'\x1b@'
+
+IDLE_TIMEOUT_DEFAULT = 30
+CONNECT_TIMEOUT_DEFAULT = 10
+SOCKET_TIMEOUT_DEFAULT = 60
+
+
+class _Connection(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.last_used = time.time()
+        self.jobs = 0
+
+
+def _is_alive(sock):
+    # Checks whether an idle connection can still be used, without blocking.
+    # A socket is only readable if the printer has closed the connection, reset it or sent status information.
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            data = sock.recv(4096)
+        finally:
+            sock.settimeout(timeout)  # setblocking(True) would remove the timeout
+        return len(data) > 0
+    except (socket.error, select.error, ValueError) as e:
+        if getattr(e, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return True
+        return False
+
+
+def _strip_preamble(chunks):
+    # Yields chunks (the output of render), without the PREAMBLE at the start
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(PREAMBLE):
+            break
+    if head.startswith(PREAMBLE):
+        head = head[len(PREAMBLE):]
+    if head:
+        yield head
+    for chunk in chunks:
+        yield chunk
+
+
+class _NothingSent(Exception):
+    # A reused connection failed before any data was written to it
+    pass
+
+
+class ConnectionPool(object):
+    # Connections to printers, keyed by address. A connection is used by one job at a time;
+    # concurrent jobs for the same printer get additional connections.
+    # Connections which have not been used for idle_timeout seconds are closed in a background thread,
+    # since printers only accept a limited number of connections.
+
+    def __init__(self, port=PORT, idle_timeout=IDLE_TIMEOUT_DEFAULT,
+                 connect_timeout=CONNECT_TIMEOUT_DEFAULT, socket_timeout=SOCKET_TIMEOUT_DEFAULT):
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.socket_timeout = socket_timeout
+        self._cond = threading.Condition()
+        self._idle = collections.defaultdict(list)  # address -> [_Connection]
+        self._reaper = None
+        self._closed = False
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+
+    def _connect(self, address):
+        sock = socket.create_connection(address, self.connect_timeout)
+        sock.settimeout(self.socket_timeout)
+        with self._cond:
+            self.connects += 1
+        return _Connection(sock, address)
+
+    def _acquire(self, address):
+        # Returns an idle, healthy connection to address, or None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('ConnectionPool is closed')
+            idle = self._idle[address]
+            while idle:
+                conn = idle.pop()
+                if time.time() - conn.last_used < self.idle_timeout and _is_alive(conn.sock):
+                    self.reuses += 1
+                    return conn
+                conn.sock.close()
+        return None
+
+    def _release(self, conn):
+        conn.last_used = time.time()
+        conn.jobs += 1
+        with self._cond:
+            if self._closed:
+                conn.sock.close()
+                return
+            self._idle[conn.address].append(conn)
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name='rasterprynt-pool-reaper')
+                self._reaper.daemon = True
+                self._reaper.start()
+
+    @contextlib.contextmanager
+    def connection(self, ip, port=None, reuse=True):
+        # Context manager yielding a tuple (socket, initialized). If initialized is True, the printer has
+        # already received a job on this connection. The connection is closed if the block raises an exception.
+        # With reuse=False, a new connection is opened (and pooled afterwards).
+        address = (ip, self.port if port is None else port)
+        conn = self._acquire(address) if reuse else None
+        initialized = conn is not None
+        if conn is None:
+            conn = self._connect(address)
+        try:
+            yield conn.sock, initialized
+        except BaseException:
+            conn.sock.close()
+            raise
+        self._release(conn)
+
+    def send(self, data, ip, port=None, observer=None):
+        # Sends a job (the output of cat). If a reused connection fails before any of the job has been written
+        # to it, the job is sent again on a new connection. Timeouts and errors after a part of the job has been
+        # written are raised, since sending the job again could print labels twice.
+        # Like any send on TCP, this returns once the job has been written into the socket buffers. If the printer
+        # drops the connection after that (and after the health check of _acquire), the job is lost without an error.
+        # Use prynt with status to learn whether the labels have been printed.
+        start = _clock()
+        view = memoryview(data)
+        try:
+            with self.connection(ip, port) as (sock, initialized):
+                payload = view[len(PREAMBLE):] if initialized and data.startswith(PREAMBLE) else view
+                try:
+                    written = sock.send(payload)
+                except socket.timeout:
+                    raise
+                except socket.error as e:
+                    if not initialized:
+                        raise
+                    raise _NothingSent(e)
+                sock.sendall(payload[written:])
+        except _NothingSent:
+            # The printer has dropped the connection since the last health check
+            with self._cond:
+                self.reconnects += 1
+            with self.connection(ip, port, reuse=False) as (sock, _):
+                sock.sendall(view)
+        _notify_send(observer, ip, len(data), start)
+
+    def send_stream(self, chunks, ip, port=None, buffer_size=SEND_BUFFER_SIZE_DEFAULT, observer=None):
+        # Like rasterprynt.send_stream, on a pooled connection. Since chunks are only generated once,
+        # a failing connection is not retried.
+        start = _clock()
+        sizes = []
+        with self.connection(ip, port) as (sock, initialized):
+            if initialized:
+                chunks = _strip_preamble(chunks)
+            _send_buffers(sock, (sizes.append(len(buf)) or buf for buf in _coalesce(chunks, buffer_size)))
+        _notify_send(observer, ip, sum(sizes), start)
+
+    def idle_count(self, ip=None, port=None):
+        with self._cond:
+            if ip is None:
+                return sum(len(conns) for conns in self._idle.values())
+            return len(self._idle.get((ip, self.port if port is None else port), ()))
+
+    def close_idle(self, max_idle=None):
+        # Closes the connections that have not been used for max_idle (default: idle_timeout) seconds
+        if max_idle is None:
+            max_idle = self.idle_timeout
+        now = time.time()
+        with self._cond:
+            for address, conns in list(self._idle.items()):
+                keep = []
+                for conn in conns:
+                    if now - conn.last_used >= max_idle:
+                        conn.sock.close()
+                    else:
+                        keep.append(conn)
+                if keep:
+                    self._idle[address] = keep
+                else:
+                    del self._idle[address]
+
+    def _reap(self):
+        with self._cond:
+            while not self._closed:
+                self._cond.wait(max(self.idle_timeout / 2.0, 0.01))
+                self.close_idle()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self.close_idle(0)
+            self._cond.notify_all()
+            reaper = self._reaper
+        if reaper is not None:
+            reaper.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,282 @@
+# Print daemon (Python 3 only).
+#
+# `python -m rasterprynt serve` keeps the interpreter, PIL, the printer model cache, a render cache and
+# the connections to the printers warm, and accepts print jobs via HTTP on localhost or on a Unix socket:
+#
+#   POST /print   {"ip": "192.168.1.123", "images": [<base64-encoded image file>, ...],
+#                  "top_margin": 8, "bottom_margin": 8, "tape_size": "18mm", "compression": "raw",
+#                  "printer_model": null}
+#                 Responds once the job has been sent: {"pages": 1}, or {"error": "..."} with status 400/500
+#   GET /status   Statistics
+#
+# submit is the client side, used by `python -m rasterprynt --server ADDRESS IP IMAGE...`.
+
+import argparse
+import base64
+import http.client
+import http.server
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from . import (
+    BOTTOM_MARGIN_DEFAULT,
+    COMPRESSION_DEFAULT,
+    COMPRESSION_MODES,
+    TAPE_SIZE_DEFAULT,
+    TOP_MARGIN_DEFAULT,
+    printer_cache,
+)
+from .cache import RenderCache
+from .pool import ConnectionPool
+from .spooler import Spooler
+
+SERVE_PORT_DEFAULT = 9180
+SERVE_ADDRESS_DEFAULT = '127.0.0.1:%d' % SERVE_PORT_DEFAULT
+UNIX_PREFIX = 'unix:'
+SUBMIT_TIMEOUT_DEFAULT = 300
+
+_SETTINGS = {
+    'top_margin': (int, TOP_MARGIN_DEFAULT),
+    'bottom_margin': (int, BOTTOM_MARGIN_DEFAULT),
+    'tape_size': (str, TAPE_SIZE_DEFAULT),
+    'compression': (str, COMPRESSION_DEFAULT),
+    'printer_model': (str, None),
+}
+
+
+class ServerError(Exception):
+    pass
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # self.server.print_daemon is the PrintDaemon
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._respond(404, {'error': 'Not found'})
+            return
+        self._respond(200, self.server.print_daemon.status())
+
+    def do_POST(self):
+        if self.path != '/print':
+            self._respond(404, {'error': 'Not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            ip, images, settings = _parse_request(request)
+        except (ValueError, KeyError, TypeError, IOError) as e:  # PIL raises IOError for invalid images
+            self._respond(400, {'error': 'Invalid request: %s' % e})
+            return
+
+        try:
+            self.server.print_daemon.print_images(images, ip, **settings)
+        except Exception as e:
+            self._respond(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        self._respond(200, {'pages': len(images)})
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        self.server.print_daemon.log(format % args)
+
+
+def _parse_request(request):
+    import PIL.Image
+
+    ip = request['ip']
+    if not isinstance(ip, str):
+        raise TypeError('ip must be a string')
+    images = []
+    for image_data in request['images']:
+        img = PIL.Image.open(io.BytesIO(base64.b64decode(image_data)))
+        img.load()
+        images.append(img)
+    if not images:
+        raise ValueError('No images given')
+
+    settings = {}
+    for key, (value_type, default) in _SETTINGS.items():
+        value = request.get(key, default)
+        settings[key] = value if value is None else value_type(value)
+    if settings['compression'] not in COMPRESSION_MODES:
+        raise ValueError('Invalid compression %s' % settings['compression'])
+    return ip, images, settings
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class PrintDaemon(object):
+    # Accepts jobs at address (HOST:PORT, or unix:PATH) and prints them with a Spooler,
+    # a RenderCache and a ConnectionPool that are shared by all jobs.
+
+    def __init__(self, address=SERVE_ADDRESS_DEFAULT, cache=None, pool=None, port=None, verbose=False):
+        self.cache = RenderCache() if cache is None else cache
+        self.pool = ConnectionPool() if pool is None else pool
+        spooler_args = {} if port is None else {'port': port}
+        self.spooler = Spooler(pool=self.pool, cache=self.cache, **spooler_args)
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self.jobs_done = 0
+        self.jobs_failed = 0
+
+        if address.startswith(UNIX_PREFIX):
+            self.path = address[len(UNIX_PREFIX):]
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = _UnixServer(self.path, _Handler)
+            self.address = address
+        else:
+            self.path = None
+            host, _, port_str = address.rpartition(':')
+            self.server = _TCPServer((host or '127.0.0.1', int(port_str)), _Handler)
+            self.address = '%s:%d' % self.server.server_address[:2]
+        self.server.print_daemon = self
+
+    def print_images(self, images, ip, **settings):
+        try:
+            self.spooler.submit(images, ip, **settings).result()
+        except Exception:
+            with self._lock:
+                self.jobs_failed += 1
+            raise
+        with self._lock:
+            self.jobs_done += 1
+
+    def status(self):
+        return {
+            'jobs_done': self.jobs_done,
+            'jobs_failed': self.jobs_failed,
+            'spooler': self.spooler.metrics(),
+            'cache': self.cache.stats(),
+            'connections': {
+                'connects': self.pool.connects,
+                'reuses': self.pool.reuses,
+                'reconnects': self.pool.reconnects,
+                'idle': self.pool.idle_count(),
+            },
+        }
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        # Stops serve_forever (from another thread)
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        self.spooler.close()
+        self.pool.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def _connection(address, timeout):
+    if address.startswith(UNIX_PREFIX):
+        return _UnixHTTPConnection(address[len(UNIX_PREFIX):], timeout)
+    host, _, port = address.rpartition(':')
+    return http.client.HTTPConnection(host, int(port), timeout=timeout)
+
+
+def _request(address, method, path, data=None, timeout=SUBMIT_TIMEOUT_DEFAULT):
+    conn = _connection(address, timeout)
+    try:
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        conn.request(method, path, body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ServerError(result.get('error', 'HTTP status %d' % response.status))
+    return result
+
+
+def submit(address, image_files, ip, timeout=SUBMIT_TIMEOUT_DEFAULT, **settings):
+    # Prints images (as the contents of image files, bytes) via the daemon at address.
+    # settings are top_margin, bottom_margin, tape_size, compression and printer_model.
+    request = dict(settings, ip=ip, images=[base64.b64encode(data).decode('ascii') for data in image_files])
+    return _request(address, 'POST', '/print', request, timeout=timeout)
+
+
+def server_status(address, timeout=SUBMIT_TIMEOUT_DEFAULT):
+    return _request(address, 'GET', '/status', timeout=timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('rasterprynt serve', description='Run a print daemon')
+    parser.add_argument(
+        '--listen', metavar='ADDRESS', default=SERVE_ADDRESS_DEFAULT,
+        help='HOST:PORT or unix:PATH to accept jobs on (default: %(default)s)')
+    parser.add_argument(
+        '--cache-dir', metavar='DIR',
+        help='Also cache rendered images in this directory')
+    parser.add_argument(
+        '--model-cache', metavar='FILE.json',
+        help='Remember detected printer models in this file')
+    parser.add_argument(
+        '--idle-timeout', metavar='SECONDS', type=float, default=30,
+        help='Close connections to printers after this long without jobs (default: %(default)s)')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Log every request')
+    args = parser.parse_args(argv)
+
+    import PIL.Image  # NOQA  Import before the first job
+
+    if args.model_cache:
+        printer_cache.path = args.model_cache
+        if os.path.exists(args.model_cache):
+            printer_cache.load()
+
+    daemon = PrintDaemon(
+        args.listen, cache=RenderCache(directory=args.cache_dir), pool=ConnectionPool(idle_timeout=args.idle_timeout),
+        verbose=args.verbose)
+    print('Listening on %s' % daemon.address)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
@@ -0,0 +1,146 @@
+from __future__ import unicode_literals
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+from . import (
+    BOTTOM_MARGIN_DEFAULT,
+    COMPRESSION_DEFAULT,
+    PORT,
+    TAPE_SIZE_DEFAULT,
+    TOP_MARGIN_DEFAULT,
+    _load_images,
+    cat,
+    send,
+)
+
+# Maximum number of jobs which are coalesced into a single print job
+MAX_BATCH_DEFAULT = 50
+
+
+_Job = collections.namedtuple('_Job', ['images', 'settings', 'future'])
+
+
+class Spooler(object):
+    # Queues print jobs per printer.
+    # Every printer gets its own worker thread, so jobs for one printer are sent one after another,
+    # while different printers are served in parallel. Rendering happens in executor (default: a thread pool).
+    # Consecutive jobs for the same printer with the same settings are printed as one job,
+    # so that only form feeds separate them.
+    # If pool (a pool.ConnectionPool) is given, batches are sent on its connections,
+    # and if cache (a RenderCache) is given, pages are rendered with it.
+
+    def __init__(self, executor=None, port=PORT, max_batch=MAX_BATCH_DEFAULT, pool=None, cache=None):
+        self.port = port
+        self.pool = pool
+        self.cache = cache
+        self.max_batch = max_batch
+        self._own_executor = executor is None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=4) if executor is None else executor
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._workers = {}
+        self._closed = False
+        self._start_time = time.time()
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.batches_sent = 0
+        self.bytes_sent = 0
+
+    def submit(self, images, ip,
+               top_margin=TOP_MARGIN_DEFAULT, bottom_margin=BOTTOM_MARGIN_DEFAULT,
+               tape_size=TAPE_SIZE_DEFAULT, compression=COMPRESSION_DEFAULT, printer_model=None):
+        # Queues a print job. Returns a concurrent.futures.Future which is done once the job has been sent.
+        settings = (printer_model, tape_size, top_margin, bottom_margin, compression)
+        job = _Job(list(_load_images(images)), settings, concurrent.futures.Future())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Spooler is closed')
+            self._queues.setdefault(ip, collections.deque()).append(job)
+            if ip not in self._workers:
+                worker = threading.Thread(target=self._work, args=(ip,), name='rasterprynt-spool-%s' % ip)
+                worker.daemon = True
+                self._workers[ip] = worker
+                worker.start()
+            self._cond.notify_all()
+        return job.future
+
+    def _next_batch(self, ip):
+        # Waits for jobs for ip, and returns the jobs that can be printed together (or None when closed)
+        with self._cond:
+            job_queue = self._queues[ip]
+            while not job_queue:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            batch = [job_queue.popleft()]
+            while job_queue and len(batch) < self.max_batch and job_queue[0].settings == batch[0].settings:
+                batch.append(job_queue.popleft())
+            return batch
+
+    def _work(self, ip):
+        while True:
+            batch = self._next_batch(ip)
+            if batch is None:
+                return
+
+            printer_model, tape_size, top_margin, bottom_margin, compression = batch[0].settings
+            images = [img for job in batch for img in job.images]
+            try:
+                data = self._executor.submit(
+                    cat, images, ip, top_margin=top_margin, bottom_margin=bottom_margin,
+                    tape_size=tape_size, compression=compression, printer_model=printer_model,
+                    cache=self.cache).result()
+                (send if self.pool is None else self.pool.send)(data, ip, port=self.port)
+            except Exception as e:
+                with self._cond:
+                    self.jobs_failed += len(batch)
+                for job in batch:
+                    job.future.set_exception(e)
+                continue
+
+            with self._cond:
+                self.jobs_done += len(batch)
+                self.batches_sent += 1
+                self.bytes_sent += len(data)
+            for job in batch:
+                job.future.set_result(None)
+
+    def queue_depth(self, ip=None):
+        with self._cond:
+            if ip is not None:
+                return len(self._queues.get(ip, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def metrics(self):
+        with self._cond:
+            elapsed = max(time.time() - self._start_time, 1e-9)
+            return {
+                'jobs_done': self.jobs_done,
+                'jobs_failed': self.jobs_failed,
+                'batches_sent': self.batches_sent,
+                'bytes_sent': self.bytes_sent,
+                'jobs_per_second': self.jobs_done / elapsed,
+                'bytes_per_second': self.bytes_sent / elapsed,
+                'queue_depth': {ip: len(q) for ip, q in self._queues.items()},
+            }
+
+    def close(self):
+        # Prints all queued jobs and stops the workers
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            workers = list(self._workers.values())
+        for worker in workers:
+            worker.join()
+        if self._own_executor:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,249 @@
+from __future__ import unicode_literals
+
+# Status information sent back by the printer on the raster connection.
+#
+# After a status request (ESC i S), the printer answers with a 32-byte status frame, and then sends
+# further frames on its own: phase changes when it starts and stops printing, "printing completed" after
+# every page, and errors such as running out of tape. See the status information section of
+# http://download.brother.com/welcome/docp000771/cv_pth500p700e500_eng_raster_110.pdf
+#
+# send_with_status uses these frames to report when every page has actually been printed, to stop at the
+# first printer error instead of sending the rest of the job into the void, and to keep at most window
+# pages ahead of the printer.
+
+import collections
+import socket
+import struct
+import threading
+import time
+
+from . import PORT, _clock, _notify, _notify_send
+from .parser import FormFeed, Parser, Print
+from .pool import PREAMBLE
+
+STATUS_REQUEST = b'\x1biS'
+STATUS_SIZE = 32
+
+# Status types (byte 18)
+STATUS_REPLY = 0x00
+STATUS_PRINTING_COMPLETED = 0x01
+STATUS_ERROR = 0x02
+STATUS_TURNED_OFF = 0x04
+STATUS_NOTIFICATION = 0x05
+STATUS_PHASE_CHANGE = 0x06
+
+# Phase types (byte 19)
+PHASE_RECEIVING = 0x00
+PHASE_PRINTING = 0x01
+
+# Bits of the error information bytes 8 and 9, lowest bit first
+ERRORS = (
+    ('no_media', 'end_of_media', 'cutter_jam', 'weak_batteries',
+     'printer_in_use', 'turned_off', 'high_voltage_adapter', 'fan_motor_error'),
+    ('replace_media', 'expansion_buffer_full', 'communication_error', 'communication_buffer_full',
+     'cover_open', 'overheating', 'black_marking_not_detected', 'system_error'),
+)
+
+STATUS_TIMEOUT_DEFAULT = 60
+# Number of pages which may be sent before the printer has printed them
+WINDOW_DEFAULT = 2
+
+Status = collections.namedtuple(
+    'Status', ['status_type', 'phase', 'errors', 'media_width', 'media_type', 'notification'])
+
+_FRAME = struct.Struct('<BBBBBBBBBBBBBBBBBBBB2xB9x')
+
+
+class PrinterError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def parse_status(frame):
+    # Returns the Status in a status frame (STATUS_SIZE bytes)
+    fields = _FRAME.unpack(bytes(frame))
+    if fields[0] != 0x80 or fields[1] != STATUS_SIZE:
+        raise ValueError('Invalid status frame: %s' % ' '.join('%02x' % b for b in bytearray(frame)))
+    errors = [
+        name
+        for error_bits, names in zip(fields[8:10], ERRORS)
+        for bit, name in enumerate(names)
+        if error_bits & (1 << bit)]
+    return Status(
+        status_type=fields[18], phase=fields[19], errors=errors,
+        media_width=fields[10], media_type=fields[11], notification=fields[20])
+
+
+def make_status(status_type=STATUS_REPLY, phase=PHASE_RECEIVING, errors=(), media_width=18, media_type=0x01,
+                notification=0):
+    # The status frame a printer would send (for tests and fakeprinter)
+    error_bits = [0, 0]
+    for error in errors:
+        for byte_index, names in enumerate(ERRORS):
+            if error in names:
+                error_bits[byte_index] |= 1 << names.index(error)
+    frame = bytearray(STATUS_SIZE)
+    frame[0:4] = b'\x80\x20B0'
+    frame[8:12] = bytearray([error_bits[0], error_bits[1], media_width, media_type])
+    frame[18:20] = bytearray([status_type, phase])
+    frame[22] = notification
+    return bytes(frame)
+
+
+class StatusReader(object):
+    # Splits data received from the printer (in arbitrary chunks) into status frames
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data):
+        # Yields the Status of every frame completed by data
+        self._pending += data
+        while len(self._pending) >= STATUS_SIZE:
+            frame, self._pending = self._pending[:STATUS_SIZE], self._pending[STATUS_SIZE:]
+            yield parse_status(frame)
+
+
+def split_pages(data):
+    # Returns the offsets at which the pages in data (the output of cat) end,
+    # i.e. after the form feed or print command which prints them.
+    parser = Parser()
+    ends = []
+    for event in parser.feed(data):
+        if isinstance(event, (FormFeed, Print)):
+            ends.append(parser.position)
+    parser.close()
+    return ends
+
+
+class StatusChannel(object):
+    # A connection to the printer at ip, on which status frames are read in a background thread.
+    # observer gets a 'status' event for every frame, and a 'printed' event for every page printed.
+
+    def __init__(self, ip, port=PORT, timeout=STATUS_TIMEOUT_DEFAULT, observer=None):
+        self.ip = ip
+        self.timeout = timeout
+        self.observer = observer
+        self.statuses = []
+        self.printed = 0  # Number of pages printed
+        self.error = None  # The first Status with errors
+        self.closed = False
+        self._cond = threading.Condition()
+        self.sock = socket.create_connection((ip, port), timeout=timeout)
+        self.sock.settimeout(None)
+        self._reader = threading.Thread(target=self._read, name='rasterprynt-status-%s' % ip)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        reader = StatusReader()
+        try:
+            while True:
+                data = self.sock.recv(4096)
+                if not data:
+                    break
+                for status in reader.feed(data):
+                    self._add_status(status)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            with self._cond:
+                self.closed = True
+                self._cond.notify_all()
+
+    def _add_status(self, status):
+        _notify(self.observer, 'status', dict(status._asdict(), ip=self.ip))
+        with self._cond:
+            self.statuses.append(status)
+            if status.errors and self.error is None:
+                self.error = status
+            if status.status_type == STATUS_PRINTING_COMPLETED:
+                self.printed += 1
+            self._cond.notify_all()
+
+    def _wait(self, predicate, what):
+        # Waits until predicate() is true; raises PrinterError on printer errors, timeouts and closed connections
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                if self.error is not None:
+                    raise PrinterError(
+                        'Printer %s reports %s' % (self.ip, ', '.join(self.error.errors)), self.error)
+                if predicate():
+                    return
+                if self.closed:
+                    raise PrinterError('Printer %s closed the connection while waiting for %s' % (self.ip, what))
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PrinterError('No %s from printer %s within %d seconds' % (what, self.ip, self.timeout))
+                self._cond.wait(remaining)
+
+    def request_status(self):
+        # Asks the printer for its status and returns the reply
+        with self._cond:
+            count = len(self.statuses)
+        self.sock.sendall(PREAMBLE + STATUS_REQUEST)
+
+        def replied():
+            return any(s.status_type == STATUS_REPLY for s in self.statuses[count:])
+        self._wait(replied, 'status reply')
+        with self._cond:
+            return [s for s in self.statuses[count:] if s.status_type == STATUS_REPLY][0]
+
+    def send_pages(self, data, window=WINDOW_DEFAULT):
+        # Sends data (the output of cat), keeping at most window pages ahead of the printer,
+        # and waits until all pages have been printed.
+        # request_status has already initialized the printer, so the PREAMBLE of data is not sent again.
+        view = memoryview(data)
+        start = len(PREAMBLE) if data.startswith(PREAMBLE) else 0
+        first_page = self.printed
+        sent_times = []
+        reported = 0
+        for index, end in enumerate(split_pages(data)):
+            self._wait(lambda: self.printed - first_page >= index - window + 1, 'completed page')
+            reported = self._notify_printed(first_page, sent_times, reported)
+            self.sock.sendall(view[start:end])
+            sent_times.append(_clock())
+            start = end
+        self.sock.sendall(view[start:])
+        self._wait(lambda: self.printed - first_page >= len(sent_times), 'completed page')
+        self._notify_printed(first_page, sent_times, reported)
+
+    def _notify_printed(self, first_page, sent_times, reported):
+        # Emits 'printed' events for the pages completed after the first reported ones.
+        # Returns the number of pages reported so far.
+        with self._cond:
+            printed = min(self.printed - first_page, len(sent_times))
+        for index in range(reported, printed):
+            _notify(self.observer, 'printed', {
+                'ip': self.ip, 'page': index, 'seconds': _clock() - sent_times[index]})
+        return max(reported, printed)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def send_with_status(data, ip, port=PORT, media_width=None, window=WINDOW_DEFAULT,
+                     timeout=STATUS_TIMEOUT_DEFAULT, observer=None):
+    # Sends data (the output of cat) to the printer at ip, pacing it with the printer's status information.
+    # Raises PrinterError if the printer reports an error, does not have media_width (mm) tape loaded,
+    # or does not report a page as printed within timeout seconds.
+    start = _clock()
+    with StatusChannel(ip, port=port, timeout=timeout, observer=observer) as channel:
+        status = channel.request_status()
+        if media_width is not None and status.media_width != media_width:
+            raise PrinterError(
+                'Printer %s has %dmm tape loaded, not %dmm' % (ip, status.media_width, media_width), status)
+        channel.send_pages(data, window=window)
+    _notify_send(observer, ip, len(data), start)
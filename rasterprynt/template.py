@@ -0,0 +1,136 @@
+from __future__ import unicode_literals
+
+# Label templates: a fixed base image with named regions whose content changes from label to label.
+#
+# The raster data of the base image is computed once per stripe size. For every label, only the columns
+# covered by filled regions are rasterized again, so printing many labels costs about as much as the
+# variable parts instead of the whole label. With trim, labels which have white space at the start or end are
+# composed into a complete image and trimmed, and then rasterized as a whole.
+#
+#     template = LabelTemplate(PIL.Image.open('base.png'), {'serial': (120, 10, 300, 60)})
+#     rasterprynt.prynt([template.fill(serial=serial_img) for serial_img in serial_images], ip)
+
+import hashlib
+import threading
+
+from . import _flatten_image, _raster_bitmap, _trim_image
+from .cache import image_hash
+
+
+class LabelTemplate(object):
+    # base is a PIL image, regions maps names to boxes (left, upper, right, lower) in base.
+
+    def __init__(self, base, regions):
+        self.base = _flatten_image(base)
+        self.regions = dict(regions)
+        for name, (left, upper, right, lower) in self.regions.items():
+            if not (0 <= left < right <= self.base.width and 0 <= upper < lower <= self.base.height):
+                raise ValueError('Region %s %r is outside of the base image' % (name, self.regions[name]))
+        self.hash = hashlib.sha256(
+            (image_hash(self.base) + repr(sorted(self.regions.items()))).encode('ascii')).hexdigest()
+        self._bitmaps = {}  # stripe size -> raster data of the base image
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.base.size
+
+    def fill(self, **values):
+        # Returns a label (which can be passed to render instead of an image) with the given region contents.
+        # Values are PIL images, drawn at the top left of their region. Regions without value show the base image.
+        for name, value in values.items():
+            if name not in self.regions:
+                raise KeyError('Unknown region %s' % name)
+            left, upper, right, lower = self.regions[name]
+            if value.width > right - left or value.height > lower - upper:
+                raise ValueError('Image of size %dx%d does not fit into region %s' % (value.size + (name,)))
+        return TemplateLabel(self, values)
+
+    def base_bitmap(self, stripe_size):
+        with self._lock:
+            bitmap = self._bitmaps.get(stripe_size)
+            if bitmap is None:
+                bitmap = self._bitmaps[stripe_size] = _raster_bitmap(self.base, stripe_size)
+        return bitmap
+
+
+def _column_spans(boxes):
+    # Merges the column ranges of boxes into sorted, non-overlapping (start, end) tuples
+    spans = []
+    for left, _, right, _ in sorted(boxes):
+        if spans and left <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], right))
+        else:
+            spans.append((left, right))
+    return spans
+
+
+class TemplateLabel(object):
+    # A filled-in LabelTemplate. Behaves like an image as far as render is concerned.
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    @property
+    def size(self):
+        return self.template.size
+
+    @property
+    def width(self):
+        return self.template.base.width
+
+    @property
+    def height(self):
+        return self.template.base.height
+
+    def content_hash(self):
+        # Used by cache.image_hash
+        h = hashlib.sha256(self.template.hash.encode('ascii'))
+        for name, value in sorted(self.values.items()):
+            h.update(('/%s=%s' % (name, image_hash(value))).encode('ascii'))
+        return h.hexdigest()
+
+    def _paste_values(self, img, x_offset):
+        for name, value in self.values.items():
+            left, upper, _, _ = self.template.regions[name]
+            if value.mode in ('RGBA', 'LA') or (value.mode == 'P' and 'transparency' in value.info):
+                value = value.convert('RGBA')
+                img.paste(value, (left - x_offset, upper), value)
+            else:
+                img.paste(value, (left - x_offset, upper))
+
+    def image(self):
+        # The complete label as PIL image
+        img = self.template.base.copy()
+        self._paste_values(img, 0)
+        return img
+
+    def trimmed(self):
+        # Used by rasterprynt._trim_image: the label itself if it has no blank columns at the start and end,
+        # otherwise the trimmed image of the label
+        img = self.image()
+        trimmed = _trim_image(img)
+        return self if trimmed is img else trimmed
+
+    def raster_bitmap(self, stripe_size, stats=None):
+        # Like rasterprynt._raster_bitmap(self.image(), stripe_size), but only rasterizes the filled regions
+        stripe_count = stripe_size // 8
+        base = self.template.base
+        parts = []
+        pos = 0
+        base_bitmap = self.template.base_bitmap(stripe_size)
+        if stats is not None:
+            stats['convert'] = stats['rasterize'] = 0
+        for start, end in _column_spans(self.template.regions[name] for name in self.values):
+            strip = base.crop((start, 0, end, base.height))
+            self._paste_values(strip, start)
+            parts.append(base_bitmap[pos * stripe_count:start * stripe_count])
+            strip_stats = {}
+            parts.append(_raster_bitmap(strip, stripe_size, strip_stats))
+            if stats is not None:
+                stats['convert'] += strip_stats['convert']
+                stats['rasterize'] += strip_stats['rasterize']
+            pos = end
+        parts.append(base_bitmap[pos * stripe_count:])
+        return b''.join(parts)
@@ -12,6 +12,7 @@ setup(name='rasterprynt',
       author_email='philipp.hagemeister@boxine.de',
       license='MIT',
       packages=['rasterprynt'],
+      python_requires='>=3.7',
       install_requires=[
           'Pillow',
       ],
@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+
+import PIL.Image
+
+import rasterprynt
+import rasterprynt.aio
+
+
+async def _serve(response=None):
+    # Starts a local server which records everything it receives (and optionally responds with response)
+    received = []
+
+    async def handle(reader, writer):
+        if response is None:
+            received.append(await reader.read())
+        else:
+            received.append(await reader.readuntil(b'\r\n\r\n'))
+            writer.write(response)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], received
+
+
+class AioTest(unittest.TestCase):
+    def test_prynt(self):
+        expected = rasterprynt.cat(
+            [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')], printer_model='P950NW')
+
+        async def run():
+            server, port, received = await _serve()
+            async with server:
+                # Freshly opened images, which are not decoded yet, are shared by concurrent jobs
+                for _ in range(10):
+                    images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+                    await asyncio.gather(*[
+                        rasterprynt.aio.prynt(images, '127.0.0.1', port=port, printer_model='P950NW')
+                        for _ in range(5)])
+                while len(received) < 50:
+                    await asyncio.sleep(0.01)
+            return received
+
+        received = asyncio.run(run())
+        self.assertEqual(received, [expected] * 50)
+
+    def test_send_timeout(self):
+        async def run():
+            # Nobody listens on port 9 of this address, so this either fails or times out
+            await rasterprynt.aio.send(b'x', '192.0.2.1', port=9, connect_timeout=0.01)
+
+        with self.assertRaises((OSError, asyncio.TimeoutError)):
+            asyncio.run(run())
+
+    def test_send_write_timeout(self):
+        async def run():
+            connections = []
+
+            async def handle(reader, writer):
+                connections.append(writer)  # Never read
+
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                loop = asyncio.get_running_loop()
+                start = loop.time()
+                with self.assertRaises(asyncio.TimeoutError):
+                    await rasterprynt.aio.send(b'x' * (50 * 1024 * 1024), '127.0.0.1', port=port, write_timeout=0.2)
+                elapsed = loop.time() - start
+                for writer in connections:
+                    writer.close()
+            return elapsed
+
+        self.assertLess(asyncio.run(run()), 5)
+
+    def test_detect_printer_model(self):
+        async def run():
+            server, port, received = await _serve(
+                b'HTTP/1.0 401 Unauthorized\r\n\r\n<html><title>Brother PT-P950NW</title></html>')
+            async with server:
+                model = await rasterprynt.aio.detect_printer_model('127.0.0.1', http_port=port)
+            return model, received
+
+        rasterprynt.printer_cache.clear()
+        model, received = asyncio.run(run())
+        self.assertEqual(model, 'P950NW')
+        self.assertTrue(received[0].startswith(b'GET /admin/default.html HTTP/1.0\r\n'))
+
+    def test_detect_printer_model_offline(self):
+        rasterprynt.printer_cache.clear()
+        self.assertEqual(asyncio.run(rasterprynt.aio.detect_printer_model('127.0.0.1', http_port=1)), 'error')
@@ -0,0 +1,92 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import PIL.Image
+
+import fakeprinter
+import plotimg
+import rasterprynt
+from rasterprynt import batch
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+        for i, img in enumerate(self.images * 2):
+            img.save(os.path.join(self.directory, 'label-%d.png' % i))
+        with open(os.path.join(self.directory, 'notes.txt'), 'w') as f:
+            f.write('not an image')
+
+    def test_sources(self):
+        paths = [os.path.join(self.directory, 'label-%d.png' % i) for i in range(4)]
+        self.assertEqual([label.path for label in batch.read_directory(self.directory)], paths)
+        self.assertEqual([label.path for label in batch.read_paths(io.StringIO('\n'.join(paths) + '\n\n'))], paths)
+
+        csv_fn = os.path.join(self.directory, 'labels.csv')
+        with open(csv_fn, 'w') as f:
+            f.write('image,ip,top_margin,bottom_margin\nlabel-0.png,,,\nlabel-1.png,10.0.0.2,20,4\n')
+        jsonl_fn = os.path.join(self.directory, 'labels.jsonl')
+        with open(jsonl_fn, 'w') as f:
+            f.write(json.dumps({'image': 'label-0.png'}) + '\n')
+            f.write(json.dumps({'image': 'label-1.png', 'ip': '10.0.0.2', 'top_margin': 20, 'bottom_margin': 4}))
+        expected = [
+            batch.Label(paths[0], None, None, None, None),
+            batch.Label(paths[1], '10.0.0.2', 20, 4, None),
+        ]
+        self.assertEqual(list(batch.read_manifest(csv_fn)), expected)
+        self.assertEqual(list(batch.read_manifest(jsonl_fn)), expected)
+
+        with open(csv_fn, 'w') as f:
+            f.write('image,ip\n,10.0.0.1\n')
+        with self.assertRaises(ValueError):
+            list(batch.read_manifest(csv_fn))
+
+    def test_prefetch(self):
+        pulled = []
+
+        def labels():
+            for label in batch.read_directory(self.directory):
+                pulled.append(label)
+                yield label
+
+        prefetched = batch.prefetch(labels(), count=1)
+        label, img = next(prefetched)
+        self.assertEqual(label, pulled[0])
+        self.assertEqual(img.tobytes(), self.images[0].convert(img.mode).tobytes())
+        self.assertLessEqual(len(pulled), 3)
+        prefetched.close()
+
+        missing = [batch.Label(os.path.join(self.directory, 'missing.png'), None, None, None, None)]
+        with self.assertRaises(IOError):
+            list(batch.prefetch(list(batch.read_directory(self.directory)) + missing))
+
+    def test_print_batch(self):
+        labels = list(batch.read_directory(self.directory))
+        labels[2] = labels[2]._replace(top_margin=20)
+        settings = {'printer_model': 'P950NW', 'compression': 'auto'}
+        expected = [
+            rasterprynt.cat(self.images, **settings),
+            rasterprynt.cat(self.images[:1], top_margin=20, **settings),
+            rasterprynt.cat(self.images[1:], **settings),
+        ]
+
+        output = io.BytesIO()
+        self.assertEqual(batch.print_batch(labels, output=output, buffer_size=100, **settings), 4)
+        self.assertEqual(output.getvalue(), b''.join(expected))
+
+        with fakeprinter.FakePrinter() as printer:
+            self.assertEqual(batch.print_batch(labels, printer.host, port=printer.port, **settings), 4)
+            self.assertTrue(printer.wait_for_pages(4))
+            self.assertEqual(
+                [page.raster for page in printer.pages], [page for job in expected for page in plotimg.read_pages(job)])
+            self.assertEqual([page.job for page in printer.pages], [0, 0, 1, 2])
+            self.assertEqual(printer.stats()['connections'], 3)
+
+        with self.assertRaises(ValueError):
+            batch.print_batch(labels, **settings)
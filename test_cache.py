@@ -0,0 +1,55 @@
+import shutil
+import tempfile
+import unittest
+
+import PIL.Image
+import PIL.ImageDraw
+
+import rasterprynt
+from rasterprynt.cache import RenderCache
+
+
+def _label(text):
+    img = PIL.Image.new('RGB', (120, 60), 'white')
+    PIL.ImageDraw.Draw(img).text((5, 20), text, fill='black')
+    return img
+
+
+class RenderCacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = RenderCache(max_bytes=10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        self.assertEqual(cache.get('a'), b'aaaa')
+        cache.put('c', b'cccc')  # evicts b, which has been used least recently
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), b'cccc')
+        cache.put('d', b'd' * 11)  # Too large to cache at all
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.get('a'), b'aaaa')
+        self.assertEqual(cache.stats(), {'hits': 3, 'disk_hits': 0, 'misses': 2, 'entries': 2, 'size': 8})
+
+    def test_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            RenderCache(directory=directory).put('k', b'data')
+            cache = RenderCache(directory=directory)
+            self.assertEqual(cache.get('k'), b'data')
+            self.assertEqual(cache.get('k'), b'data')
+            self.assertEqual((cache.disk_hits, cache.hits, cache.misses), (1, 1, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_render(self):
+        images = [_label('A-1'), _label('B-2'), _label('A-1'), _label('A-1').convert('P')]
+        cache = RenderCache()
+        for printer_model in ('P950NW', '9800PCN'):
+            expected = b''.join(rasterprynt.render(images, printer_model=printer_model))
+            self.assertEqual(b''.join(rasterprynt.render(images, printer_model=printer_model, cache=cache)), expected)
+            self.assertEqual(b''.join(rasterprynt.render(images, printer_model=printer_model, cache=cache)), expected)
+        self.assertEqual(cache.misses, 6)
+        self.assertEqual(cache.hits, 10)
+
+        other_settings = b''.join(rasterprynt.render(images, printer_model='P950NW', top_margin=20, cache=cache))
+        self.assertEqual(other_settings, b''.join(rasterprynt.render(images, printer_model='P950NW', top_margin=20)))
+        self.assertEqual(cache.misses, 9)
@@ -0,0 +1,70 @@
+import time
+import unittest
+
+import PIL.Image
+
+import fakeprinter
+import plotimg
+import rasterprynt
+from rasterprynt.pool import ConnectionPool
+
+
+class FakePrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+
+    def test_print(self):
+        with fakeprinter.FakePrinter() as printer:
+            job = rasterprynt.cat(self.images, printer_model='P950NW', compression='auto')
+            rasterprynt.send(job, printer.host, port=printer.port)
+            self.assertTrue(printer.wait_for_pages(2))
+            self.assertEqual([page.raster for page in printer.pages], plotimg.read_pages(job))
+            stats = printer.stats()
+            self.assertEqual((stats['jobs'], stats['pages'], stats['bytes'], stats['errors']), (1, 2, len(job), 0))
+
+    def test_blank(self):
+        images = [self.images[0], PIL.Image.new('RGB', (20, 10), 'white'), self.images[0]]
+        with fakeprinter.FakePrinter() as printer:
+            job = rasterprynt.cat(images, printer_model='P950NW')
+            rasterprynt.send(job, printer.host, port=printer.port)
+            self.assertTrue(printer.wait_for_pages(3))
+            self.assertEqual([page.raster for page in printer.pages], plotimg.read_pages(job))
+            self.assertEqual(printer.errors, [])
+
+    def test_detect(self):
+        for model in ('P950NW', '9800PCN'):
+            with fakeprinter.FakePrinter(model=model, http_port=0, password=(model == 'P950NW')) as printer:
+                self.assertEqual(rasterprynt._detect_printer_model_uncached(printer.http_host), model)
+
+    def test_print_speed(self):
+        with fakeprinter.FakePrinter(rows_per_second=2000, recv_buffer=4096) as printer:
+            start = time.time()
+            rasterprynt.send(rasterprynt.cat(self.images * 3, printer_model='P950NW'), printer.host, port=printer.port)
+            self.assertTrue(printer.wait_for_pages(6))
+            # 3 * (133 + 185) columns and the margins
+            self.assertGreater(time.time() - start, 3 * 318 / 2000.0)
+
+    def test_reset(self):
+        with fakeprinter.FakePrinter(reset_after=1000, reset_count=1) as printer:
+            with ConnectionPool(port=printer.port) as pool:
+                job = rasterprynt.cat(self.images, printer_model='P950NW')
+                try:
+                    pool.send(job, printer.host)
+                except OSError:
+                    pass  # Depending on timing, the reset is noticed while sending
+                # Otherwise, the pool would not notice the reset before reusing the connection
+                deadline = time.time() + 10
+                while printer.stats()['resets'] < 1 and time.time() < deadline:
+                    time.sleep(0.01)
+                pool.send(job, printer.host)
+                self.assertTrue(printer.wait_for_pages(2))
+                stats = printer.stats()
+                self.assertEqual((stats['connections'], stats['resets'], stats['pages']), (2, 1, 2))
+
+    def test_invalid(self):
+        with fakeprinter.FakePrinter() as printer:
+            rasterprynt.send(b'\x1b@X', printer.host, port=printer.port)
+            deadline = time.time() + 10
+            while not printer.errors and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(printer.errors), 1)
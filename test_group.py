@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import PIL.Image
+
+import fakeprinter
+import plotimg
+import rasterprynt
+from rasterprynt import group
+
+
+class PrinterGroupTest(unittest.TestCase):
+    def setUp(self):
+        self.images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+        # Printers on different loopback addresses, but the same port
+        first = fakeprinter.FakePrinter(host='127.0.0.2')
+        self.printers = [first, fakeprinter.FakePrinter(host='127.0.0.3', port=first.port)]
+        for printer in self.printers:
+            self.addCleanup(printer.close)
+        self.port = first.port
+
+    def test_failover(self):
+        # Nothing listens on 127.0.0.4
+        printer_group = group.PrinterGroup(
+            'station', ['127.0.0.4', '127.0.0.2', '127.0.0.3'], printer_model='P950NW', port=self.port)
+        job = rasterprynt.cat(self.images, printer_model='P950NW')
+        ips = [printer_group.send(job) for _ in range(4)]
+        self.assertNotIn('127.0.0.4', ips)
+        for printer in self.printers:
+            jobs = ips.count(printer.host)
+            self.assertTrue(printer.wait_for_pages(2 * jobs))
+            self.assertEqual([page.raster for page in printer.pages], plotimg.read_pages(job) * jobs)
+
+        stats = printer_group.stats()
+        self.assertEqual(stats['127.0.0.4']['failures'], 1)
+        self.assertTrue(stats['127.0.0.4']['down'])
+        self.assertEqual(sum(s['jobs'] for s in stats.values()), 4)
+        self.assertEqual(sum(s['in_flight'] for s in stats.values()), 0)
+
+        printer_group = group.PrinterGroup('down', ['127.0.0.4'], printer_model='P950NW', port=self.port)
+        with self.assertRaises(OSError):
+            printer_group.send(job)
+
+    def test_sequential(self):
+        # Slow printers: a job has been received long before it has been printed
+        first = fakeprinter.FakePrinter(host='127.0.0.5', rows_per_second=500)
+        printers = [first, fakeprinter.FakePrinter(host='127.0.0.6', port=first.port, rows_per_second=500)]
+        for printer in printers:
+            self.addCleanup(printer.close)
+        printer_group = group.PrinterGroup(
+            'station', ['127.0.0.5', '127.0.0.6'], printer_model='P950NW', port=first.port)
+
+        job = rasterprynt.cat(self.images, printer_model='P950NW')
+        ips = [printer_group.send(job) for _ in range(10)]
+        self.assertEqual([ips.count(ip) for ip in printer_group.ips], [5, 5])
+        for _ in range(6):
+            rasterprynt.prynt(self.images, printer_group, stream=True)
+        stats = printer_group.stats()
+        self.assertEqual([stats[ip]['jobs'] for ip in printer_group.ips], [8, 8])
+        self.assertEqual([stats[ip]['in_flight'] for ip in printer_group.ips], [0, 0])
+        self.assertEqual([stats[ip]['jobs_in_flight'] for ip in printer_group.ips], [0, 0])
+
+    def test_concurrent_streams(self):
+        printer_group = group.PrinterGroup(
+            'station', ['127.0.0.2', '127.0.0.3'], printer_model='P950NW', port=self.port)
+        job = rasterprynt.cat(self.images, printer_model='P950NW')
+        # Every job is only sent once all jobs are connected, so that they are all in flight at the same time
+        barrier = threading.Barrier(4, timeout=10)
+
+        def chunks():
+            barrier.wait()
+            yield job
+
+        threads = [threading.Thread(target=printer_group.send_stream, args=(chunks(),)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = printer_group.stats()
+        self.assertEqual([stats[ip]['jobs'] for ip in printer_group.ips], [2, 2])
+        self.assertEqual([stats[ip]['in_flight'] for ip in printer_group.ips], [0, 0])
+        self.assertEqual([stats[ip]['jobs_in_flight'] for ip in printer_group.ips], [0, 0])
+
+    def test_candidates(self):
+        printer_group = group.PrinterGroup('station', ['10.0.0.1', '10.0.0.2', '10.0.0.3'], print_rate=4000)
+        first, second, third = printer_group._members
+        first.throughput, second.throughput = 1000, 100000
+        now = time.time()
+
+        def order(size):
+            return [m.ip for m in printer_group._candidates(size, now)]
+
+        # Printers are assumed to print at most print_rate; ties are broken by the least recently used printer
+        self.assertEqual(order(1000), ['10.0.0.2', '10.0.0.3', '10.0.0.1'])
+        second.last_used = 1
+        self.assertEqual(order(1000), ['10.0.0.3', '10.0.0.2', '10.0.0.1'])
+        third.backlog, third.updated = 2000, now
+        second.backlog, second.updated = 5000, now
+        self.assertEqual(order(1000), ['10.0.0.3', '10.0.0.1', '10.0.0.2'])
+        # The backlog shrinks while the printers print
+        self.assertEqual(printer_group._backlog(second, now + 1), 1000)
+        self.assertEqual([m.ip for m in printer_group._candidates(1000, now + 1)], ['10.0.0.3', '10.0.0.2', '10.0.0.1'])
+        third.down_until = now + 10
+        self.assertEqual(order(1000), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+    def test_prynt(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        fn = os.path.join(directory, 'groups.json')
+        with open(fn, 'w') as f:
+            json.dump({'station': {'ips': ['127.0.0.2', '127.0.0.3'], 'printer_model': 'P950NW'}}, f)
+        printer_group = group.load_groups(fn, port=self.port)['station']
+        self.assertEqual(printer_group.ips, ['127.0.0.2', '127.0.0.3'])
+
+        rasterprynt.prynt(self.images, printer_group, compression='auto')
+        rasterprynt.prynt(self.images, printer_group, compression='auto', stream=True)
+        expected = plotimg.read_pages(rasterprynt.cat(self.images, printer_model='P950NW', compression='auto'))
+        for printer in self.printers:
+            pages = printer_group.stats()[printer.host]['jobs'] * 2
+            self.assertTrue(printer.wait_for_pages(pages))
+            self.assertEqual([page.raster for page in printer.pages], expected * (pages // 2))
@@ -0,0 +1,117 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import PIL.Image
+
+import rasterprynt
+from rasterprynt import jobfile
+from rasterprynt.cache import image_hash
+
+
+class JobFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compile_replay(self):
+        for printer_model in ('P950NW', '9800PCN'):
+            fn = os.path.join(self.directory, 'job-%s.rpj' % printer_model)
+            settings = {'printer_model': printer_model, 'compression': 'auto', 'top_margin': 10}
+            index = jobfile.compile_job(self.images, fn, **settings)
+            self.assertEqual(index['printer_model'], printer_model)
+            self.assertEqual(index['settings'], {'compression': 'auto', 'top_margin': 10})
+            self.assertEqual([p['width'] for p in index['pages']], [133, 185])
+
+            with jobfile.JobFile(fn) as job:
+                self.assertEqual(job.index, index)
+                self.assertEqual(job.page_count, 2)
+                self.assertEqual(job.verify(), [])
+                self.assertEqual(
+                    b''.join(job.chunks()), rasterprynt.cat(self.images, **settings))
+                self.assertEqual(
+                    b''.join(job.chunks([1])), rasterprynt.cat(self.images[1:], **settings))
+                self.assertEqual(
+                    b''.join(job.chunks([1, 0, 1])),
+                    rasterprynt.cat([self.images[1], self.images[0], self.images[1]], **settings))
+
+    def test_trim(self):
+        img = PIL.Image.new('L', (100, 50), 'white')
+        img.paste(0, (30, 10, 70, 20))
+        fn = os.path.join(self.directory, 'job.rpj')
+        index = jobfile.compile_job([img], fn, printer_model='P950NW', trim=True)
+        trimmed = img.crop((30, 0, 70, 50))
+        self.assertEqual(index['settings'], {'trim': True})
+        self.assertEqual(index['pages'][0]['width'], 40)
+        self.assertEqual(index['pages'][0]['image_sha256'], image_hash(trimmed))
+        with jobfile.JobFile(fn) as job:
+            self.assertEqual(b''.join(job.chunks()), rasterprynt.cat([trimmed], printer_model='P950NW'))
+
+    def test_invalid(self):
+        fn = os.path.join(self.directory, 'job.rpj')
+        jobfile.compile_job(self.images, fn, printer_model='P950NW')
+        with open(fn, 'rb') as f:
+            data = f.read()
+        with open(fn, 'wb') as f:
+            f.write(data[:-10])
+        with self.assertRaises(ValueError):
+            jobfile.JobFile(fn)
+
+    def test_replay(self):
+        fn = os.path.join(self.directory, 'job.rpj')
+        jobfile.compile_job(self.images, fn, printer_model='P950NW')
+
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+
+        def _serve():
+            conn, _ = server.accept()
+            with conn:
+                received.append(b''.join(iter(lambda: conn.recv(65536), b'')))
+        thread = threading.Thread(target=_serve)
+        thread.start()
+        try:
+            jobfile.replay(fn, '127.0.0.1', pages=[0], port=server.getsockname()[1])
+            thread.join()
+        finally:
+            server.close()
+        self.assertEqual(received, [rasterprynt.cat(self.images[:1], printer_model='P950NW')])
+
+    def test_replay_error(self):
+        fn = os.path.join(self.directory, 'job.rpj')
+        jobfile.compile_job(self.images, fn, printer_model='P950NW')
+
+        class BrokenSocket(object):
+            def sendall(self, data):
+                raise ConnectionResetError('connection reset')
+
+            def close(self):
+                pass
+
+        with unittest.mock.patch('socket.create_connection', return_value=BrokenSocket()):
+            with self.assertRaises(ConnectionResetError):
+                jobfile.replay(fn, '127.0.0.1')
+
+    def test_parse_page_ranges(self):
+        self.assertEqual(jobfile.parse_page_ranges('1,3-5,2'), [0, 2, 3, 4, 1])
+        for spec in ('0', '0-2', '3-1', '-1', 'x'):
+            with self.assertRaises(ValueError):
+                jobfile.parse_page_ranges(spec)
+
+        fn = os.path.join(self.directory, 'job.rpj')
+        jobfile.compile_job(self.images, fn, printer_model='P950NW')
+        with jobfile.JobFile(fn) as job:
+            for pages in ([2], [-1], [0, 5]):
+                with self.assertRaises(ValueError):
+                    list(job.chunks(pages))
+        with self.assertRaises(ValueError):
+            jobfile.replay(fn, '192.0.2.1', pages=[2])
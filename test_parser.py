@@ -0,0 +1,57 @@
+import random
+import unittest
+
+import PIL.Image
+
+import rasterprynt
+from rasterprynt import parser
+
+
+def _normalize(events):
+    # memoryviews do not compare by value in namedtuples
+    return [
+        tuple(bytes(v) if isinstance(v, memoryview) else v for v in event) + (type(event).__name__,)
+        for event in events]
+
+
+class ParserTest(unittest.TestCase):
+    def setUp(self):
+        images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+        self.bc = rasterprynt.cat(images, printer_model='P950NW', compression='auto')
+
+    def test_parse(self):
+        events = list(parser.parse(self.bc))
+        self.assertEqual(
+            [type(e) for e in events[:5]],
+            [parser.Init, parser.ModeSwitch, parser.VariousMode, parser.Margin, parser.PrintInfo])
+        self.assertEqual(events[1].mode, parser.MODE_RASTER)
+        self.assertEqual(events[4].command, 'z')
+        self.assertEqual(events[5], parser.Compression(parser.COMPRESSION_TIFF))
+        self.assertEqual(sum(isinstance(e, parser.FormFeed) for e in events), 1)
+        # 86 + 40 blank columns are sent as Z
+        self.assertEqual(sum(isinstance(e, parser.RasterRow) for e in events), 133 + 185 - (86 + 40))
+        self.assertEqual(events[-1], parser.Print(True))
+
+        row = next(e for e in events if isinstance(e, parser.RasterRow))
+        self.assertIs(row.data.obj, self.bc)  # Not copied
+        self.assertEqual(len(row.decode()), 408 // 8)
+
+    def test_chunks(self):
+        expected = _normalize(parser.parse(self.bc))
+        rnd = random.Random(1)
+        for max_chunk in (1, 2, 5, 100, 10000):
+            chunks = []
+            p = 0
+            while p < len(self.bc):
+                size = rnd.randint(1, max_chunk)
+                chunks.append(self.bc[p:p + size])
+                p += size
+            self.assertEqual(_normalize(parser.parse_stream(chunks)), expected)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            list(parser.parse(self.bc[:-100]))
+        with self.assertRaises(ValueError):
+            list(parser.parse(b'\x1b@X'))
+        with self.assertRaises(NotImplementedError):
+            list(parser.parse(b'\x1b@\x1biz' + b'\x00' * 10))  # Only allowed in raster mode
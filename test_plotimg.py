@@ -1,3 +1,7 @@
+import collections
+import io
+import socket
+import struct
 import unittest
 
 import plotimg
@@ -18,3 +22,111 @@ class PlotimgTest(unittest.TestCase):
             b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
             b'\x22\x22\x23\xBA\xBF\xA2\x22\x2B'
         )
+
+    def test_read_rows(self):
+        bc = (
+            b'\x00' * 10 +
+            b'\x1b@\x1bia\x01\x1biM\x00\x1bid\x01\x00M\x00' +
+            b'Z' +
+            b'G\x02\x00\x80\x01' +
+            b'G\x02\x00\xf0\x00' +
+            b'\x1a')
+        raster = plotimg.read_rows(bc)
+        self.assertEqual(raster.width, 16)
+        # One row of margin on both sides, rows are mirrored
+        self.assertEqual(raster.rows, [b'\x00\x00', b'\x00\x00', b'\x80\x01', b'\x00\x0f', b'\x00\x00'])
+        self.assertTrue(raster.pixel(12, 3))
+        self.assertFalse(raster.pixel(11, 3))
+        self.assertEqual(
+            plotimg.plotimg(plotimg.Raster(8, [b'\x81'])),
+            b'P1\n8 1\n1 0 0 0 0 0 0 1')
+
+    def test_read_pages(self):
+        import PIL.Image
+
+        import rasterprynt
+
+        images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png'), PIL.Image.open('example1.png')]
+        bc = rasterprynt.cat(images, printer_model='P950NW', compression='auto')
+        pages = plotimg.read_pages(bc)
+        self.assertEqual([p.height for p in pages], [img.width + 16 for img in images])
+        self.assertEqual([p.width for p in pages], [408] * 3)
+        self.assertEqual(pages[0], pages[2])
+        self.assertEqual(b''.join(b''.join(p.rows) for p in pages), b''.join(plotimg.read_rows(bc).rows))
+
+        p4 = plotimg.plotimg_p4(pages[1])
+        self.assertEqual(p4, b'P4\n408 201\n' + b''.join(pages[1].rows))
+
+        img = plotimg.raster_image(pages[1])
+        self.assertEqual(img.size, (408, 201))
+        self.assertEqual(img.getpixel((0, 0)), 255)
+        x, y = next((x, y) for y in range(201) for x in range(408) if pages[1].pixel(x, y))
+        self.assertEqual(img.getpixel((x, y)), 0)
+        self.assertEqual(plotimg.page_filename('out/label.pbm', 2), 'out/label-2.pbm')
+
+    def test_read_pages_blank(self):
+        import PIL.Image
+
+        import rasterprynt
+
+        img = PIL.Image.open('example1.png')
+        blank = PIL.Image.new('RGB', (20, 10), 'white')
+        for printer_model, width in (('P950NW', 408), ('9800PCN', 312)):
+            for images in ([blank], [img, blank, img], [blank, img]):
+                pages = plotimg.read_pages(rasterprynt.cat(images, printer_model=printer_model))
+                self.assertEqual([p.width for p in pages], [width] * len(images))
+                blank_page = pages[images.index(blank)]
+                self.assertEqual(blank_page.rows, [bytes(width // 8)] * blank_page.height)
+                self.assertGreaterEqual(blank_page.height, blank.width)
+
+    def _tcp_frame(self, sport, seq, payload, flags=0x18, dport=9100):
+        tcp = struct.pack('!HHIIBBHHH', sport, dport, seq, 0, 5 << 4, flags, 65535, 0, 0) + payload
+        ip = struct.pack(
+            '!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0, 64, 6, 0,
+            socket.inet_aton('10.0.0.1'), socket.inet_aton('10.0.0.2')) + tcp
+        return b'\x00' * 12 + b'\x08\x00' + ip
+
+    def _segments(self, data1, data2):
+        # Two connections, with reordering and retransmissions
+        frames = [self._tcp_frame(1000, 99, b'', flags=0x02)]
+        chunks = [(100 + i, data1[i:i + 500]) for i in range(0, len(data1), 500)]
+        chunks[1], chunks[2] = chunks[2], chunks[1]
+        chunks.insert(4, chunks[3])
+        chunks.insert(6, (chunks[5][0] - 10, data1[chunks[5][0] - 110:chunks[5][0] - 100 + 20]))
+        frames.extend(self._tcp_frame(1000, seq, payload) for seq, payload in chunks)
+        frames.append(self._tcp_frame(1001, 2 ** 32 - 5, b'', flags=0x02))
+        frames.append(self._tcp_frame(1001, 2 ** 32 - 4, data2))
+        frames.append(self._tcp_frame(9100, 0, b'response', dport=1000))
+        return frames
+
+    def test_pcap(self):
+        import PIL.Image
+
+        import rasterprynt
+
+        data1 = rasterprynt.cat([PIL.Image.open('example1.png')], printer_model='P950NW')
+        data2 = rasterprynt.cat([PIL.Image.open('example2.png')], printer_model='P950NW', compression='tiff')
+        frames = self._segments(data1, data2)
+
+        pcap = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1) + b''.join(
+            struct.pack('<IIII', 0, 0, len(f), len(f)) + f for f in frames)
+
+        def block(block_type, body):
+            body += b'\x00' * (-len(body) % 4)
+            return struct.pack('>II', block_type, len(body) + 12) + body + struct.pack('>I', len(body) + 12)
+
+        pcapng = (
+            block(0x0a0d0d0a, struct.pack('>IHHq', 0x1a2b3c4d, 1, 0, -1)) +
+            block(1, struct.pack('>HHI', 1, 0, 65535)) +
+            b''.join(block(6, struct.pack('>IIIII', 0, 0, 0, len(f), len(f)) + f) for f in frames))
+
+        self.assertEqual(plotimg.detect_format(pcap), 'pcap')
+        self.assertEqual(plotimg.detect_format(pcapng), 'pcapng')
+        for capture in (pcap, pcapng):
+            streams = collections.OrderedDict()
+            for connection, data in plotimg.pcap_streams(io.BytesIO(capture)):
+                streams.setdefault(connection, []).append(data)
+            self.assertEqual(list(streams), [('10.0.0.1', 1000, '10.0.0.2', 9100, 0),
+                                             ('10.0.0.1', 1001, '10.0.0.2', 9100, 0)])
+            self.assertEqual([b''.join(chunks) for chunks in streams.values()], [data1, data2])
+            self.assertEqual(plotimg.parse_pcap(capture), data1 + data2)
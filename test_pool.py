@@ -0,0 +1,168 @@
+import socket
+import threading
+import time
+import unittest
+import unittest.mock
+
+import PIL.Image
+
+import rasterprynt
+from rasterprynt import parser
+from rasterprynt.pool import PREAMBLE, ConnectionPool, _Connection
+
+
+class Server(object):
+    # Records the data received on every connection; drop() closes all open connections
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.connections = []
+        self.received = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections.append(conn)
+                self.received.append(bytearray())
+                received = self.received[-1]
+            thread = threading.Thread(target=self._read, args=(conn, received))
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, conn, received):
+        while True:
+            try:
+                chunk = conn.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            with self.lock:
+                received += chunk
+
+    def wait_for(self, sizes, timeout=10):
+        deadline = time.time() + timeout
+        while [len(r) for r in self.received] != sizes and time.time() < deadline:
+            time.sleep(0.01)
+
+    def drop(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            self.connections = []
+
+    def close(self):
+        self.drop()
+        self.sock.close()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.addCleanup(self.server.close)
+        img = PIL.Image.open('example1.png')
+        self.job = rasterprynt.cat([img], printer_model='P950NW')
+
+    def test_reuse(self):
+        with ConnectionPool(port=self.server.port) as pool:
+            pool.send(self.job, '127.0.0.1')
+            pool.send(self.job, '127.0.0.1')
+            rasterprynt.prynt(
+                [PIL.Image.open('example2.png')], '127.0.0.1', printer_model='P950NW', pool=pool, stream=True)
+            self.assertEqual((pool.connects, pool.reuses), (1, 2))
+            self.assertEqual(pool.idle_count('127.0.0.1'), 1)
+
+            second = len(self.job) - len(PREAMBLE)
+            third = len(rasterprynt.cat([PIL.Image.open('example2.png')], printer_model='P950NW')) - len(PREAMBLE)
+            self.server.wait_for([len(self.job) + second + third])
+            received = bytes(self.server.received[0])
+            self.assertEqual(received[:len(self.job)], self.job)
+            self.assertEqual(received[len(self.job):len(self.job) + second], self.job[len(PREAMBLE):])
+
+            # All jobs can be parsed as one stream
+            events = list(parser.parse(received))
+            self.assertEqual(sum(isinstance(e, parser.Print) for e in events), 3)
+
+    def test_health_check_keeps_timeout(self):
+        with ConnectionPool(port=self.server.port, socket_timeout=7) as pool:
+            pool.send(self.job, '127.0.0.1')
+            self.server.wait_for([len(self.job)])
+            # Status information from the printer makes the health check read from the socket
+            self.server.connections[0].sendall(b'\x80')
+            time.sleep(0.05)
+            with pool.connection('127.0.0.1') as (sock, initialized):
+                self.assertTrue(initialized)
+                self.assertEqual(sock.gettimeout(), 7)
+
+    def test_reconnect(self):
+        with ConnectionPool(port=self.server.port) as pool:
+            pool.send(self.job, '127.0.0.1')
+            self.server.wait_for([len(self.job)])
+            self.server.drop()
+            time.sleep(0.05)
+
+            pool.send(self.job, '127.0.0.1')  # Found dead in the health check
+            self.server.wait_for([len(self.job), len(self.job)])
+            self.assertEqual(bytes(self.server.received[1]), self.job)
+            self.assertEqual(pool.connects, 2)
+
+    def test_retry(self):
+        class BrokenSocket(object):
+            # A pooled connection whose first send fails with first_error, or which fails after 10 bytes
+            def __init__(self, first_error=None):
+                self.first_error = first_error
+                self.closed = False
+
+            def send(self, data):
+                if self.first_error is not None:
+                    raise self.first_error
+                return 10
+
+            def sendall(self, data):
+                raise ConnectionResetError('connection reset')
+
+            def close(self):
+                self.closed = True
+
+        address = ('127.0.0.1', self.server.port)
+        with unittest.mock.patch('rasterprynt.pool._is_alive', return_value=True):
+            with ConnectionPool(port=self.server.port) as pool:
+                # Nothing written: sent again on a new connection
+                sock = BrokenSocket(ConnectionResetError('connection reset'))
+                pool._idle[address].append(_Connection(sock, address))
+                pool.send(self.job, '127.0.0.1')
+                self.server.wait_for([len(self.job)])
+                self.assertEqual(bytes(self.server.received[0]), self.job)
+                self.assertEqual((pool.reconnects, pool.connects), (1, 1))
+                self.assertTrue(sock.closed)
+
+                # Partially written, or timed out: raised
+                for sock in (BrokenSocket(), BrokenSocket(socket.timeout('timed out'))):
+                    pool._idle[address] = [_Connection(sock, address)]
+                    with self.assertRaises(OSError):
+                        pool.send(self.job, '127.0.0.1')
+                    self.assertEqual((pool.reconnects, pool.connects), (1, 1))
+                    self.assertTrue(sock.closed)
+
+    def test_idle_timeout(self):
+        with ConnectionPool(port=self.server.port, idle_timeout=0.05) as pool:
+            pool.send(self.job, '127.0.0.1')
+            self.assertEqual(pool.idle_count(), 1)
+            deadline = time.time() + 10
+            while pool.idle_count() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(pool.idle_count(), 0)
+
+            pool.send(self.job, '127.0.0.1')
+            self.assertEqual(pool.connects, 2)
@@ -1,5 +1,16 @@
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
+import PIL.Image
+
+import plotimg
 import rasterprynt
 
 
@@ -22,3 +33,230 @@ class RasterpryntTest(unittest.TestCase):
             b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
             b'\x22\x22\x23\xBA\xBF\xA2\x22\x2B'
         ),  b'\xED\x00\xff\x22\x05\x23\xBA\xBF\xA2\x22\x2B')
+
+    def _sample_images(self):
+        import PIL.Image
+        import PIL.ImageDraw
+
+        res = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+        for mode in ('RGB', 'RGBA', 'L', 'P', '1', 'LA'):
+            for size in ((30, 100), (17, 416), (5, 600), (1, 20)):
+                img = PIL.Image.new(mode, size, 'white')
+                draw = PIL.ImageDraw.Draw(img)
+                draw.line((0, 0) + size, fill='black', width=3)
+                draw.ellipse((0, 2, size[0] // 2, size[1] // 2), fill='black' if mode == '1' else 'gray')
+                res.append(img)
+        # Values around the threshold
+        gradient = PIL.Image.new('RGB', (3, 256))
+        gradient.putdata([(v, v, v + d) for v in range(256) for d in (-1, 0, 1)])
+        res.append(gradient)
+        res.append(gradient.convert('L'))
+        res.append(PIL.Image.new('L', (0, 20)))
+        return res
+
+    def test_raster_bitmap(self):
+        for img in self._sample_images():
+            for stripe_size in (312, 408, 536):
+                self.assertEqual(
+                    rasterprynt._raster_bitmap(img, stripe_size),
+                    rasterprynt._raster_bitmap_reference(img, stripe_size),
+                    'mismatch for %r in stripe size %d' % (img, stripe_size))
+
+    def test_compress_tiff_row(self):
+        rnd = random.Random(42)
+        samples = [b'', b'a', b'\x00' * 67, b'\xff' * 51, b'aaaabbbbbbbccccaadef']
+        for _ in range(500):
+            samples.append(bytes(bytearray(rnd.choice(b'\x00\x00\x01\xff') for _ in range(rnd.randint(1, 128)))))
+
+        for row in samples:
+            self.assertEqual(rasterprynt._compress_tiff_row(row), b''.join(rasterprynt._compress_tiff(row)))
+            self.assertEqual(b''.join(plotimg.tiff_uncompress(rasterprynt._compress_tiff_row(row))), row)
+
+        # Longer than a single block
+        for row in (b'\x00' * 300, b'\x00' * 129, bytes(bytearray(range(256))) * 2, b'ab' * 200 + b'c' * 200):
+            self.assertEqual(b''.join(plotimg.tiff_uncompress(rasterprynt._compress_tiff_row(row))), row)
+
+    def test_render_compression(self):
+        images = self._sample_images()[:4]
+        for printer_model in ('P950NW', '9800PCN'):
+            raw = b''.join(rasterprynt.render(images, printer_model=printer_model, compression='raw'))
+            expected_rows = plotimg.read_rows(raw)
+            for compression in ('tiff', 'auto'):
+                data = b''.join(rasterprynt.render(images, printer_model=printer_model, compression=compression))
+                self.assertLess(len(data), len(raw))
+                self.assertEqual(plotimg.read_rows(data), expected_rows)
+
+    def test_render_tiles(self):
+        images = self._sample_images()
+        for compression in ('raw', 'tiff', 'auto'):
+            expected = rasterprynt.cat(images, printer_model='P950NW', compression=compression)
+            for tile_width in (1, 7, 64):
+                data = rasterprynt.cat(images, printer_model='P950NW', compression=compression, tile_width=tile_width)
+                if compression == 'auto':
+                    self.assertEqual(plotimg.read_rows(data), plotimg.read_rows(expected))
+                else:
+                    self.assertEqual(data, expected)
+
+    def test_render_blank_rows(self):
+        img = PIL.Image.new('L', (100, 50), 'white')
+        img.paste(0, (30, 10, 40, 20))
+        img.paste(0, (60, 10, 70, 20))
+        for compression in ('raw', 'tiff'):
+            data = rasterprynt.cat(
+                [img], printer_model='P950NW', compression=compression, top_margin=0, bottom_margin=0)
+            self.assertEqual(data.count(b'G'), 20)
+            bitmap = rasterprynt._raster_bitmap_reference(img, 408)
+            self.assertEqual(
+                plotimg.read_rows(data),
+                plotimg._make_raster([bitmap[pos:pos + 51] for pos in range(0, len(bitmap), 51)], 0, False))
+
+            trimmed = rasterprynt.cat([img], printer_model='P950NW', compression=compression, trim=True)
+            self.assertEqual(trimmed, rasterprynt.cat(
+                [img.crop((30, 0, 70, 50))], printer_model='P950NW', compression=compression))
+
+        blank = rasterprynt.cat([PIL.Image.new('RGB', (10, 10), 'white')], printer_model='P950NW', trim=True)
+        self.assertEqual(blank, rasterprynt.cat([PIL.Image.new('RGB', (0, 10))], printer_model='P950NW'))
+
+    def test_job(self):
+        images = self._sample_images()
+        cache = rasterprynt.RenderCache()
+        for printer_model in ('P950NW', '9800PCN'):
+            for settings in ({}, {'compression': 'auto'}, {'tile_width': 7}, {'trim': True}, {'cache': cache}):
+                expected = b''.join(rasterprynt.render(images, printer_model=printer_model, **settings))
+                job = rasterprynt.Job(images, printer_model=printer_model, **settings)
+                self.assertEqual(job.job_size(), len(expected))
+                buf = bytearray(b'-' * (len(expected) + 10))
+                self.assertEqual(job.render_into(buf, 5), len(expected) + 5)
+                self.assertEqual(bytes(buf), b'-' * 5 + expected + b'-' * 5)
+
+        with self.assertRaises(ValueError):
+            job.render_into(bytearray(job.job_size()), 1)
+
+    def test_coalesce(self):
+        chunks = [b'a', b'bc', b'', b'defg', b'h']
+        self.assertEqual(list(rasterprynt._coalesce(chunks, 3)), [b'abc', b'defg', b'h'])
+        self.assertEqual(list(rasterprynt._coalesce(chunks, 100)), [b'abcdefgh'])
+        self.assertEqual(list(rasterprynt._coalesce([], 100)), [])
+
+    def test_send_buffers(self):
+        data = b''.join(rasterprynt.render(self._sample_images(), printer_model='P950NW'))
+        sock, peer = socket.socketpair()
+        received = []
+
+        def receive():
+            while True:
+                chunk = peer.recv(4096)
+                if not chunk:
+                    break
+                received.append(chunk)
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        with sock:
+            rasterprynt._send_buffers(sock, rasterprynt._coalesce(chunks, 1000))
+        receiver.join()
+        peer.close()
+        self.assertEqual(b''.join(received), data)
+
+    def test_send_buffers_error(self):
+        class BrokenSocket(object):
+            def sendall(self, data):
+                raise socket.error('connection reset')
+
+        with self.assertRaises(socket.error):
+            rasterprynt._send_buffers(BrokenSocket(), (b'x' * 100 for _ in range(1000)), queue_size=2)
+
+    def test_render_workers(self):
+        images = self._sample_images()
+        for printer_model in ('P950NW', '9800PCN'):
+            for compression in ('raw', 'auto'):
+                expected = rasterprynt.cat(images, printer_model=printer_model, compression=compression)
+                self.assertEqual(
+                    rasterprynt.cat(images, printer_model=printer_model, compression=compression, workers=3),
+                    expected)
+
+        cache = rasterprynt.RenderCache()
+        expected = rasterprynt.cat(images, printer_model='P950NW')
+        self.assertEqual(rasterprynt.cat(images, printer_model='P950NW', workers=2, cache=cache), expected)
+        self.assertEqual(rasterprynt.cat(images, printer_model='P950NW', workers=2, cache=cache), expected)
+        self.assertEqual(cache.hits, len(images))
+
+    def test_observer(self):
+        images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+        cache = rasterprynt.RenderCache()
+        rasterprynt.cat(images[:1], printer_model='P950NW', compression='auto', cache=cache)
+
+        events = []
+        profile = rasterprynt.Profile()
+
+        def observer(event, info):
+            events.append((event, info))
+            profile(event, info)
+
+        with self.assertLogs('rasterprynt', 'DEBUG'):
+            rasterprynt.cat(images, printer_model='P950NW', compression='auto', cache=cache, observer=observer)
+        self.assertEqual([event for event, _ in events], ['image', 'image'])
+        cached, rendered = events[0][1], events[1][1]
+        self.assertTrue(cached['cached'])
+        self.assertEqual(rendered['pixels'], 185 * 185)
+        self.assertEqual(rendered['raw_bytes'], 185 * 51)
+        self.assertEqual(rendered['compression'], 'tiff')
+        self.assertLess(rendered['bytes'], rendered['raw_bytes'])
+        self.assertEqual((profile.images, profile.cached_images), (2, 1))
+        self.assertIn('rasterize', profile.report())
+
+        events = []
+        rasterprynt.cat(images, printer_model='P950NW', workers=2, observer=observer)
+        self.assertEqual([info['compression'] for _, info in events], ['raw', 'raw'])
+
+    def test_printer_model_cache(self):
+        cache = rasterprynt.PrinterModelCache()
+        now = time.time()
+        cache.set('10.0.0.1', 'P950NW', now=now)
+        cache.set('10.0.0.2', 'error', now=now)
+        self.assertEqual(cache.get('10.0.0.1', now=now + 10), 'P950NW')
+        self.assertEqual(cache.get('10.0.0.1', now=now + rasterprynt.CACHE_TIMEOUT + 1), None)
+        self.assertEqual(cache.get('10.0.0.2', now=now + 10), 'error')
+        self.assertEqual(cache.get('10.0.0.2', now=now + rasterprynt.ERROR_CACHE_TIMEOUT + 1), None)
+        self.assertEqual(cache.get('10.0.0.3'), None)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'models.json')
+        rasterprynt.PrinterModelCache(path).set('10.0.0.1', '9800PCN')
+        self.assertEqual(rasterprynt.PrinterModelCache(path).get('10.0.0.1'), '9800PCN')
+
+    def test_detect_printer_model_cached(self):
+        rasterprynt.printer_cache.clear()
+        self.addCleanup(rasterprynt.printer_cache.clear)
+        models = {'10.0.0.1': 'P950NW', '10.0.0.2': '9800PCN'}
+
+        def detect(ip, timeout):
+            if ip not in models:
+                raise rasterprynt.URLError('offline')
+            return models[ip]
+
+        with unittest.mock.patch('rasterprynt._detect_printer_model_uncached', side_effect=detect) as mock:
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(
+                    rasterprynt.detect_many(['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.1']),
+                    {'10.0.0.1': 'P950NW', '10.0.0.2': '9800PCN', '10.0.0.3': 'error'})
+            self.assertEqual(mock.call_count, 3)
+
+            self.assertEqual(rasterprynt.detect_printer_model('10.0.0.1'), 'P950NW')
+            self.assertEqual(rasterprynt.detect_printer_model('10.0.0.3'), 'error')
+            self.assertEqual(mock.call_count, 3)
+
+    def test_detect_many_queued(self):
+        rasterprynt.printer_cache.clear()
+        self.addCleanup(rasterprynt.printer_cache.clear)
+        ips = ['10.0.1.%d' % i for i in range(20)]
+
+        def detect(ip, timeout):
+            time.sleep(timeout / 2)  # Every printer answers in time
+            return 'P950NW'
+
+        # Only 4 printers are asked at a time, so all of them together take longer than timeout
+        with unittest.mock.patch('rasterprynt._detect_printer_model_uncached', side_effect=detect):
+            self.assertEqual(rasterprynt.detect_many(ips, timeout=0.1, max_workers=4), dict.fromkeys(ips, 'P950NW'))
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fakeprinter
+import plotimg
+import rasterprynt
+from rasterprynt import server
+
+
+class PrintDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.printer = fakeprinter.FakePrinter()
+        self.addCleanup(self.printer.close)
+        self.image_files = []
+        for fn in ('example1.png', 'example2.png'):
+            with open(fn, 'rb') as f:
+                self.image_files.append(f.read())
+
+    def _start(self, address):
+        daemon = server.PrintDaemon(address, port=self.printer.port)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+
+        def _stop():
+            daemon.shutdown()
+            thread.join()
+            daemon.close()
+        self.addCleanup(_stop)
+        return daemon
+
+    def _check(self, address):
+        settings = {'printer_model': 'P950NW', 'compression': 'auto', 'top_margin': 12}
+        result = server.submit(address, self.image_files, self.printer.host, **settings)
+        self.assertEqual(result, {'pages': 2})
+        server.submit(address, self.image_files[:1], self.printer.host, **settings)
+        self.assertTrue(self.printer.wait_for_pages(3))
+
+        import PIL.Image
+        images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+        expected = plotimg.read_pages(rasterprynt.cat(images + images[:1], **settings))
+        self.assertEqual([page.raster for page in self.printer.pages], expected)
+
+        status = server.server_status(address)
+        self.assertEqual(status['jobs_done'], 2)
+        self.assertEqual(status['connections']['connects'], 1)
+        self.assertEqual(status['cache']['hits'], 1)
+
+    def test_tcp(self):
+        daemon = self._start('127.0.0.1:0')
+        self._check(daemon.address)
+
+    def test_unix(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        daemon = self._start('unix:' + os.path.join(directory, 'rasterprynt.sock'))
+        self._check(daemon.address)
+
+    def test_errors(self):
+        daemon = self._start('127.0.0.1:0')
+        with self.assertRaises(server.ServerError):
+            server.submit(daemon.address, [b'not an image'], self.printer.host, printer_model='P950NW')
+        with self.assertRaises(server.ServerError):
+            server.submit(daemon.address, self.image_files, self.printer.host, compression='zip')
+        self.printer.close()
+        with self.assertRaises(server.ServerError):
+            server.submit(daemon.address, self.image_files, self.printer.host, printer_model='P950NW')
+        self.assertEqual(server.server_status(daemon.address)['jobs_failed'], 1)
@@ -0,0 +1,85 @@
+import socket
+import threading
+import time
+import unittest
+
+import PIL.Image
+
+import rasterprynt
+from rasterprynt.spooler import Spooler
+
+
+class FakePrinter(object):
+    # Accepts connections on a local port and records the data of each connection
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.jobs = []
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                chunks = []
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                self.jobs.append(b''.join(chunks))
+
+    def wait_for_jobs(self, count, timeout=10):
+        deadline = time.time() + timeout
+        while len(self.jobs) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.sock.close()
+
+
+class SpoolerTest(unittest.TestCase):
+    def setUp(self):
+        self.printer = FakePrinter()
+        self.addCleanup(self.printer.close)
+        self.img1 = PIL.Image.open('example1.png')
+        self.img2 = PIL.Image.open('example2.png')
+
+    def test_coalesce(self):
+        spooler = Spooler(port=self.printer.port)
+        # Queue all jobs before the worker can pick up the first one
+        with spooler._cond:
+            futures = [
+                spooler.submit([self.img1], '127.0.0.1', printer_model='P950NW'),
+                spooler.submit([self.img2, self.img1], '127.0.0.1', printer_model='P950NW'),
+                spooler.submit([self.img2], '127.0.0.1', printer_model='P950NW', top_margin=20),
+            ]
+            self.assertEqual(spooler.queue_depth('127.0.0.1'), 3)
+        spooler.close()
+        self.printer.wait_for_jobs(2)
+
+        for f in futures:
+            self.assertIsNone(f.result())
+        self.assertEqual(self.printer.jobs, [
+            rasterprynt.cat([self.img1, self.img2, self.img1], printer_model='P950NW'),
+            rasterprynt.cat([self.img2], printer_model='P950NW', top_margin=20),
+        ])
+        metrics = spooler.metrics()
+        self.assertEqual(metrics['jobs_done'], 3)
+        self.assertEqual(metrics['batches_sent'], 2)
+        self.assertEqual(metrics['bytes_sent'], sum(len(job) for job in self.printer.jobs))
+        self.assertEqual(metrics['queue_depth'], {'127.0.0.1': 0})
+
+    def test_error(self):
+        with Spooler(port=self.printer.port) as spooler:
+            future = spooler.submit([self.img1], '127.0.0.1', printer_model='unknown')
+            with self.assertRaises(AssertionError):
+                future.result()
+        self.assertEqual(spooler.metrics()['jobs_failed'], 1)
@@ -0,0 +1,73 @@
+import unittest
+
+import PIL.Image
+
+import fakeprinter
+import rasterprynt
+from rasterprynt import parser, status
+
+
+class StatusTest(unittest.TestCase):
+    def setUp(self):
+        self.images = [PIL.Image.open('example1.png'), PIL.Image.open('example2.png')]
+
+    def test_frames(self):
+        frame = status.make_status(
+            status.STATUS_ERROR, status.PHASE_PRINTING, ['no_media', 'cover_open'], media_width=36)
+        self.assertEqual(len(frame), status.STATUS_SIZE)
+        self.assertEqual(status.parse_status(frame), status.Status(
+            status_type=status.STATUS_ERROR, phase=status.PHASE_PRINTING, errors=['no_media', 'cover_open'],
+            media_width=36, media_type=1, notification=0))
+
+        reader = status.StatusReader()
+        data = frame + status.make_status(status.STATUS_PRINTING_COMPLETED)
+        statuses = [s for i in range(0, len(data), 5) for s in reader.feed(data[i:i + 5])]
+        self.assertEqual([s.status_type for s in statuses], [status.STATUS_ERROR, status.STATUS_PRINTING_COMPLETED])
+
+        with self.assertRaises(ValueError):
+            status.parse_status(b'\x00' * status.STATUS_SIZE)
+
+        events = list(parser.parse(b'\x00\x00\x1b@' + status.STATUS_REQUEST))
+        self.assertEqual(events, [parser.Init(), parser.StatusRequest()])
+
+    def test_send_with_status(self):
+        data = rasterprynt.cat(self.images * 2, printer_model='P950NW')
+        page_ends = status.split_pages(data)
+        self.assertEqual(len(page_ends), 4)
+        self.assertEqual(page_ends[-1], len(data))
+
+        with fakeprinter.FakePrinter(rows_per_second=5000) as printer:
+            events = []
+
+            def observer(event, info):
+                if event == 'printed' and info['page'] == 0:
+                    # With window 1, the second page is only sent once the first one has been printed
+                    info = dict(info, received=printer.stats()['bytes'])
+                events.append((event, info))
+
+            status.send_with_status(data, printer.host, port=printer.port, media_width=18, window=1, observer=observer)
+            self.assertEqual(len(printer.pages), 4)
+
+        printed = [info for event, info in events if event == 'printed']
+        self.assertEqual([info['page'] for info in printed], [0, 1, 2, 3])
+        self.assertEqual(printed[0]['received'], len(status.STATUS_REQUEST) + page_ends[0])
+        statuses = [info['status_type'] for event, info in events if event == 'status']
+        self.assertEqual(statuses[0], status.STATUS_REPLY)
+        self.assertEqual(statuses.count(status.STATUS_PRINTING_COMPLETED), 4)
+        self.assertEqual(events[-1][0], 'send')
+
+    def test_errors(self):
+        data = rasterprynt.cat(self.images * 2, printer_model='P950NW')
+        with fakeprinter.FakePrinter(media_width=36) as printer:
+            with self.assertRaises(status.PrinterError):
+                status.send_with_status(data, printer.host, port=printer.port, media_width=18)
+            self.assertEqual(printer.pages, [])
+
+        with fakeprinter.FakePrinter(tape_out_after=1) as printer:
+            with self.assertRaises(status.PrinterError) as cm:
+                status.send_with_status(data, printer.host, port=printer.port)
+            self.assertEqual(cm.exception.status.errors, ['no_media'])
+            self.assertEqual(len(printer.pages), 1)
+
+        with self.assertRaises(ValueError):
+            rasterprynt.prynt(self.images, '127.0.0.1', printer_model='P950NW', stream=True, status=True)
@@ -0,0 +1,75 @@
+import unittest
+
+import PIL.Image
+import PIL.ImageDraw
+
+import rasterprynt
+from rasterprynt.cache import RenderCache
+from rasterprynt.template import LabelTemplate
+
+
+def _text(text, size=(90, 20), mode='RGB'):
+    img = PIL.Image.new(mode, size, 'white')
+    PIL.ImageDraw.Draw(img).text((2, 2), text, fill='black')
+    return img
+
+
+class LabelTemplateTest(unittest.TestCase):
+    def setUp(self):
+        base = PIL.Image.new('RGBA', (400, 100), (255, 255, 255, 0))
+        draw = PIL.ImageDraw.Draw(base)
+        draw.rectangle((0, 0, 399, 99), outline='black', width=2)
+        draw.text((10, 40), 'Serial number:', fill='black')
+        self.template = LabelTemplate(base, {
+            'serial': (120, 35, 250, 60),
+            'lot': (200, 70, 300, 95),  # Overlaps the columns of serial
+            'date': (320, 10, 390, 30),
+        })
+
+    def test_raster_bitmap(self):
+        labels = [
+            self.template.fill(),
+            self.template.fill(serial=_text('A-0001')),
+            self.template.fill(serial=_text('A-0002'), lot=_text('L7', mode='L')),
+            self.template.fill(date=_text('2020-01-01', (70, 20), 'RGBA'), lot=_text('L8')),
+        ]
+        for label in labels:
+            for stripe_size in (312, 408, 536):
+                self.assertEqual(
+                    rasterprynt._raster_bitmap(label, stripe_size),
+                    rasterprynt._raster_bitmap(label.image(), stripe_size))
+
+        images = [label.image() for label in labels]
+        for printer_model in ('P950NW', '9800PCN'):
+            expected = rasterprynt.cat(images, printer_model=printer_model, compression='auto')
+            self.assertEqual(rasterprynt.cat(labels, printer_model=printer_model, compression='auto'), expected)
+
+            cache = RenderCache()
+            self.assertEqual(rasterprynt.cat(labels, printer_model=printer_model, cache=cache), rasterprynt.cat(
+                images, printer_model=printer_model))
+            rasterprynt.cat([self.template.fill(serial=_text('A-0001'))], printer_model=printer_model, cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_trim(self):
+        # Without the frame, there is white space before the text and after the date
+        base = PIL.Image.new('RGB', (400, 100), 'white')
+        PIL.ImageDraw.Draw(base).text((10, 40), 'Serial number:', fill='black')
+        template = LabelTemplate(base, {'serial': (120, 35, 250, 60), 'date': (320, 10, 390, 30)})
+        labels = [template.fill(serial=_text('A-0001')), template.fill(date=_text('2020-01-01', (60, 20)))]
+        images = [label.image() for label in labels]
+        self.assertEqual(
+            rasterprynt.cat(labels, printer_model='P950NW', trim=True),
+            rasterprynt.cat(images, printer_model='P950NW', trim=True))
+        self.assertLess(rasterprynt._trim_image(labels[1]).width, 380)
+
+        # Labels without white space stay template labels
+        label = self.template.fill(serial=_text('A-0001'))
+        self.assertIs(rasterprynt._trim_image(label), label)
+
+    def test_invalid(self):
+        with self.assertRaises(KeyError):
+            self.template.fill(price=_text('1'))
+        with self.assertRaises(ValueError):
+            self.template.fill(date=_text('too large', (100, 20)))
+        with self.assertRaises(ValueError):
+            LabelTemplate(PIL.Image.new('L', (10, 10)), {'x': (5, 0, 11, 5)})